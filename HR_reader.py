@@ -4,192 +4,162 @@
 # when the notifications are switched on.
 # Unlike some other device(e.g. Hexiwear) which just broadcasts all values of interest at 
 # all time this needs to be switched on for each value of interest
+# Connecting, switching the notifications on and reconnecting when the strap
+# goes quiet are all done by the ble_connection state machine in the reader thread
+# The strap can be given by name once it is in the strap cache (see
+# ble_discovery.py), without one the strap used last is read, or DEVICE
+# If gatttool exits or anything handed the notifications fails, the state
+# machine is started again after its backoff (with a new gatttool if need be),
+# the thread only ends when it is stopped
 import pexpect
+import select
 import threading
 import time
-DEVICE = 'A0:9E:1A:25:71:5C'     # Mac address of the device
+from ble_connection import ConnectionStateMachine
+from ble_engine import GatttoolBackend
+from hr_sources import HeartRateSource
+from instrumentation import METRICS
+from strap_cache import StrapCache
+from telemetry import SOURCE_READER
+from tick_scheduler import monotonic
+DEVICE = 'A0:9E:1A:25:71:5C'     # Mac address of the device if the strap cache has none
+GATTTOOL_CMD = "gatttool -I"     # Interactive gatttool, can be swapped for a fake one when benchmarking
+STOP_POLL = 0.5                  # seconds, how quickly the thread notices it is to stop
 
-class HeartBeat_BLE(threading.Thread):
+class HeartBeat_BLE(threading.Thread, HeartRateSource):
     
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, device=None, telemetry=None, cache=None):
         """
         Initialise the gattool. Note we need to be on a Unix based system
         @param logger: If logging is required then a python logger needs to be passed to it 
+        @param device: Mac address or name of the strap to read from, by default the one used last
+        @param telemetry: Optional telemetry.Telemetry to record every notification to
+        @param cache: StrapCache of the known straps, the default file if None
         """
         # This implements threading so super class thread will need initialising
-        super(self.__class__, self).__init__()
+        super(HeartBeat_BLE, self).__init__()
+        # heartRate, rrIntervals and measurement are kept up to date by the source
+        HeartRateSource.__init__(self)
+        self.cache = cache if cache is not None else StrapCache()
+        mac = self.cache.lookup(device) if device else (self.cache.last_used() or DEVICE)
+        if mac is None:
+            raise ValueError("Unknown strap %s, scan for it with: python ble_discovery.py scan" % device)
+        device = mac
         print("Run gatttool...")
         
-        # The gattHandle is the pipe to the gatttool which speaks to the device
-        self.gattHandle = pexpect.spawn("gatttool -I")    
+        # The backend is the pipe to the gatttool which speaks to the device,
+        # known straps skip discovering their handles
+        self.backend = GatttoolBackend(device, GATTTOOL_CMD, self.cache.handles(device),
+                                       self.cache.connect_timeout(device))
         self.stop_thread = False
-        self.listen = False
-        self.heartRate = 60      # This value is updated with new measured heart rate
         self.logger = logger
-        
-        
-        
-    def hexStrToInt(self, hexstr):
-        """
-        Function to transform hexadecimal string like "cd" i.e.0xCD into signed integer
-        """
-        val = int(hexstr[4],16) + (int(hexstr[3],16)<<4)
-        return val
-    
+        self.device = device
+        self.telemetry = telemetry.channel(SOURCE_READER) if telemetry else None
+        self.connection = ConnectionStateMachine(self, self.backend, logger, telemetry=self.telemetry,
+                                                 cache=self.cache)
+        self.machine = None         # the running lifecycle, None while waiting to start it again
+        self.deadline = 0.0
+        self.respawn = False        # gatttool has to be started again before the lifecycle
+
     def stop(self):
         """
         Cleaning up and stopping thread
         """
         self.stop_thread = True
-        time.sleep(0.5)
+        if self.is_alive():
+            self.join(STOP_POLL * 4)
         # switch of notifications since we will no longer be listening to them
-        self.switch_HR_notifications(False)
-        # Close the gatthandle
-        self.gattHandle.close(force=True)
-        self.gattHandle = None
+        try:
+            self.backend.switch_notifications(False)
+            self.backend.disconnect()
+        except Exception:
+            # gatttool may already have gone
+            pass
+        # Close the gatttool
+        self.backend.close()
         self.heartRate = -1
-        
 
-    def connect(self):
-        """
-        Attempts to connect to the BLE measurement tool via the gattTool. The device needs to be connected to
-        before starting the thread
-        @return index: This value is 1 when there is a successful connection.
-        """
-        child = self.gattHandle
-        index = -1
-        # Connect to the device.
-        print("Connecting to "),
-        print(DEVICE),
-        if self.logger:
-            self.logger.info("Trying to connect to %s" %DEVICE)
-        child.sendline("connect {0}".format(DEVICE))
-        try:
-            # Look out for success or error in connection
-            index = child.expect(["connect error", "Connection successful"], timeout=10)
-            if index > 0:
-                print(" Connected!")
-                if self.logger:
-                    self.logger.info("Connected to %s" %DEVICE)
-            else:
-                print("Error connecting")
-                if self.logger:
-                    self.logger.info("Error Connecting to %s" %DEVICE)
-        except pexpect.TIMEOUT:
-            print("Timed out, device not responding to connection request. Please check device")
-            if self.logger:
-                self.logger.info("Timed out, device not responding to connection request. Please check device")
-        
-        return index
-    
-    def disconnect(self):
-        """
-        Attempts to disconnect from the BLE measurement tool. BLE devices can only be connected
-        to one other device at a time. So it must be disconnected 
-        """
-        child = self.gattHandle
-        child.sendline("disconnect {0}".format(DEVICE))
-        # As long as we have sent the command out we are not too fussy about what device sends back
-        # it may already have disconnected
-        index = child.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=5)
-        return index 
-    
-    def switch_HR_notifications(self, switchOn=True):
+    def wait_streaming(self, timeout=None):
         """
-        Switching heart rate notification on/off
-        @param switchOn: bool to indicated whether notification should be on
+        Wait for the first heart rate notification
+        @param timeout: seconds to wait
+        @return: True if notifications are coming in
         """
-        child = self.gattHandle
-        if switchOn:
-            # polarOH specific heart rate notification switch on command
-            child.sendline("char-write-req 0x0026 0100")
-        else:
-            # polarOH specific heart rate notification switch off command
-            child.sendline("char-write-req 0x0026 0000")
-        # As long as it was written successfully we should have hear-rate brodcasting
-        # switched on/off as needed
-        child.expect("Characteristic value was written successfully", timeout=10)
-        self.listen = switchOn
-        
-    def monitor_hr_notification(self):
-        """
-        Monitors heart-rate if the notification was switched on
-        """
-        child = self.gattHandle     
-        # If notifications are on      
-        if self.listen:
-            # Listen for heart rate notification channel for values
-            child.expect("Notification handle = 0x0025 value: ", timeout=30)
-            child.expect("\r\n", timeout=30)
-            
-            # isolate the part that gives the heart rate value
-            hr_string = child.before.strip()
-            
-            # hear rate values come in as hexadecimal strings reversed so
-            # convert it to int
-            hr = self.hexStrToInt(hr_string)
-            if not self.heartRate == hr:
-                #Log and update if there is a change of heart rate
-                if self.logger:
-                    self.logger.info("Heart rate change: %d to %d" % (self.heartRate, hr))
-                self.heartRate = hr
-            else:
-                # print current heart rate 
-                # print("Heart rate read: %s" % hr)
-                if self.logger:
-                    self.logger.info("Heart rate read: %d" % hr)
-            
-            
-            
+        return self.connection.streaming.wait(timeout)
+
     def run(self):
         """
         Thread to constant monitor heart rate
-        Some times device disconnects. We will retry connecting in that case
-        But some reasonable number of times just in case the monitor has died
-        i.e. signal to weak, not picking up, battery dead.
+        The state machine connects, and reconnects whenever the strap goes quiet,
+        backing off between attempts until the thread is stopped
         """ 
-        max_retry = 11 
+        wait_stage = METRICS.stage("ble wait")
+        read_stage = METRICS.stage("ble read")
+        self._advance()
         while not self.stop_thread:
+            timeout = min(max(0.0, self.deadline - monotonic()), STOP_POLL)
+            # waiting to start again there is nothing to read
+            fds = [self.backend.fileno()] if self.machine is not None else []
+            started = wait_stage.begin()
+            ready = select.select(fds, [], [], timeout)[0]
+            wait_stage.end(started)
+            if ready:
+                try:
+                    started = read_stage.begin()
+                    lines = self.backend.read_lines()
+                    read_stage.end(started)
+                except pexpect.EOF:
+                    if not self.stop_thread:
+                        self._restart("gatttool exited", respawn=True)
+                    continue
+                if lines:
+                    self._advance(lines)
+            if monotonic() >= self.deadline:
+                self._advance()
+
+    def _advance(self, lines=None):
+        """
+        Hand the lifecycle its lines, or None at its deadline, starting it if it is not running
+        """
+        try:
+            if self.machine is None:
+                if self.respawn:
+                    self.backend.respawn()
+                    self.respawn = False
+                self.machine = self.connection.lifecycle()
+                self.deadline = next(self.machine)
+            else:
+                self.deadline = self.machine.send(lines)
+        except pexpect.EOF:
+            self._restart("gatttool exited", respawn=True)
+        except Exception as e:
+            self._restart("reader failed: %r" % e, respawn=self.respawn)
+
+    def _restart(self, reason, respawn=False):
+        """
+        Start the lifecycle again after a backoff, with a new gatttool if respawn
+        """
+        if self.machine is not None:
+            self.machine.close()
+        self.machine = None
+        self.respawn = respawn
+        delay = self.connection.abort()
+        self.deadline = monotonic() + delay
+        msg = "%s, starting again in %.1fs" % (reason, delay)
+        print(msg)
+        if self.logger:
+            self.logger.info(msg)
+        if not respawn:
             try:
-                # read monitor
-                self.monitor_hr_notification()    
-                # reset retries
-                max_retry = 11
-            except pexpect.TIMEOUT:
-                if self.stop_thread:
-                    #We are to stop so do nothing
-                    break
-                if max_retry <= 1:
-                    print("Heart rate monitor not responding... ")
-                    if self.logger:
-                        self.logger.info("Heart rate monitor not responding... ")
-                    self.stop()
-                else:
-                    try:
-                        max_retry -= 1
-                        print("Heart rate notification error. Retry %d times" % max_retry)
-                        if self.logger:
-                            self.logger.info("Heart rate notification error. Retry %d times" % max_retry)
-                        self.connect()
-                        self.switch_HR_notifications(True)
-                    except pexpect.TIMEOUT:
-                        pass
+                self.backend.disconnect()
             except Exception:
-                # We are getting some errors when stopping the thread which we don't care about
-                # if we are stopping
-                if self.stop_thread:
-                    #We are to stop so do nothing
-                    break
-                else:
-                    raise
+                self.respawn = True
                 
     
 if __name__ =='__main__':
     hr_listener = None
     try:
         hr_listener = HeartBeat_BLE()
-        hr_listener.connect()
-        hr_listener.switch_HR_notifications(True)
         hr_listener.start()
         time.sleep(120)
 
@@ -197,7 +167,3 @@ if __name__ =='__main__':
         print(" final stop")
         if hr_listener:
             hr_listener.stop()
-    
-    
-    
-    
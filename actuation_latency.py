@@ -0,0 +1,82 @@
+# Online estimate of how long a light command takes to reach the robot.
+# Pepper's ALLeds calls go over the network and block until the robot has
+# applied them, Miro's illum messages are handed to ROS, so the same pulse
+# ends up with a different phase offset on each robot. The robot handlers time
+# their commands (or a blocking probe call when the commands themselves do not
+# block) and the pulse generator runs ahead by the estimate, so the light the
+# participant sees is in phase on both robots. Commands are stamped when step()
+# works them out, so the time one waits in the fanout mailbox while the robot
+# is still busy counts as well.
+# What cannot be timed from here, Miro's way from the ROS publish to its LEDs
+# or the leds' own response, is measured once per robot (e.g. filming a pulse)
+# and given as a fixed offset, "actuation_offset" in the session file.
+# The estimate is the median of the last window measurements so a single
+# stalled call does not throw the phase about.
+import math
+from collections import deque
+
+
+class ActuationLatency(object):
+
+    def __init__(self, window=50, round_trip=False, offset=0.0):
+        """
+        @param window: number of measurements the estimate is taken over
+        @param round_trip: measurements are round trips to the robot, only half counts towards the delay
+        @param offset: fixed delay in seconds on top of what can be measured, e.g. the led driver
+        """
+        self.round_trip = round_trip
+        self.offset = offset
+        self.samples = deque(maxlen=window)
+        self.estimate = offset      # seconds from command to visible light
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._sum = 0.0
+
+    def add(self, duration, queued=0.0):
+        """
+        Add one measured command duration in seconds
+        @param queued: seconds the command waited between step() and being sent, counts in full
+        @return: the updated estimate
+        """
+        delay = (duration / 2.0 if self.round_trip else duration) + queued
+        self.samples.append(delay)
+        self.count += 1
+        self._sum += delay
+        if self.min is None or delay < self.min:
+            self.min = delay
+        if self.max is None or delay > self.max:
+            self.max = delay
+        ordered = sorted(self.samples)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            median = ordered[middle]
+        else:
+            median = (ordered[middle - 1] + ordered[middle]) / 2.0
+        self.estimate = median + self.offset
+        return self.estimate
+
+    def phase_lead(self, f_pulse):
+        """
+        @param f_pulse: pulse frequency in Hz
+        @return: phase in radians the pulse has to run ahead by
+        """
+        return 2 * math.pi * f_pulse * self.estimate
+
+    @property
+    def mean(self):
+        return self._sum / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        @return: dict with the current estimate and the measurements it came from
+        """
+        return {"estimate": self.estimate, "offset": self.offset, "measurements": self.count,
+                "mean": self.mean, "min": self.min, "max": self.max}
+
+    def __str__(self):
+        if not self.count:
+            return "no measurements, estimate: %.1fms (offset %.1fms)" % (self.estimate * 1000.0, self.offset * 1000.0)
+        return ("estimate: %.1fms (offset %.1fms) measurements: %d mean: %.1fms min: %.1fms max: %.1fms"
+                % (self.estimate * 1000.0, self.offset * 1000.0, self.count, self.mean * 1000.0, self.min * 1000.0,
+                   self.max * 1000.0))
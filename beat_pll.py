@@ -0,0 +1,178 @@
+# Phase locked loop on the participant's heart beats.
+# Integrating the pulse frequency gets the light going at the right rate but
+# its peaks end up wherever they end up relative to the actual beats. Here
+# every beat reconstructed from the RR-intervals corrects a prediction of when
+# the next beat will come (phase) and of the beat period (frequency), so the
+# light phase can be computed from the predicted beats directly and the peaks
+# land on them.
+# The light pulses at half the heart rate (one peak every second beat), which
+# is kept here: the light phase advances by pi per predicted beat.
+# Computing the phase for a tick is a couple of multiplications so it is fine
+# to call every tick.
+# The beats are reconstructed on a beat clock: every RR-interval extends it
+# from the previous beat. The strap notifies on a clock of its own (about
+# once a second whatever the heart rate), so a notification only tells that
+# its last beat came before it arrived. That is all the clock is held to: it
+# is pulled back whenever it runs past a notification and let forward to the
+# closest it came to the last ANCHOR_WINDOW of them, so it settles on the
+# beats as their timing against the notifications varies. It is only anchored
+# to a notification afresh at the start and after a gap.
+import math
+from collections import deque
+
+MIN_PERIOD = 0.3    # seconds, i.e. 200bpm
+MAX_PERIOD = 2.0    # seconds, i.e. 30bpm
+ANCHOR_WINDOW = 30  # notifications the beat clock is held to
+MAX_GAP = 3.0       # seconds between notifications before the beat clock is anchored afresh
+
+
+class BeatPLL(object):
+
+    def __init__(self, period=1.0, phase_gain=0.3, period_gain=0.05, rate_factor=1.0, offset=0.0,
+                 beat_delay=0.0, anchor_window=ANCHOR_WINDOW):
+        """
+        @param period: initial beat period in seconds
+        @param phase_gain: fraction of a beat's timing error corrected straight away
+        @param period_gain: fraction of a beat's timing error fed into the period estimate
+        @param rate_factor: light rate relative to the heart rate, 0.8 for the asynchronous condition
+        @param offset: constant light phase offset in radians
+        @param beat_delay: seconds between a beat and its notification arriving
+        @param anchor_window: notifications the beat clock is held to
+        """
+        self.period = period
+        self.phase_gain = phase_gain
+        self.period_gain = period_gain
+        self.rate_factor = rate_factor
+        self.offset = offset
+        self.beat_delay = beat_delay
+        self.next_beat = None      # predicted time of the next beat
+        self.beat_index = 0        # number of the next predicted beat
+        self.last_beat = None      # time of the last beat we were given
+        self.beat_clock = None     # time of the last beat reconstructed from the RR-intervals
+        self.last_sample = None    # arrival time of the last sample
+        self.anchors = 0           # times the beat clock was anchored to a notification
+        self.leads = deque(maxlen=anchor_window)   # seconds the last beat came before each notification
+        # timing error of the beats against the prediction
+        self.phase_error = 0.0     # radians, of the last beat
+        self.beats = 0
+        self._error_sum = 0.0
+        self._error_sq_sum = 0.0
+
+    def add_beat(self, beat_time):
+        """
+        Correct the prediction with an observed beat
+        @param beat_time: monotonic time of the beat
+        @return: phase error of the beat in radians or None if it was not used
+        """
+        if self.last_beat is not None and beat_time <= self.last_beat:
+            return None
+        self.last_beat = beat_time
+        if self.next_beat is None:
+            self.next_beat = beat_time + self.period
+            self.beat_index = 1
+            return None
+        # Catch the prediction up if beats were missed, e.g. during a dropout
+        while beat_time - self.next_beat > self.period / 2.0:
+            self.next_beat += self.period
+            self.beat_index += 1
+        error = beat_time - self.next_beat
+        if error < -self.period / 2.0:
+            # Closer to the previous predicted beat, which we already matched
+            return None
+        self.period = min(max(self.period + self.period_gain * error, MIN_PERIOD), MAX_PERIOD)
+        self.next_beat += self.period + self.phase_gain * error
+        self.beat_index += 1
+
+        self.phase_error = 2 * math.pi * error / self.period
+        self.beats += 1
+        self._error_sum += self.phase_error
+        self._error_sq_sum += self.phase_error * self.phase_error
+        return self.phase_error
+
+    def add_sample(self, sample):
+        """
+        Add the beats of a heart rate sample. Each RR-interval ends a beat one
+        interval after the one before it on the beat clock
+        @return: list of the phase errors of the beats used
+        """
+        if self.next_beat is None and sample.heart_rate > 0:
+            # Start from the measured rate rather than the default period
+            self.period = min(max(60.0 / sample.heart_rate, MIN_PERIOD), MAX_PERIOD)
+        arrived = sample.timestamp - self.beat_delay
+        gap = self.last_sample is not None and sample.timestamp - self.last_sample > MAX_GAP
+        self.last_sample = sample.timestamp
+        if not sample.rr_intervals:
+            if sample.heart_rate > 0:
+                # No RR-intervals, all we can do is follow the rate
+                self.period = min(max(60.0 / sample.heart_rate, MIN_PERIOD), MAX_PERIOD)
+            return []
+        if self.beat_clock is not None and arrived - self.beat_clock - sum(sample.rr_intervals) / 1000.0 > MAX_GAP:
+            # Beats went missing without a gap in the notifications
+            gap = True
+        times = []
+        if self.beat_clock is None or gap:
+            # Nothing to go on but that the last beat came before the notification
+            beat_time = arrived
+            for rr in reversed(sample.rr_intervals):
+                times.append(beat_time)
+                beat_time -= rr / 1000.0
+            times.reverse()
+            self.leads.clear()
+            self.leads.append(0.0)
+            self.anchors += 1
+        else:
+            beat_time = self.beat_clock
+            for rr in sample.rr_intervals:
+                beat_time += rr / 1000.0
+                times.append(beat_time)
+            # The beats cannot have come after the notification, a clock running past one is
+            # pulled back straight away. So that the rounding of the RR-intervals does not build
+            # up it is also let forward, to the closest it came to the notifications of the window
+            self.leads.append(arrived - beat_time)
+            correction = min(self.leads)
+            if correction > 0 and len(self.leads) < self.leads.maxlen:
+                correction = 0.0
+            if correction:
+                times = [beat + correction for beat in times]
+                self.leads = deque((lead - correction for lead in self.leads), self.leads.maxlen)
+        self.beat_clock = times[-1]
+        errors = []
+        for beat_time in times:
+            error = self.add_beat(beat_time)
+            if error is not None:
+                errors.append(error)
+        return errors
+
+    def beat_phase(self, now):
+        """
+        @return: number of predicted beats so far, including the fraction of the current one
+        """
+        if self.next_beat is None:
+            return 0.0
+        previous = self.next_beat - self.period
+        return self.beat_index - 1 + (now - previous) / self.period
+
+    def light_phase(self, now):
+        """
+        Light phase for a raised cosine pulse that peaks on every second predicted beat
+        @param now: monotonic time
+        """
+        return self.rate_factor * math.pi * self.beat_phase(now) + self.offset
+
+    def pulse_frequency(self):
+        """
+        @return: the light pulse frequency in Hz the loop is currently locked to
+        """
+        return self.rate_factor / (2.0 * self.period)
+
+    @property
+    def error_mean(self):
+        return self._error_sum / self.beats if self.beats else 0.0
+
+    @property
+    def error_rms(self):
+        return math.sqrt(self._error_sq_sum / self.beats) if self.beats else 0.0
+
+    def __str__(self):
+        return ("beats: %d period: %.3fs phase error mean: %.1fdeg rms: %.1fdeg"
+                % (self.beats, self.period, math.degrees(self.error_mean), math.degrees(self.error_rms)))
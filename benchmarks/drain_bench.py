@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Strap reader throughput benchmark: how much CPU the reader spends per
+# notification and how quickly it works through a backlog.
+# HeartBeat_BLE is run on its own against the fake gatttool notifying far
+# faster than a polarOH (100+ a second) and writing bursts of notifications
+# at once, the way they come out after the reader was held up. Every
+# notification the reader hands on is time stamped, so the recovery time of a
+# burst is from the fake writing it to the reader having handed on its last
+# notification.
+#
+# python benchmarks/drain_bench.py --notify-rate 200 --bursts 5:2000,12:2000 --duration 20
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+from latency_bench import FAKE_GATTTOOL, percentile, read_events
+from tick_scheduler import monotonic
+
+
+def run_reader(args):
+    import HR_reader
+    import strap_cache
+
+    events_path = tempfile.mktemp(suffix=".jsonl", prefix="heartbot_drain_")
+    cache_path = tempfile.mktemp(suffix=".json", prefix="heartbot_straps_")
+    strap_cache.STRAP_CACHE = cache_path
+    HR_reader.GATTTOOL_CMD = "%s %s --rate %f --schedule %s --events %s --bursts %s" % (
+        sys.executable, FAKE_GATTTOOL, args.notify_rate, args.schedule, events_path, args.bursts)
+
+    handed_on = []
+    samples = []
+    reader = HR_reader.HeartBeat_BLE()
+    reader.add_notification_listener(lambda timestamp, payload: handed_on.append(monotonic()))
+    reader.add_sample_listener(samples.append)
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = monotonic()
+    reader.start()
+    time.sleep(args.duration)
+    reader.stop()
+    wall = monotonic() - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    events = read_events(events_path)
+    os.remove(events_path)
+    for path in (cache_path, cache_path + ".lock"):
+        if os.path.exists(path):
+            os.remove(path)
+    count = min(len(events), len(handed_on))
+    lags = [handed_on[i] - events[i]["t"] for i in range(count) if not events[i]["burst"]]
+    recoveries = []
+    i = 0
+    while i < count:
+        if events[i]["burst"]:
+            first = i
+            while i + 1 < count and events[i + 1]["burst"] and events[i + 1]["t"] == events[first]["t"]:
+                i += 1
+            recoveries.append({"notifications": i + 1 - first, "recovery_s": handed_on[i] - events[first]["t"]})
+        i += 1
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    return {
+        "config": vars(args),
+        "notifications": {"written": len(events), "handed_on": len(handed_on), "samples": len(samples)},
+        "lag_s": {
+            "p50": percentile(lags, 50),
+            "p99": percentile(lags, 99),
+            "max": max(lags) if lags else None,
+        },
+        "bursts": recoveries,
+        "cpu": {
+            "wall_s": wall,
+            "reader_s": cpu,
+            "per_notification_us": 1e6 * cpu / len(handed_on) if handed_on else None,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HeartBot strap reader throughput benchmark")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to read for")
+    parser.add_argument("--notify-rate", type=float, default=200.0, help="notifications per second")
+    parser.add_argument("--schedule", default="60:3,90:4,60:4", help="heart rate schedule, bpm:seconds,...")
+    parser.add_argument("--bursts", default="5:2000,12:2000", help="start:count,... notifications written at once")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_reader(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
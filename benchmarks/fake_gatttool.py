@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Pretends to be "gatttool -I" connected to a polarOH.
+# Answers connect/char-write-req/disconnect the way gatttool does and, while
+# notifications are switched on, prints heart rate notifications at a set rate
+# following a heart rate schedule. The monotonic time each notification is
+# written is appended to an events file (one JSON object per line) so the
+# benchmark can work out how long each heart rate change took to reach the
+# robot. Dropouts of the strap (out of range, battery contact) can be
+# scheduled too: the link is lost, notifications stop and connection attempts
+# fail until the dropout is over. So can bursts: a backlog of notifications
+# written in one go, the way they reach the reader after it was held up.
+# Connecting and looking up the heart rate characteristic take as long as
+# they are told to, so the time saved by the strap cache shows.
+#
+# python fake_gatttool.py [--rate N] [--schedule 60:3,90:4,60:4] [--events file] [--dropouts 5:3,20:8]
+#                         [--bursts 5:500,20:2000] [--connect-delay 0.5] [--discovery-delay 1.0]
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from hr_measurement import encode_hr_measurement
+from tick_scheduler import TickScheduler, monotonic
+
+HR_MEASUREMENT_UUID = "00002a37-0000-1000-8000-00805f9b34fb"
+CCCD_UUID = "00002902-0000-1000-8000-00805f9b34fb"
+
+
+def parse_dropouts(text):
+    """
+    "5:3,20:8" -> [(5.0, 8.0), (20.0, 28.0)] i.e. out of range from 5s to 8s and from 20s to 28s
+    """
+    dropouts = []
+    for step in text.split(",") if text else []:
+        start, duration = step.split(":")
+        dropouts.append((float(start), float(start) + float(duration)))
+    return dropouts
+
+
+def parse_bursts(text):
+    """
+    "5:500,20:2000" -> [(5.0, 500), (20.0, 2000)] i.e. 500 notifications at once 5s after they were switched on
+    """
+    bursts = []
+    for step in text.split(",") if text else []:
+        start, count = step.split(":")
+        bursts.append((float(start), int(count)))
+    return bursts
+
+
+def parse_schedule(text):
+    """
+    "60:3,90:4" -> [(60, 3.0), (90, 4.0)] i.e. 60bpm for 3s then 90bpm for 4s
+    """
+    schedule = []
+    for step in text.split(","):
+        hr, duration = step.split(":")
+        schedule.append((int(hr), float(duration)))
+    return schedule
+
+
+class FakeGatttool(object):
+
+    def __init__(self, rate, schedule, events_path=None, handle=0x0025, dropouts=(), bursts=(),
+                 connect_delay=0.0, discovery_delay=0.0):
+        self.rate = rate
+        self.schedule = schedule
+        self.dropouts = dropouts
+        self.bursts = sorted(bursts)
+        self.handle = handle
+        self.connect_delay = connect_delay
+        self.discovery_delay = discovery_delay
+        self.events = open(events_path, "a") if events_path else None
+        self.notifying = threading.Event()
+        self.lock = threading.Lock()
+        self.started = None
+        self.launched = monotonic()
+
+    def out(self, line):
+        with self.lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def heart_rate_at(self, elapsed):
+        """
+        Heart rate of the schedule at a time since notifications were switched on.
+        The schedule repeats once it runs out
+        """
+        total = sum(duration for _, duration in self.schedule)
+        elapsed = elapsed % total
+        for hr, duration in self.schedule:
+            if elapsed < duration:
+                return hr
+            elapsed -= duration
+        return self.schedule[-1][0]
+
+    def out_of_range(self):
+        """
+        @return: True during a scheduled dropout, the times are from when gatttool was started
+        """
+        elapsed = monotonic() - self.launched
+        return any(start <= elapsed < end for start, end in self.dropouts)
+
+    def notify(self):
+        scheduler = TickScheduler(self.rate)
+        scheduler.start()
+        previous = None
+        while True:
+            self.notifying.wait()
+            if self.out_of_range():
+                # The link is lost, the strap has to be connected to again
+                self.notifying.clear()
+                continue
+            now = monotonic()
+            hr = self.heart_rate_at(now - self.started)
+            count = 1
+            if self.bursts and now - self.started >= self.bursts[0][0]:
+                count = self.bursts.pop(0)[1]
+            payload = encode_hr_measurement(hr, [60000.0 / hr])
+            values = " ".join("%02x" % b for b in bytearray(payload))
+            self.out("\n".join(["Notification handle = 0x%04x value: %s " % (self.handle, values)] * count))
+            if self.events:
+                for i in range(count):
+                    self.events.write(json.dumps({"t": now, "hr": hr, "change": hr != previous and not i,
+                                                  "burst": count > 1}) + "\n")
+                self.events.flush()
+            previous = hr
+            scheduler.wait()
+
+    def run(self):
+        threading.Thread(target=self.notify, name="notify").start()
+        for line in iter(sys.stdin.readline, ""):
+            command = line.split()
+            if not command:
+                continue
+            if command[0] == "connect":
+                self.out("Attempting to connect to %s" % (command[1] if len(command) > 1 else ""))
+                time.sleep(self.connect_delay)
+                if self.out_of_range():
+                    self.out("Error: connect error: Connection refused (111)")
+                else:
+                    self.out("Connection successful")
+            elif command[0] == "characteristics":
+                time.sleep(self.discovery_delay)
+                if len(command) < 4 or command[3] == HR_MEASUREMENT_UUID:
+                    self.out("handle: 0x%04x, char properties: 0x10, char value handle: 0x%04x, uuid: %s"
+                             % (self.handle - 1, self.handle, HR_MEASUREMENT_UUID))
+            elif command[0] == "char-desc":
+                self.out("handle: 0x%04x, uuid: %s" % (self.handle + 1, CCCD_UUID))
+            elif command[0] == "char-write-req":
+                if int(command[1], 16) != self.handle + 1:
+                    self.out("Characteristic Write Request failed: Attribute can't be written")
+                    continue
+                self.out("Characteristic value was written successfully")
+                if command[-1] == "0100":
+                    if self.started is None:
+                        self.started = monotonic()
+                    self.notifying.set()
+                else:
+                    self.notifying.clear()
+            elif command[0] == "disconnect":
+                self.notifying.clear()
+            elif command[0] in ("exit", "quit"):
+                break
+        os._exit(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake interactive gatttool for a polarOH")
+    parser.add_argument("--rate", type=float, default=1.0, help="notifications per second")
+    parser.add_argument("--schedule", default="60:3,90:4,60:4", help="bpm:seconds,... repeated")
+    parser.add_argument("--events", help="file to append notification time stamps to")
+    parser.add_argument("--dropouts", help="start:seconds,... the strap is out of range")
+    parser.add_argument("--bursts", help="start:count,... notifications written at once")
+    parser.add_argument("--connect-delay", type=float, default=0.0, help="seconds connecting takes")
+    parser.add_argument("--discovery-delay", type=float, default=0.0,
+                        help="seconds looking up the heart rate characteristic takes")
+    args = parser.parse_args()
+    FakeGatttool(args.rate, parse_schedule(args.schedule), args.events, dropouts=parse_dropouts(args.dropouts),
+                 bursts=parse_bursts(args.bursts), connect_delay=args.connect_delay,
+                 discovery_delay=args.discovery_delay).run()
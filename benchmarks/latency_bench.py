@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# End to end latency benchmark: from the polarOH sending a new heart rate to
+# the robot's light command going out at the new tempo.
+# polarHeartBot.main is run unchanged against a fake gatttool (which logs when
+# it sends every notification) and fake robot SDKs (which time stamp every
+# light command together with the rate the robot was pulsing at). The
+# propagation latency of a heart rate change is the time from its first
+# notification to the first light command at the new rate.
+#
+# python benchmarks/latency_bench.py --robot pepper --duration 30 --output pepper.json
+# python benchmarks/latency_bench.py --robot pepper,miro --rpc-latency 0.1
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+import fake_naoqi
+import fake_ros
+from instrumentation import METRICS
+from startup_timer import StartupTimer
+from tick_scheduler import monotonic
+
+FAKE_GATTTOOL = os.path.join(BENCH_DIR, "fake_gatttool.py")
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def propagation_latencies(events, commands, asynch):
+    """
+    @param events: notifications written by the fake gatttool
+    @param commands: (monotonic time, robot rate in bps) of every light command
+    @return: list of seconds from each heart rate change to the first command at the new rate,
+             number of changes that never reached the robot
+    """
+    factor = 0.8 if asynch else 1.0
+    changes = [e for e in events if e["change"]][1:]
+    latencies = []
+    missed = 0
+    index = 0
+    for change in changes:
+        expected = change["hr"] * factor / 60.0
+        while index < len(commands) and commands[index][0] < change["t"]:
+            index += 1
+        for stamp, rate in commands[index:]:
+            if rate is not None and abs(rate - expected) < 1e-9:
+                latencies.append(stamp - change["t"])
+                break
+        else:
+            missed += 1
+    return latencies, missed
+
+
+def run_session(args):
+    fake_ros.install()
+    fake_naoqi.install(args.rpc_latency)
+    import HR_reader
+    import polarHeartBot
+    import strap_cache
+
+    events_path = tempfile.mktemp(suffix=".jsonl", prefix="heartbot_bench_")
+    HR_reader.GATTTOOL_CMD = "%s %s --rate %f --schedule %s --events %s --connect-delay %f --discovery-delay %f" % (
+        sys.executable, FAKE_GATTTOOL, args.notify_rate, args.schedule, events_path, args.connect_delay,
+        args.discovery_delay)
+    if args.dropouts:
+        HR_reader.GATTTOOL_CMD += " --dropouts %s" % args.dropouts
+    # Never the participants' strap cache. A fresh one unless asked for, so the strap is discovered
+    cache_path = args.strap_cache or tempfile.mktemp(suffix=".json", prefix="heartbot_straps_")
+    strap_cache.STRAP_CACHE = cache_path
+
+    if args.session:
+        with open(args.session) as f:
+            session = json.load(f)
+    else:
+        session = {"robots": [{"type": robot, "name": "%s%d" % (robot, i), "ip": "robot%d" % i}
+                              for i, robot in enumerate(args.robot.split(","))]}
+    for config in session["robots"]:
+        config.setdefault("led_mode", args.led_mode)
+    session.setdefault("update_rate", args.update_rate)
+    session.setdefault("sync_mode", args.sync_mode)
+
+    captured = {}
+    fanout_class = polarHeartBot.RobotFanout
+
+    class CapturingFanout(fanout_class):
+        """
+        Records the rate every robot was pulsing at with each of its light commands
+        """
+        def __init__(self, robots, *rest, **kwargs):
+            fanout_class.__init__(self, robots, *rest, **kwargs)
+            captured["robot"] = self
+
+        def connect(self, timeout=None):
+            fanout_class.connect(self, timeout)
+            for robot in self.robots:
+                commands = robot.leds if hasattr(robot, "leds") else robot.pub_lights
+                commands.probe = (lambda robot: lambda: robot.heart_rate)(robot)
+    polarHeartBot.RobotFanout = CapturingFanout
+    reader_class = polarHeartBot.HeartBeat_BLE
+
+    class CapturingReader(reader_class):
+        def __init__(self, *args, **kwargs):
+            reader_class.__init__(self, *args, **kwargs)
+            captured["reader"] = self
+    polarHeartBot.HeartBeat_BLE = CapturingReader
+
+    def stop_after_duration():
+        time.sleep(args.duration)
+        captured["robot"].set_active = False
+    stopper = threading.Thread(target=stop_after_duration)
+    stopper.daemon = True
+
+    logger = logging.getLogger("HeartBotBench")
+    logger.addHandler(logging.NullHandler())
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = monotonic()
+    startup = StartupTimer(started=started)
+    if args.stages:
+        METRICS.enable()
+    stopper.start()
+    polarHeartBot.main(args.asynch, logger, session=session, startup=startup)
+    wall = monotonic() - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    fanout = captured["robot"]
+    events = read_events(events_path)
+    os.remove(events_path)
+    if not args.strap_cache:
+        for path in (cache_path, cache_path + ".lock"):
+            if os.path.exists(path):
+                os.remove(path)
+    robots = []
+    for robot, worker in zip(fanout.robots, fanout.workers):
+        if hasattr(robot, "leds"):
+            commands = [(stamp, probe) for stamp, name, _, probe in robot.leds.calls
+                        if name in ("setIntensity", "post.fadeListRGB")]
+        else:
+            commands = [(stamp, probe) for stamp, _, probe in robot.pub_lights.published]
+        latencies, missed = propagation_latencies(events, commands, robot.asynchMode)
+        robots.append({
+            "name": robot.name,
+            "light_commands": len(commands),
+            "replaced_while_busy": worker.mailbox.replaced,
+            "latency_s": {
+                "count": len(latencies),
+                "missed": missed,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies) if latencies else None,
+            },
+            "actuation_latency_s": robot.actuation.summary(),
+        })
+
+    stages = dict((name, dict((key, value) for key, value in stage.items() if key != "buckets"))
+                  for name, stage in METRICS.snapshot()["stages"].items())
+    cpu_self = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    stats = fanout.scheduler.stats
+    return {
+        "config": vars(args),
+        "notifications": len(events),
+        "connection": captured["reader"].connection.metrics.summary(),
+        "startup_s": startup.summary(),
+        "robots": robots,
+        "loop": {
+            "ticks": stats.ticks,
+            "overruns": stats.overruns,
+            "skipped": stats.skipped,
+            "jitter_mean_s": stats.jitter_mean,
+            "jitter_rms_s": stats.jitter_rms,
+            "jitter_max_s": stats.jitter_max,
+        },
+        "stages": stages,
+        "cpu": {
+            "wall_s": wall,
+            "session_s": cpu_self,
+            "session_percent": 100.0 * cpu_self / wall,
+            "fake_gatttool_s": children.ru_utime + children.ru_stime,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HeartBot notification to light latency benchmark")
+    parser.add_argument("--robot", default="pepper", help="pepper, miro or several of them e.g. pepper,miro")
+    parser.add_argument("--session", help="session file with the robots, instead of --robot")
+    parser.add_argument("--duration", type=float, default=30.0, help="session length in seconds")
+    parser.add_argument("--notify-rate", type=float, default=1.0, help="notifications per second")
+    parser.add_argument("--schedule", default="60:3,90:4,60:4", help="heart rate schedule, bpm:seconds,...")
+    parser.add_argument("--dropouts", help="strap dropouts, start:seconds,...")
+    parser.add_argument("--connect-delay", type=float, default=0.0, help="seconds connecting to the strap takes")
+    parser.add_argument("--discovery-delay", type=float, default=0.0,
+                        help="seconds looking up the heart rate characteristic takes")
+    parser.add_argument("--strap-cache", help="strap cache file kept between runs, by default a fresh one each run")
+    parser.add_argument("--update-rate", type=float, default=20.0, help="light loop rate")
+    parser.add_argument("--led-mode", default="tick", help="Pepper led mode, tick or window")
+    parser.add_argument("--sync-mode", default="rate", help="rate or beat locked lights")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="simulated naoqi round trip")
+    parser.add_argument("--async", dest="asynch", action="store_true", help="asynchronous mode")
+    parser.add_argument("--stages", action="store_true", help="time the stages of the reader and the light loop")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_session(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
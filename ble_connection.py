@@ -0,0 +1,406 @@
+# Connection state machine for one heart rate strap, used by HeartBeat_BLE
+# (startup and runtime alike) and by every SensorSession of the BLE engine.
+# It is a generator coroutine: it yields the deadline it is prepared to wait
+# until and is sent the lines the transport produced since (as many as came in
+# one read), or None if the deadline passed first.
+# A malformed notification is skipped and counted, the others around it are
+# handed on as usual.
+#
+#   connecting -> [discovering ->] subscribing -> streaming -> backoff -> connecting ...
+#
+# A strap whose handles are not known yet (see strap_cache.py) has its heart
+# rate characteristic discovered on the first connection only.
+# While streaming the strap counts as lost when the gap since its last
+# notification grows well past the gaps it has been keeping (a polarOH
+# notifies about once a second, so a dropout is noticed after a few seconds
+# rather than after a fixed long timeout). Failed or lost connections are
+# retried after an exponentially growing, jittered delay that starts again
+# from the beginning once notifications flow. Nothing is published while the
+# strap is away, so the robots keep pulsing at the last good heart rate.
+# Every dropout is recorded with how long it took to notice and to recover,
+# every connection with how long it took to connect.
+# Notifications that come in together, e.g. the backlog after the reader was
+# held up, are handed on as one batch: the newest sets the heart rate, every
+# one of them is recorded.
+import random
+import threading
+
+from hr_measurement import decode_hr_measurement
+from instrumentation import METRICS
+from tick_scheduler import monotonic as _now
+
+CONNECT_TIMEOUT = 10.0          # seconds to wait for "Connection successful", unless the strap is known
+DISCOVER_TIMEOUT = 10.0         # seconds to wait for the heart rate characteristic to be found
+WRITE_TIMEOUT = 10.0            # seconds to wait for the notification switch write
+SILENCE_TIMEOUT = 5.0           # longest gap allowed, also used until the gaps are known
+MIN_SILENCE = 2.0               # shortest gap that counts as a dropout
+GAP_FACTOR = 3.0                # a gap this many times the usual one counts as a dropout
+BACKOFF_INITIAL = 0.5           # seconds before the first reconnect attempt
+BACKOFF_MAX = 30.0              # the delay between attempts does not grow past this
+BACKOFF_JITTER = 0.5            # up to this fraction of the delay is taken off at random
+
+CONNECTING = "connecting"
+DISCOVERING = "discovering"
+SUBSCRIBING = "subscribing"
+STREAMING = "streaming"
+BACKOFF = "backoff"
+
+CONNECTED = b"Connection successful"
+CONNECT_ERROR = b"connect error"
+WRITTEN = b"Characteristic value was written successfully"
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter, so several straps that dropped out
+    together do not all retry at the same moment
+    """
+
+    def __init__(self, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX, factor=2.0, jitter=BACKOFF_JITTER,
+                 rng=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.attempt = 0
+
+    def next(self):
+        """
+        @return: seconds to wait before the next attempt
+        """
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1.0 - self.jitter * self.rng.random())
+
+    def reset(self):
+        self.attempt = 0
+
+
+class NotificationGaps(object):
+    """
+    Running estimate of the gap between notifications
+    """
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.mean = None
+        self.last = None
+
+    def add(self, now):
+        if self.last is not None:
+            gap = now - self.last
+            self.mean = gap if self.mean is None else self.mean + self.alpha * (gap - self.mean)
+        self.last = now
+
+    def restart(self):
+        """
+        Forget the last notification, e.g. after reconnecting, but keep the usual gap
+        """
+        self.last = None
+
+    def silence_timeout(self):
+        """
+        @return: how long without a notification counts as a dropout
+        """
+        if self.mean is None:
+            return SILENCE_TIMEOUT
+        return min(max(GAP_FACTOR * self.mean, MIN_SILENCE), SILENCE_TIMEOUT)
+
+
+class DropoutMetrics(object):
+    """
+    Time to detect and time to recover of every dropout of a strap
+    """
+
+    def __init__(self):
+        self.started = _now()
+        self.first_notification = None
+        self.dropouts = []          # (time to detect, time to recover or None while still out)
+        self.attempts = 0           # connection attempts, including the first
+        self.connects = []          # seconds each successful connection took
+        self.discoveries = []       # seconds each discovery of the handles took
+        self.malformed = 0          # notifications skipped as they could not be decoded
+        self._detected = None
+
+    def connecting(self):
+        self.attempts += 1
+
+    def connected(self, seconds):
+        self.connects.append(seconds)
+
+    def discovered(self, seconds):
+        self.discoveries.append(seconds)
+
+    def notification(self, now):
+        """
+        @return: seconds it took to recover if this notification ends a dropout, else None
+        """
+        if self.first_notification is None:
+            self.first_notification = now
+        if self._detected is None:
+            return None
+        recovered = now - self._detected
+        self.dropouts[-1] = (self.dropouts[-1][0], recovered)
+        self._detected = None
+        return recovered
+
+    def dropout(self, last_notification, now):
+        """
+        @param last_notification: time of the last notification before the strap went silent
+        @param now: time the silence was noticed
+        @return: seconds it took to notice
+        """
+        detect = now - last_notification
+        self.dropouts.append((detect, None))
+        self._detected = now
+        return detect
+
+    @property
+    def startup_time(self):
+        """
+        @return: seconds from starting to the first notification
+        """
+        return self.first_notification - self.started if self.first_notification is not None else None
+
+    def summary(self):
+        detect = [d for d, _ in self.dropouts]
+        recover = [r for _, r in self.dropouts if r is not None]
+        return {
+            "startup_s": self.startup_time,
+            "attempts": self.attempts,
+            "dropouts": len(self.dropouts),
+            "malformed": self.malformed,
+            "detect_mean_s": sum(detect) / len(detect) if detect else None,
+            "detect_max_s": max(detect) if detect else None,
+            "recover_mean_s": sum(recover) / len(recover) if recover else None,
+            "recover_max_s": max(recover) if recover else None,
+            "connect_mean_s": sum(self.connects) / len(self.connects) if self.connects else None,
+            "connect_max_s": max(self.connects) if self.connects else None,
+            "discover_s": sum(self.discoveries) if self.discoveries else None,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        text = "attempts: %d dropouts: %d" % (summary["attempts"], summary["dropouts"])
+        if summary["startup_s"] is not None:
+            text += " startup: %.1fs" % summary["startup_s"]
+        if summary["malformed"]:
+            text += " malformed: %d" % summary["malformed"]
+        if summary["connect_mean_s"] is not None:
+            text += " connect mean: %.2fs max: %.2fs" % (summary["connect_mean_s"], summary["connect_max_s"])
+        if summary["discover_s"] is not None:
+            text += " discovery: %.2fs" % summary["discover_s"]
+        if summary["detect_mean_s"] is not None:
+            text += " detect mean: %.1fs max: %.1fs" % (summary["detect_mean_s"], summary["detect_max_s"])
+        if summary["recover_mean_s"] is not None:
+            text += " recover mean: %.1fs max: %.1fs" % (summary["recover_mean_s"], summary["recover_max_s"])
+        return text
+
+
+def _from_line(lines, *markers):
+    """
+    @return: the lines from the first one with any of the markers on, None if there is none
+    """
+    for i, line in enumerate(lines):
+        for marker in markers:
+            if marker in line:
+                return lines[i:]
+    return None
+
+
+class ConnectionStateMachine(object):
+
+    def __init__(self, source, backend, logger=None, name=None, telemetry=None, backoff=None, cache=None):
+        """
+        @param source: HeartRateSource the notifications are handed to
+        @param backend: transport with connect, disconnect, switch_notifications and notification_value,
+                        the handles, discover and discovered and a connect_timeout
+        @param logger: optional python logger
+        @param name: prefix for the log messages, e.g. the mac address
+        @param telemetry: optional telemetry channel every heart rate is recorded to
+        @param backoff: Backoff to pace the reconnect attempts with
+        @param cache: optional StrapCache to keep the discovered handles and connect times in
+        """
+        self.source = source
+        self.backend = backend
+        self.cache = cache
+        self.logger = logger
+        self.name = name
+        self.telemetry = telemetry
+        self.backoff = backoff or Backoff()
+        self.gaps = NotificationGaps()
+        self.metrics = DropoutMetrics()
+        self.state = CONNECTING
+        # set while notifications are coming in
+        self.streaming = threading.Event()
+        self.parse_stage = METRICS.stage("%s parse" % (name or "ble"))
+        self.publish_stage = METRICS.stage("%s publish" % (name or "ble"))
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.info("[%s] %s" % (self.name, msg) if self.name else msg)
+
+    def lifecycle(self):
+        """
+        The connect/notify/reconnect coroutine
+        """
+        backend = self.backend
+        while True:
+            self.state = CONNECTING
+            self.metrics.connecting()
+            self._log("Trying to connect")
+            connecting = _now()
+            backend.connect()
+            deadline = connecting + backend.connect_timeout
+            lines = yield deadline
+            while lines is not None and _from_line(lines, CONNECTED, CONNECT_ERROR) is None:
+                lines = yield deadline
+            if lines is not None:
+                lines = _from_line(lines, CONNECTED, CONNECT_ERROR)
+
+            connected = lines is not None and CONNECTED in lines[0]
+            if connected:
+                self._connected(_now() - connecting)
+                if backend.handles is None:
+                    # First connection to this strap, find its heart rate characteristic
+                    self.state = DISCOVERING
+                    discovering = _now()
+                    backend.discover()
+                    deadline = discovering + DISCOVER_TIMEOUT
+                    lines = yield deadline
+                    while lines is not None and not backend.discovered(lines):
+                        lines = yield deadline
+                    connected = lines is not None
+                    if connected:
+                        self._discovered(_now() - discovering)
+                    else:
+                        self._log("Could not find the heart rate characteristic")
+            else:
+                self._log("Connection failed")
+                # a known strap may just be slower to connect today, give the next attempts the full time
+                backend.connect_timeout = max(backend.connect_timeout, CONNECT_TIMEOUT)
+
+            if connected:
+                self.state = SUBSCRIBING
+                backend.switch_notifications(True)
+                deadline = _now() + WRITE_TIMEOUT
+                lines = yield deadline
+                while lines is not None and _from_line(lines, WRITTEN) is None:
+                    lines = yield deadline
+
+                if lines is not None:
+                    self.state = STREAMING
+                    self._log("Connected, heart rate notifications on")
+                    self.gaps.restart()
+                    # Hand notifications to the source until the strap goes silent,
+                    # starting with any that came in right behind the write response
+                    deadline = _now() + SILENCE_TIMEOUT
+                    lines = _from_line(lines, WRITTEN)[1:]
+                    while lines is not None:
+                        started = self.parse_stage.begin()
+                        try:
+                            values = [value for value in map(backend.notification_value, lines)
+                                      if value is not None]
+                        except ValueError:
+                            values = [value for value in map(self._notification_value, lines)
+                                      if value is not None]
+                        self.parse_stage.end(started)
+                        if values:
+                            now = _now()
+                            self._notifications(values, now)
+                            self.publish_stage.end(now)
+                            deadline = now + self.gaps.silence_timeout()
+                        lines = yield deadline
+                    if self.gaps.last is not None:
+                        detect = self.metrics.dropout(self.gaps.last, _now())
+                        self._log("No notification for %.1fs, holding heart rate %d while reconnecting"
+                                  % (detect, self.source.heartRate))
+                else:
+                    self._log("Could not switch heart rate notifications on")
+
+            self.streaming.clear()
+            self.state = BACKOFF
+            backend.disconnect()
+            delay = self.backoff.next()
+            deadline = _now() + delay
+            while (yield deadline) is not None:
+                pass
+
+    def abort(self, now=None):
+        """
+        The lifecycle was ended from outside, e.g. its gatttool exited. Counts
+        as a dropout if the strap was streaming
+        @return: seconds to back off before starting a new lifecycle
+        """
+        if self.state == STREAMING and self.gaps.last is not None:
+            self.metrics.dropout(self.gaps.last, _now() if now is None else now)
+        self.streaming.clear()
+        self.state = BACKOFF
+        return self.backoff.next()
+
+    def _connected(self, seconds):
+        self.metrics.connected(seconds)
+        self._log("Connection took %.2fs" % seconds)
+        if self.cache is not None:
+            self.cache.record_connect(self.backend.device, seconds)
+
+    def _discovered(self, seconds):
+        self.metrics.discovered(seconds)
+        self._log("Heart rate characteristic found in %.2fs, value handle 0x%04x notification switch 0x%04x"
+                  % ((seconds,) + tuple(self.backend.handles)))
+        if self.cache is not None:
+            self.cache.add(self.backend.device, handles=self.backend.handles)
+
+    def _notification_value(self, line):
+        """
+        backend.notification_value, skipping a line that is not hex
+        """
+        try:
+            return self.backend.notification_value(line)
+        except ValueError as e:
+            self._malformed(line, e)
+            return None
+
+    def _decodes(self, value):
+        try:
+            decode_hr_measurement(value)
+            return True
+        except ValueError as e:
+            self._malformed(" ".join("%02x" % b for b in bytearray(value)), e)
+            return False
+
+    def _malformed(self, text, error):
+        self.metrics.malformed += 1
+        self._log("Skipped a malformed notification %r: %s" % (text, error))
+
+    def _notifications(self, values, now):
+        if self.gaps.last is None:
+            # First notification of this connection
+            self.backoff.reset()
+            self.streaming.set()
+            recovered = self.metrics.notification(now)
+            if recovered is not None:
+                self._log("Recovered after %.1fs" % recovered)
+        # a batch is one gap, the notifications in it were only held up on the way
+        self.gaps.add(now)
+        previous = self.source.heartRate
+        try:
+            measurements = self.source.handle_notifications(values, received=now)
+        except ValueError:
+            # Hand on the ones that decode
+            decoded = [value for value in values if self._decodes(value)]
+            if len(decoded) == len(values):
+                # not the notifications, a subscriber
+                raise
+            values = decoded
+            if not values:
+                return
+            measurements = self.source.handle_notifications(values, received=now)
+        if self.telemetry:
+            for measurement in measurements:
+                self.telemetry.record(measurement.heart_rate)
+        hr = measurements[-1].heart_rate
+        if hr != previous:
+            # Log if there is a change of heart rate
+            self._log("Heart rate change: %d to %d" % (previous, hr))
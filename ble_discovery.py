@@ -0,0 +1,177 @@
+# Finding heart rate straps.
+# Scans for Bluetooth LE devices, connects to each of them in turn and keeps
+# the ones with a heart rate measurement characteristic in the strap cache
+# (strap_cache.py) together with the handles of the characteristic and of its
+# notification switch. Sessions then read a strap by its name and go
+# straight to switching its notifications on. A strap that is only given by
+# its mac address is discovered the first time a session connects to it.
+# Scanning uses hcitool, which needs root:
+#
+#   sudo python ble_discovery.py scan [--duration 10] [--name polar] --cache ~/.heartbot_straps.json
+#   python ble_discovery.py list
+#   python ble_discovery.py forget <strap>
+import argparse
+import os
+import re
+import select
+import signal
+import subprocess
+import sys
+
+import pexpect
+
+from ble_connection import CONNECT_ERROR, CONNECT_TIMEOUT, CONNECTED, DISCOVER_TIMEOUT
+from ble_engine import READ_SIZE, GatttoolBackend
+from strap_cache import StrapCache
+from tick_scheduler import monotonic
+
+SCAN_COMMAND = ["hcitool", "lescan"]
+SCAN_DURATION = 10.0            # seconds
+ADVERTISEMENT = re.compile(r"^([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})\s+(.*)$")
+
+
+def _line_buffered(command):
+    """
+    hcitool block buffers what it writes to a pipe, under stdbuf (if there is one) it writes every line
+    """
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        if os.access(os.path.join(directory, "stdbuf"), os.X_OK):
+            return ["stdbuf", "-oL"] + list(command)
+    return list(command)
+
+
+def _advertisements(data, devices):
+    """
+    Take the devices out of the complete lines of the scan's output
+    @return: what is left after the last complete line
+    """
+    lines = data.split(b"\n")
+    for line in lines[:-1]:
+        match = ADVERTISEMENT.match(line.decode("utf-8", "replace").strip())
+        if match:
+            mac = match.group(1).upper()
+            name = match.group(2).strip()
+            devices[mac] = (None if name == "(unknown)" else name) or devices.get(mac)
+    return lines[-1]
+
+
+def scan(duration=SCAN_DURATION, command=SCAN_COMMAND):
+    """
+    @param duration: seconds to listen for advertisements
+    @return: dict of the mac address of every device seen to its name, None if it did not send one
+    """
+    process = subprocess.Popen(_line_buffered(command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    devices = {}
+    pending = b""
+    deadline = monotonic() + duration
+    try:
+        # Straight from the pipe, a buffered readline would keep lines select cannot see
+        while monotonic() < deadline:
+            if not select.select([process.stdout], [], [], max(0.0, deadline - monotonic()))[0]:
+                continue
+            data = os.read(process.stdout.fileno(), READ_SIZE)
+            if not data:
+                break
+            pending = _advertisements(pending + data, devices)
+    finally:
+        if process.poll() is None:
+            # lescan only puts the adapter back when it is interrupted
+            process.send_signal(signal.SIGINT)
+        # and what it flushes on the way out counts too
+        _advertisements(pending + process.communicate()[0] + b"\n", devices)
+    return devices
+
+
+def _wait_for(backend, done, timeout):
+    """
+    Read gatttool's lines until done(lines) is true
+    @return: False if the timeout passed first
+    """
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if select.select([backend.fileno()], [], [], max(0.0, deadline - monotonic()))[0]:
+            lines = backend.read_lines()
+            if lines and done(lines):
+                return True
+    return False
+
+
+def probe(mac, command="gatttool -I", timeout=CONNECT_TIMEOUT):
+    """
+    Connect to a device and look for its heart rate measurement characteristic
+    @return: (value handle, notification switch handle) or None if the device has none or could not
+             be connected to, and the seconds connecting took (None if it failed)
+    """
+    backend = GatttoolBackend(mac, command)
+    answer = []
+
+    def answered(lines):
+        answer.extend(line for line in lines if CONNECTED in line or CONNECT_ERROR in line)
+        return bool(answer)
+
+    try:
+        started = monotonic()
+        backend.connect()
+        if not _wait_for(backend, answered, timeout) or CONNECTED not in answer[0]:
+            return None, None
+        connect_s = monotonic() - started
+        backend.discover()
+        if not _wait_for(backend, backend.discovered, DISCOVER_TIMEOUT):
+            return None, connect_s
+        return backend.handles, connect_s
+    except pexpect.EOF:
+        return None, None
+    finally:
+        try:
+            backend.disconnect()
+        except Exception:
+            pass
+        backend.close()
+
+
+def print_straps(cache):
+    print("%-17s  %-24s %6s %6s %8s %8s" % ("mac", "name", "value", "switch", "connects", "connect"))
+    for mac, entry in sorted(cache.straps.items()):
+        handles = cache.handles(mac)
+        print("%-17s  %-24s %6s %6s %8d %8s" % (
+            mac, entry.get("name") or "-",
+            "0x%04x" % handles[0] if handles else "-",
+            "0x%04x" % handles[1] if handles else "-",
+            entry.get("connects", 0),
+            "%.2fs" % entry["connect_mean_s"] if "connect_mean_s" in entry else "-"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find heart rate straps and keep them in the strap cache")
+    parser.add_argument("command", choices=["scan", "list", "forget"])
+    parser.add_argument("strap", nargs="?", help="mac address or name of the strap to forget")
+    parser.add_argument("--duration", type=float, default=SCAN_DURATION, help="seconds to scan for")
+    parser.add_argument("--name", help="only look at devices whose name contains this, e.g. polar")
+    parser.add_argument("--gatttool", default="gatttool -I", help="interactive gatttool command")
+    parser.add_argument("--cache", help="strap cache file, by default %s" % StrapCache().path)
+    args = parser.parse_args()
+
+    cache = StrapCache(args.cache)
+    if args.command == "scan":
+        print("Scanning for %.0fs..." % args.duration)
+        devices = scan(args.duration)
+        for mac, name in sorted(devices.items()):
+            if args.name and args.name.lower() not in (name or "").lower():
+                continue
+            handles, connect_s = probe(mac, args.gatttool)
+            if handles:
+                cache.add(mac, name, handles)
+                print("%s %s: heart rate at 0x%04x, notifications 0x%04x, connected in %.2fs"
+                      % (mac, name or "", handles[0], handles[1], connect_s))
+            else:
+                print("%s %s: %s" % (mac, name or "", "no heart rate" if connect_s is not None else "no connection"))
+        print_straps(cache)
+    elif args.command == "list":
+        print_straps(cache)
+    else:
+        mac = cache.lookup(args.strap or "")
+        if mac is None:
+            print("Unknown strap %s" % args.strap)
+            sys.exit(1)
+        cache.forget(mac)
+        print("Forgot %s" % mac)
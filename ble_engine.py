@@ -0,0 +1,352 @@
+# Multi-sensor heart rate reader.
+# HeartBeat_BLE needs a thread and a gatttool per strap. Here a single select()
+# loop drives any number of straps. Each strap gets a SensorSession whose
+# connect/notify/reconnect cycle is the generator coroutine of
+# ble_connection.ConnectionStateMachine: it yields the deadline it is prepared
+# to wait until and gets sent the lines the device transport produced (or
+# None if the deadline passed first).
+# The transport is pluggable. GatttoolBackend wraps the same "gatttool -I"
+# interface HeartBeat_BLE uses. gatttool only holds one connection at a time so
+# that backend still needs a child per strap, but they are all serviced from
+# the one loop.
+# The handles of a strap's heart rate characteristic come from the strap cache
+# (strap_cache.py), a strap that is not in it yet has them discovered once
+# connected.
+import os
+import re
+import select
+import threading
+import time
+import pexpect
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from ble_connection import CONNECT_TIMEOUT, ConnectionStateMachine
+from hr_measurement import gatt_value_to_bytes
+from hr_sources import HeartRateSource
+from strap_cache import StrapCache
+from tick_scheduler import monotonic as _now
+
+HR_MEASUREMENT_UUID = b"00002a37-0000-1000-8000-00805f9b34fb"
+CCCD_UUID = b"00002902-0000-1000-8000-00805f9b34fb"       # notification switch of a characteristic
+DESCRIPTOR_SPAN = 3             # handles after the value handle to look for the switch in
+VALUE_HANDLE = re.compile(br"char value handle: 0x([0-9a-fA-F]{4})")
+DESCRIPTOR_HANDLE = re.compile(br"handle: 0x([0-9a-fA-F]{4}), uuid: ")
+STREAM_SIZE = 256               # samples kept per device stream before dropping
+READ_SIZE = 65536               # bytes read from the pty at a time
+
+
+class GatttoolBackend(object):
+    """
+    Device transport on top of an interactive gatttool. Only does non blocking
+    I/O so it can be serviced from a select loop
+    """
+
+    def __init__(self, device, command="gatttool -I", handles=None, connect_timeout=CONNECT_TIMEOUT):
+        """
+        @param device: mac address of the strap
+        @param command: command to start the interactive gatttool
+        @param handles: (heart rate measurement value handle, its notification switch handle),
+                        None to discover them once connected
+        @param connect_timeout: seconds to wait for a connection
+        """
+        self.device = device
+        self.command = command
+        self.child = pexpect.spawn(command)
+        self.connect_timeout = connect_timeout
+        self._buffer = b""
+        self._value_handle = None
+        self.set_handles(handles)
+
+    def respawn(self):
+        """
+        Start a new gatttool after the last one exited
+        """
+        self.close()
+        self._buffer = b""
+        self._value_handle = None
+        self.child = pexpect.spawn(self.command)
+
+    def set_handles(self, handles):
+        self.handles = tuple(handles) if handles else None
+        self.notification_prefix = None
+        if handles:
+            self.notification_prefix = ("Notification handle = 0x%04x value: " % handles[0]).encode('ascii')
+
+    def fileno(self):
+        return self.child.fileno()
+
+    def connect(self):
+        self.child.sendline("connect {0}".format(self.device))
+
+    def disconnect(self):
+        self.child.sendline("disconnect")
+
+    def switch_notifications(self, switchOn=True):
+        self.child.sendline("char-write-req 0x%04x %s" % (self.handles[1], "0100" if switchOn else "0000"))
+
+    def discover(self):
+        """
+        Ask the connected strap for its heart rate measurement characteristic,
+        the answers go to discovered()
+        """
+        self._value_handle = None
+        self.child.sendline("characteristics 0x0001 0xffff %s" % HR_MEASUREMENT_UUID.decode('ascii'))
+
+    def discovered(self, lines):
+        """
+        Take in gatttool's answers to discover(), and look for the notification
+        switch once the characteristic is found
+        @return: True once the handles are known
+        """
+        for line in lines:
+            if self._value_handle is None:
+                match = VALUE_HANDLE.search(line)
+                if match and HR_MEASUREMENT_UUID in line:
+                    self._value_handle = int(match.group(1), 16)
+                    self.child.sendline("char-desc 0x%04x 0x%04x"
+                                        % (self._value_handle + 1, self._value_handle + DESCRIPTOR_SPAN))
+            else:
+                match = DESCRIPTOR_HANDLE.search(line)
+                if match and CCCD_UUID in line:
+                    self.set_handles((self._value_handle, int(match.group(1), 16)))
+                    return True
+        return False
+
+    def read_lines(self):
+        """
+        Drain whatever is waiting on the pty and return the complete lines.
+        A backlog comes out in a few large reads and is split in one go
+        @return: list of lines (bytes) without line endings
+        """
+        chunks = [self._buffer]
+        try:
+            while True:
+                chunk = self.child.read_nonblocking(READ_SIZE, timeout=0)
+                chunks.append(chunk)
+                if len(chunk) < READ_SIZE:
+                    break
+        except pexpect.TIMEOUT:
+            pass
+        except pexpect.EOF:
+            if len(chunks) == 1:
+                raise
+            # hand on what came before, the next read raises again
+        if len(chunks) == 1:
+            return []
+        lines = b"".join(chunks).replace(b"\r", b"").split(b"\n")
+        self._buffer = lines.pop()
+        return lines
+
+    def notification_value(self, line):
+        """
+        @return: the raw measurement bytes if the line is a heart rate notification, else None
+        """
+        if self.notification_prefix is None:
+            return None
+        index = line.find(self.notification_prefix)
+        if index < 0:
+            return None
+        return gatt_value_to_bytes(line[index + len(self.notification_prefix):])
+
+    def close(self):
+        self.child.close(force=True)
+
+
+class SensorSession(HeartRateSource):
+    """
+    State of a single strap in the engine. It is a heart rate source like
+    HeartBeat_BLE so it can be handed to the robot handlers as their hr_reader
+    """
+
+    def __init__(self, device, backend, logger=None, stream_size=STREAM_SIZE, cache=None):
+        super(SensorSession, self).__init__()
+        self.device = device
+        self.backend = backend
+        self.logger = logger
+        self.connection = ConnectionStateMachine(self, backend, logger, name=device, cache=cache)
+        self.dropped = 0
+        # Per device stream of HRSamples
+        self.samples = queue.Queue(stream_size)
+        self.add_sample_listener(self._enqueue)
+        self.coroutine = None
+        self.deadline = None
+        self.respawn = False        # gatttool exited, start a new one before connecting again
+
+    @property
+    def state(self):
+        return self.connection.state
+
+    def lifecycle(self):
+        """
+        The connect/notify/reconnect coroutine for this strap
+        """
+        return self.connection.lifecycle()
+
+    def _enqueue(self, sample):
+        try:
+            self.samples.put_nowait(sample)
+        except queue.Full:
+            # Nobody is draining this stream, keep the newest
+            self.dropped += 1
+            try:
+                self.samples.get_nowait()
+            except queue.Empty:
+                pass
+            self.samples.put_nowait(sample)
+
+
+class BLEReaderEngine(object):
+    """
+    Runs any number of SensorSessions from one event loop
+    """
+
+    def __init__(self, backend_factory=GatttoolBackend, logger=None, cache=None):
+        """
+        @param backend_factory: callable(device) returning a transport for the device
+        @param logger: optional python logger
+        @param cache: StrapCache of the known straps, the default file if None
+        """
+        self.backend_factory = backend_factory
+        self.logger = logger
+        self.cache = cache if cache is not None else StrapCache()
+        self.sessions = {}
+        self.stop_loop = False
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+
+    def add_sensor(self, device):
+        """
+        Register a strap. Can be called before or while the engine is running
+        @param device: mac address or name of the strap
+        @return: the SensorSession of the device
+        """
+        mac = self.cache.lookup(device)
+        if mac is None:
+            raise ValueError("Unknown strap %s, scan for it with: python ble_discovery.py scan" % device)
+        backend = self.backend_factory(mac)
+        if backend.handles is None:
+            backend.set_handles(self.cache.handles(mac))
+        backend.connect_timeout = self.cache.connect_timeout(mac)
+        session = SensorSession(mac, backend, self.logger, cache=self.cache)
+        self._advance(session)
+        self.sessions[mac] = session
+        self._wake()
+        return session
+
+    def stream(self, device):
+        """
+        @return: queue of HRSamples for the device
+        """
+        return self.sessions[self.cache.lookup(device)].samples
+
+    def _wake(self):
+        os.write(self._wake_w, b"x")
+
+    def run(self):
+        """
+        Service all the sessions until stop() is called
+        """
+        while not self.stop_loop:
+            sessions = list(self.sessions.values())
+            now = _now()
+            timeout = min([s.deadline for s in sessions] or [now + 1.0]) - now
+            # a session waiting to start again has nothing to read
+            fds = dict((s.backend.fileno(), s) for s in sessions if s.coroutine is not None)
+            readable = select.select(list(fds) + [self._wake_r], [], [], max(0.0, timeout))[0]
+            for fd in readable:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 512)
+                    continue
+                session = fds[fd]
+                try:
+                    lines = session.backend.read_lines()
+                except pexpect.EOF:
+                    self._restart(session, "gatttool exited", respawn=True)
+                    continue
+                if lines:
+                    self._advance(session, lines)
+            now = _now()
+            for session in sessions:
+                if session.deadline <= now:
+                    self._advance(session)
+
+    def _advance(self, session, lines=None):
+        """
+        Hand a session's lifecycle its lines, or None at its deadline, starting it if it is not running.
+        Whatever goes wrong with one strap only restarts that strap
+        """
+        try:
+            if session.coroutine is None:
+                if session.respawn:
+                    session.backend.respawn()
+                    session.respawn = False
+                session.coroutine = session.lifecycle()
+                session.deadline = next(session.coroutine)
+            else:
+                session.deadline = session.coroutine.send(lines)
+        except pexpect.EOF:
+            self._restart(session, "gatttool exited", respawn=True)
+        except Exception as e:
+            self._restart(session, "reader failed: %r" % e, respawn=session.respawn)
+
+    def _restart(self, session, reason, respawn=False):
+        """
+        Start the session's lifecycle again after a backoff, with a new gatttool if respawn
+        """
+        if session.coroutine is not None:
+            session.coroutine.close()
+        session.coroutine = None
+        session.respawn = respawn
+        delay = session.connection.abort()
+        session.deadline = _now() + delay
+        self._log("[%s] %s, starting again in %.1fs" % (session.device, reason, delay))
+        if not respawn:
+            try:
+                session.backend.disconnect()
+            except Exception:
+                session.respawn = True
+
+    def start(self):
+        """
+        Run the engine in one background thread
+        """
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.stop_loop = True
+        self._wake()
+        if self._thread:
+            self._thread.join(5)
+        for session in self.sessions.values():
+            try:
+                session.backend.switch_notifications(False)
+                session.backend.close()
+            except Exception:
+                pass
+
+    def _log(self, msg):
+        print(msg)
+        if self.logger:
+            self.logger.info(msg)
+
+
+if __name__ == '__main__':
+    import sys
+    engine = BLEReaderEngine()
+    for strap in sys.argv[1:]:
+        engine.add_sensor(strap)
+    engine.start()
+    try:
+        while True:
+            time.sleep(2)
+            print(", ".join("%s: %d (%s)" % (s.device, s.heartRate, s.state)
+                            for s in engine.sessions.values()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop()
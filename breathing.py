@@ -0,0 +1,108 @@
+# Pepper's breathing, following the participant.
+# Pepper's arms breathe with ALMotion's breathing animation. Instead of the
+# fixed tempo it can follow the participant:
+#   "hr"    a breath every BEATS_PER_BREATH heart beats
+#   "resp"  the breathing rate estimated from the RR-intervals (hrv.RespirationRate)
+# both at the robot's heart rate factor, i.e. slower in the asynchronous
+# condition. The light loop works out the tempo every tick but only hands it
+# on when it is at least THRESHOLD breaths a minute off what the robot was
+# last told, and never more often than every MIN_INTERVAL seconds. It goes
+# through a worker thread with a single slot mailbox (robot_fanout.RobotWorker),
+# so the loop never waits for ALMotion and a tempo the robot has not taken yet
+# is replaced by the newer one.
+from hrv import RespirationRate
+from robot_fanout import RobotWorker
+
+BREATHING_MODES = ("fixed", "hr", "resp")
+MIN_BPM = 10.0                  # range of ALMotion's breathing tempo
+MAX_BPM = 50.0
+# tempo of the "fixed" mode. Pepper used to be sent 2.0, outside the range
+# ALMotion documents for Bpm, so what it did with it was up to the robot. The
+# fixed mode now asks for the slowest tempo in the range instead
+FIXED_BPM = MIN_BPM
+AMPLITUDE = 1.0
+BEATS_PER_BREATH = 4.0
+THRESHOLD = 2.0                 # breaths per minute the tempo has to change by to be sent
+MIN_INTERVAL = 5.0              # seconds between tempo changes on the robot
+
+
+class BreathTempo(object):
+    """
+    The tempo Pepper should breathe at and when to tell it
+    """
+
+    def __init__(self, mode="hr", rate_factor=1.0, threshold=THRESHOLD, min_interval=MIN_INTERVAL):
+        """
+        @param mode: "hr" or "resp"
+        @param rate_factor: robot heart rate relative to the participant's
+        @param threshold: breaths per minute the tempo has to change by to be sent
+        @param min_interval: shortest time between two tempos sent, seconds
+        """
+        if mode not in BREATHING_MODES[1:]:
+            raise ValueError("Unknown breathing mode %r, one of %s" % (mode, ", ".join(BREATHING_MODES)))
+        self.mode = mode
+        self.rate_factor = rate_factor
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.respiration = RespirationRate() if mode == "resp" else None
+        self.target = None          # breaths per minute the participant calls for
+        self.sent = None            # breaths per minute the robot was last told
+        self.sent_at = None
+        self.updates = 0
+
+    def add_sample(self, sample):
+        """
+        Take in a new HRSample
+        """
+        if self.respiration:
+            self.respiration.add_rr(sample.rr_intervals)
+            bpm = self.respiration.breaths_per_minute()
+        else:
+            bpm = sample.heart_rate / BEATS_PER_BREATH if sample.heart_rate > 0 else None
+        if bpm is not None:
+            self.target = min(max(bpm * self.rate_factor, MIN_BPM), MAX_BPM)
+
+    def due(self, now):
+        """
+        @param now: monotonic time
+        @return: the tempo to send the robot now, or None
+        """
+        target = self.target
+        if target is None:
+            return None
+        if self.sent is not None and abs(target - self.sent) < self.threshold:
+            return None
+        if self.sent_at is not None and now - self.sent_at < self.min_interval:
+            return None
+        self.sent = target
+        self.sent_at = now
+        self.updates += 1
+        return target
+
+
+class BreathMotion(object):
+    """
+    Sets the tempo on the robot, the "robot" of the breathing worker
+    """
+
+    def __init__(self, motion, name, amplitude=AMPLITUDE):
+        """
+        @param motion: ALMotion proxy
+        """
+        self.motion = motion
+        self.name = "%s breathing" % name
+        self.amplitude = amplitude
+        self.calls = 0
+
+    def send(self, bpm):
+        self.motion.setBreathConfig([['Bpm', bpm], ['Amplitude', self.amplitude]])
+        self.calls += 1
+
+
+def breathing_worker(motion, name, logger=None, amplitude=AMPLITUDE):
+    """
+    @return: started RobotWorker that hands the tempos posted to it to ALMotion
+    """
+    worker = RobotWorker(BreathMotion(motion, name, amplitude), logger)
+    worker.start()
+    return worker
@@ -0,0 +1,127 @@
+# Stand-in for the naoqi SDK so the Pepper code can run without a robot.
+# FakeALProxy accepts any method call, optionally sleeps to simulate the network
+# round trip to the robot and counts every call with how long it blocked the
+# caller. Calls made through .post return a task id straight away like naoqi.
+#
+# To run the Pepper handler against it:
+#     import fake_naoqi
+#     fake_naoqi.install(latency=0.02)
+#     from pepper_heartbot_lights import PepperHandler
+import itertools
+import sys
+import threading
+import time
+
+from tick_scheduler import monotonic
+
+_lock = threading.Lock()
+_task_ids = itertools.count(1)
+_proxies = []
+
+
+class RPCStats(object):
+    """
+    Call count and time spent blocked for one proxy method
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return "calls: %d mean: %.2fms max: %.2fms" % (self.count, self.mean * 1000.0, self.max * 1000.0)
+
+
+class _FakePost(object):
+    """
+    proxy.post.<method>() runs asynchronously on the robot, the caller only gets a task id
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name):
+        def post_call(*args):
+            started = monotonic()
+            task_id = next(_task_ids)
+            self._proxy._record("post." + name, args, started, monotonic() - started)
+            return task_id
+        return post_call
+
+
+class FakeALProxy(object):
+
+    def __init__(self, module, ip=None, port=None, latency=None):
+        """
+        @param module: naoqi module name e.g. "ALLeds"
+        @param latency: seconds every blocking call takes, defaults to the installed latency
+        """
+        self.module = module
+        self.ip = ip
+        self.port = port
+        self.latency = default_latency if latency is None else latency
+        self.stats = {}
+        self.calls = []          # (monotonic time, method, args, probe value) of every call
+        self.probe = None        # optional callable whose value is recorded with each call
+        self.post = _FakePost(self)
+        with _lock:
+            _proxies.append(self)
+
+    def _record(self, name, args, started, duration):
+        probe = self.probe() if self.probe else None
+        with _lock:
+            self.calls.append((started, name, args, probe))
+            self.stats.setdefault(name, RPCStats()).record(duration)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args):
+            started = monotonic()
+            if self.latency:
+                time.sleep(self.latency)
+            self._record(name, args, started, monotonic() - started)
+        return call
+
+
+ALProxy = FakeALProxy
+default_latency = 0.0
+
+
+def install(latency=0.0):
+    """
+    Make "from naoqi import ALProxy" pick up the fake
+    @param latency: simulated round trip of each blocking call in seconds
+    """
+    global default_latency
+    default_latency = latency
+    sys.modules['naoqi'] = sys.modules[__name__]
+
+
+def rpc_report():
+    """
+    @return: dict of "<module>.<method>" to RPCStats over all the fake proxies
+    """
+    report = {}
+    with _lock:
+        for proxy in _proxies:
+            for name, stats in proxy.stats.items():
+                report["%s.%s" % (proxy.module, name)] = stats
+    return report
+
+
+def reset():
+    with _lock:
+        del _proxies[:]
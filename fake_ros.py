@@ -0,0 +1,85 @@
+# Stand-in for rospy and the std_msgs message the lights are published as, so
+# the Miro code can run without a ROS installation or a robot.
+# Every publish is recorded with the monotonic time it was made and a copy of
+# the message data.
+#
+# To run the Miro client against it:
+#     import fake_ros
+#     fake_ros.install()
+#     from miro_heartbot_lights import setup_heartbot
+import sys
+import threading
+import time
+import types
+
+from tick_scheduler import monotonic
+
+_lock = threading.Lock()
+publishers = []
+_shutdown = [False]
+
+
+class _Message(object):
+    def __init__(self):
+        self.data = []
+
+
+class UInt32MultiArray(_Message):
+    pass
+
+
+class Publisher(object):
+
+    def __init__(self, topic, msg_type, queue_size=None, latency=0.0):
+        self.topic = topic
+        self.msg_type = msg_type
+        self.latency = latency
+        self.published = []      # (monotonic time, copy of message data, probe value)
+        self.probe = None        # optional callable whose value is recorded with each publish
+        with _lock:
+            publishers.append(self)
+
+    def publish(self, msg):
+        stamp = monotonic()
+        if self.latency:
+            time.sleep(self.latency)
+        probe = self.probe() if self.probe else None
+        self.published.append((stamp, list(msg.data), probe))
+
+
+def init_node(name, anonymous=False, disable_signals=False):
+    pass
+
+
+def signal_shutdown(reason=None):
+    _shutdown[0] = True
+
+
+def _is_shutdown():
+    return _shutdown[0]
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install():
+    """
+    Register the fake modules so the Miro code's imports pick them up
+    """
+    _shutdown[0] = False
+    rospy = _module('rospy', Publisher=Publisher, init_node=init_node, signal_shutdown=signal_shutdown,
+                    core=_module('rospy.core', is_shutdown=_is_shutdown))
+    sys.modules.update({
+        'rospy': rospy,
+        'rospy.core': rospy.core,
+        'std_msgs': _module('std_msgs'),
+        'std_msgs.msg': _module('std_msgs.msg', UInt32MultiArray=UInt32MultiArray),
+    })
+
+
+def reset():
+    with _lock:
+        del publishers[:]
@@ -0,0 +1,181 @@
+# Shared memory heart rate bus.
+# The Miro handler needs rospy and the Pepper handler the naoqi SDK, which do
+# not sit well in one interpreter, and the strap reader is better off without
+# a light loop competing with it for the GIL. So one process reads the strap
+# and writes every notification to a ring buffer in a memory mapped file, and
+# any number of processes (a robot each, analysis, ...) map the same file and
+# read from it: no sockets, no serialisation, nothing for the writer to wait on.
+#
+# File layout, little endian:
+#   header  magic, version, slot size, capacity, head (notifications written)
+#   slots   capacity x (seq, wall clock time, monotonic time, payload length, raw 0x2A37 payload)
+#
+# Every slot is guarded by a seqlock: the writer makes the slot's seq odd,
+# writes the slot, then makes it even again (2 * (n + 1) for notification n).
+# A reader copies the slot and checks the seq before and after: if it changed
+# or is not the one expected for the notification it wanted, the writer got
+# there first and the reader has fallen a whole ring behind.
+# The monotonic clock is system wide so the receive times mean the same in
+# every process.
+#
+# The reading end is hr_sources.BusSource.
+#
+#   writer:  python polarHeartBot.py 12 robot=none publish=/dev/shm/heartbot_hr
+#   reader:  python polarHeartBot.py 12 robot=miro bus=/dev/shm/heartbot_hr
+import mmap
+import os
+import struct
+import tempfile
+
+from tick_scheduler import monotonic
+
+BUS_MAGIC = b"HBHR"
+BUS_VERSION = 1
+BUS_HEADER = struct.Struct('<4sHHI')            # magic, version, slot size, capacity
+HEAD = struct.Struct('<Q')
+HEAD_OFFSET = 16
+SLOTS_OFFSET = 64
+SEQ = struct.Struct('<Q')
+SLOT = struct.Struct('<Qdd B23s')                # seq, wall clock time, monotonic time, length, payload
+MAX_PAYLOAD = 23                                 # largest characteristic value in one notification
+CAPACITY = 256                                   # notifications, minutes worth at about one a second
+
+BUS_PATH = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "heartbot_hr")
+
+
+class BusWriter(object):
+    """
+    Single writer of a heart rate bus
+    """
+
+    def __init__(self, path=BUS_PATH, capacity=CAPACITY):
+        """
+        @param path: bus file, replaced if it exists
+        @param capacity: notifications the ring holds
+        """
+        self.path = path
+        self.capacity = capacity
+        self.head = 0
+        self.source = None
+        size = SLOTS_OFFSET + capacity * SLOT.size
+        # Build the new file next to the old one and swap it in, readers of the
+        # old one keep a valid mapping and notice the new file by its inode
+        temp = "%s.%d" % (path, os.getpid())
+        with open(temp, "wb") as f:
+            f.write(BUS_HEADER.pack(BUS_MAGIC, BUS_VERSION, SLOT.size, capacity))
+            f.write(b"\0" * (size - BUS_HEADER.size))
+        self._file = open(temp, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), size)
+        os.rename(temp, path)
+
+    def write(self, timestamp, payload, received=None):
+        """
+        Publish one notification
+        @param timestamp: wall clock time it was received
+        @param payload: raw heart rate measurement
+        @param received: monotonic time it was received, defaults to now
+        """
+        if received is None:
+            received = monotonic()
+        payload = bytes(payload[:MAX_PAYLOAD])
+        n = self.head
+        offset = SLOTS_OFFSET + (n % self.capacity) * SLOT.size
+        SEQ.pack_into(self._map, offset, 2 * n + 1)
+        SLOT.pack_into(self._map, offset, 2 * n + 1, timestamp, received, len(payload), payload)
+        SEQ.pack_into(self._map, offset, 2 * n + 2)
+        self.head = n + 1
+        HEAD.pack_into(self._map, HEAD_OFFSET, self.head)
+
+    def attach(self, source):
+        """
+        Publish every notification of a heart rate source
+        """
+        self.source = source
+        source.add_notification_listener(self.write)
+
+    def close(self):
+        if self.source is not None:
+            self.source.remove_notification_listener(self.write)
+            self.source = None
+        self._map.close()
+        self._file.close()
+
+
+class BusReader(object):
+    """
+    One reader's position on a heart rate bus
+    """
+
+    def __init__(self, path=BUS_PATH):
+        self.path = path
+        self.next = 0           # notification to read next
+        self.missed = 0         # notifications overwritten before they were read
+        self._map = None
+        self._inode = None
+        self.capacity = 0
+
+    def _open(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if stat.st_ino == self._inode:
+            return True
+        if self._map is not None:
+            # The writer was restarted
+            self._map.close()
+            self._map = None
+        with open(self.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slot_size, capacity = BUS_HEADER.unpack_from(data, 0)
+        if magic != BUS_MAGIC or slot_size != SLOT.size:
+            data.close()
+            raise ValueError("%s is not a version %d heart rate bus" % (self.path, BUS_VERSION))
+        self._map = data
+        self._inode = stat.st_ino
+        self.capacity = capacity
+        # Carry on from the current heart rate rather than what is left in the ring
+        self.next = max(HEAD.unpack_from(data, HEAD_OFFSET)[0] - 1, 0)
+        return True
+
+    def check(self):
+        """
+        Look for a new bus file, e.g. after the writer was restarted
+        @return: True if there is a bus to read
+        """
+        return self._open()
+
+    def read(self):
+        """
+        @return: list of (timestamp, received, payload) of the notifications written since the last call
+        """
+        if self._map is None and not self._open():
+            return []
+        data = self._map
+        head = HEAD.unpack_from(data, HEAD_OFFSET)[0]
+        if head - self.next > self.capacity:
+            self.missed += head - self.capacity - self.next
+            self.next = head - self.capacity
+        notifications = []
+        while self.next < head:
+            n = self.next
+            offset = SLOTS_OFFSET + (n % self.capacity) * SLOT.size
+            seq, timestamp, received, length, payload = SLOT.unpack_from(data, offset)
+            if seq != 2 * n + 2 or SEQ.unpack_from(data, offset)[0] != seq:
+                if seq < 2 * n + 2:
+                    # still being written
+                    break
+                # overwritten while we were behind, carry on from the oldest one there is
+                head = HEAD.unpack_from(data, HEAD_OFFSET)[0]
+                self.missed += max(head - self.capacity, n + 1) - n
+                self.next = max(head - self.capacity, n + 1)
+                continue
+            notifications.append((timestamp, received, payload[:length]))
+            self.next = n + 1
+        return notifications
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
@@ -0,0 +1,129 @@
+# Decoder for the Bluetooth Heart Rate Measurement characteristic (0x2A37).
+# The polarOH sends one of these with every notification. The layout is:
+#   byte 0      flags
+#                 bit 0    heart rate value format (0 = uint8, 1 = uint16)
+#                 bit 1-2  sensor contact status
+#                 bit 3    energy expended field present
+#                 bit 4    RR-interval fields present
+#   byte 1(-2)  heart rate in beats per minute
+#   (2 bytes)   energy expended in kilo Joules, if flagged
+#   (2 bytes)*  RR-intervals in 1/1024 seconds, as many as fit, if flagged
+# All multi-byte fields are little endian.
+import struct
+from collections import namedtuple
+
+HR_FORMAT_UINT16 = 0x01
+SENSOR_CONTACT_SUPPORTED = 0x04
+SENSOR_CONTACT_DETECTED = 0x02
+ENERGY_EXPENDED_PRESENT = 0x08
+RR_INTERVAL_PRESENT = 0x10
+
+RR_RESOLUTION = 1024.0          # RR-intervals are sent in 1/1024 of a second
+
+_UINT8 = struct.Struct('<B')
+_UINT16 = struct.Struct('<H')
+_RR_STRUCTS = {}
+
+
+class HRMeasurement(namedtuple('HRMeasurement', ['heart_rate', 'contact', 'energy', 'rr_intervals'])):
+    """
+    One decoded heart rate measurement
+    @param heart_rate: beats per minute
+    @param contact: True/False if the sensor reports skin contact, None if it does not support it
+    @param energy: energy expended in kJ or None if it was not sent
+    @param rr_intervals: tuple of RR-intervals in milliseconds (may be empty)
+    """
+    __slots__ = ()
+
+
+def _rr_struct(count):
+    """
+    Cached struct for unpacking count RR-intervals in one go
+    """
+    rr_struct = _RR_STRUCTS.get(count)
+    if rr_struct is None:
+        rr_struct = _RR_STRUCTS[count] = struct.Struct('<%dH' % count)
+    return rr_struct
+
+
+def decode_hr_measurement(data):
+    """
+    Decode a heart rate measurement notification payload
+    @param data: bytes, bytearray or memoryview holding the raw characteristic value
+    @return: HRMeasurement
+    @raise ValueError: if the payload is shorter than its flags say
+    """
+    size = len(data)
+    if size < 2:
+        raise ValueError("Heart rate measurement too short: %d bytes" % size)
+    flags = _UINT8.unpack_from(data, 0)[0]
+    if flags & HR_FORMAT_UINT16:
+        if size < 3:
+            raise ValueError("Heart rate measurement truncated: %d bytes for a 16 bit heart rate" % size)
+        heart_rate = _UINT16.unpack_from(data, 1)[0]
+        offset = 3
+    else:
+        heart_rate = _UINT8.unpack_from(data, 1)[0]
+        offset = 2
+
+    contact = None
+    if flags & SENSOR_CONTACT_SUPPORTED:
+        contact = bool(flags & SENSOR_CONTACT_DETECTED)
+
+    energy = None
+    if flags & ENERGY_EXPENDED_PRESENT:
+        if size < offset + 2:
+            raise ValueError("Heart rate measurement truncated: %d bytes, no room for the energy expended" % size)
+        energy = _UINT16.unpack_from(data, offset)[0]
+        offset += 2
+
+    rr_intervals = ()
+    if flags & RR_INTERVAL_PRESENT:
+        count = (size - offset) // 2
+        if count:
+            rr_intervals = tuple(rr * 1000.0 / RR_RESOLUTION
+                                 for rr in _rr_struct(count).unpack_from(data, offset))
+    return HRMeasurement(heart_rate, contact, energy, rr_intervals)
+
+
+def gatt_value_to_bytes(value):
+    """
+    gatttool prints characteristic values as space separated hex pairs e.g. "16 4b 1e 03 ".
+    Turn that into the raw payload in one go
+    @param value: the hex text after "value: " (str or bytes)
+    @return: bytearray with the raw value
+    @raise ValueError: if the value is not hex
+    """
+    if not isinstance(value, str):
+        value = value.decode('ascii')
+    return bytearray.fromhex(value)
+
+
+def encode_hr_measurement(heart_rate, rr_intervals=(), energy=None, contact=None):
+    """
+    Build a heart rate measurement payload, the reverse of decode_hr_measurement.
+    Used by the synthetic sources to produce what a strap would send
+    @param heart_rate: beats per minute
+    @param rr_intervals: RR-intervals in milliseconds
+    @param energy: energy expended in kJ or None
+    @param contact: True/False for sensor contact or None if not supported
+    @return: bytearray payload
+    """
+    flags = 0
+    payload = bytearray()
+    heart_rate = int(round(heart_rate))
+    if heart_rate > 0xFF:
+        flags |= HR_FORMAT_UINT16
+        payload += _UINT16.pack(heart_rate)
+    else:
+        payload += _UINT8.pack(heart_rate)
+    if contact is not None:
+        flags |= SENSOR_CONTACT_SUPPORTED | (SENSOR_CONTACT_DETECTED if contact else 0)
+    if energy is not None:
+        flags |= ENERGY_EXPENDED_PRESENT
+        payload += _UINT16.pack(energy)
+    if rr_intervals:
+        flags |= RR_INTERVAL_PRESENT
+        rr = [int(round(interval * RR_RESOLUTION / 1000.0)) for interval in rr_intervals]
+        payload += _rr_struct(len(rr)).pack(*rr)
+    return bytearray(_UINT8.pack(flags)) + payload
@@ -0,0 +1,448 @@
+# Heart rate sources the robots can be driven from.
+# Every source publishes its measurements as sequence numbered HRSamples that
+# the robot handlers subscribe to, so they only do work when a new heart rate
+# arrives. HeartBeat_BLE reads from the polarOH, the sources here let a whole
+# session run without a strap:
+#   NotificationRecorder  captures the raw notifications of any source to a file
+#   ReplaySource          plays such a file back in real time or faster
+#   SyntheticSource       generates a plausible heart beat with some variability
+#   FileHeartRateSource   reads a rate written to a text file (heartRate.txt)
+#   BusSource             reads the notifications another process publishes (see hr_bus.py)
+import math
+import os
+import random
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from hr_bus import BUS_PATH, BusReader
+from hr_measurement import HRMeasurement, decode_hr_measurement, encode_hr_measurement
+from tick_scheduler import monotonic
+
+HR_FILE = "./heartRate.txt"
+
+# Recording file: header then one record per notification,
+# record = wall clock time stamp, payload length, payload
+RECORDING_MAGIC = b"HBRR"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct('<4sH')
+RECORDING_ENTRY = struct.Struct('<dB')
+
+
+class HRSample(namedtuple('HRSample', ['seq', 'timestamp', 'heart_rate', 'rr_intervals', 'measurement'])):
+    """
+    Immutable snapshot of one heart rate measurement as published by a source
+    @param seq: sequence number, increases by one with every sample of a source
+    @param timestamp: monotonic time the sample was received
+    @param heart_rate: beats per minute
+    @param rr_intervals: RR-intervals in ms sent with it
+    @param measurement: the full HRMeasurement
+    """
+    __slots__ = ()
+
+    def age(self, now=None):
+        """
+        @return: seconds since the sample was received
+        """
+        return (monotonic() if now is None else now) - self.timestamp
+
+
+class SampleSubscription(object):
+    """
+    A reader's view of the samples of a source. Reading the latest sample is a
+    single attribute read of an immutable tuple so it never sees a half updated
+    value, and there is nothing to do until the sequence number moves
+    """
+
+    def __init__(self, source):
+        self.source = source
+        # Start at 0 so the first poll hands over what the source already has
+        self.last_seq = 0
+
+    def poll(self):
+        """
+        @return: the newest sample if there has been one since the last call, else None
+        """
+        sample = self.source.latest
+        if sample is None or sample.seq == self.last_seq:
+            return None
+        self.last_seq = sample.seq
+        return sample
+
+    def wait(self, timeout=None):
+        """
+        Block until there is a new sample
+        @return: the new sample or None on timeout
+        """
+        condition = self.source.sample_condition
+        with condition:
+            sample = self.poll()
+            if sample is None:
+                condition.wait(timeout)
+                sample = self.poll()
+        return sample
+
+
+class HeartRateSource(object):
+    """
+    Base of everything that produces heart rate measurements.
+    Keeps heartRate, rrIntervals and measurement like HeartBeat_BLE always has,
+    publishes every measurement as a sequence numbered HRSample to subscribers
+    and passes every raw notification payload on to the registered listeners
+    """
+
+    def __init__(self):
+        self.heartRate = 60      # Last measured heart rate (bpm)
+        self.rrIntervals = ()    # RR-intervals (ms) of the last measurement
+        self.measurement = None  # Last decoded measurement
+        self.notification_listeners = []
+        self.sample_listeners = []
+        self.sample_condition = threading.Condition()
+        self._latest = None
+        self._seq = 0
+
+    @property
+    def latest(self):
+        """
+        The last published HRSample or None
+        """
+        return self._latest
+
+    def subscribe(self):
+        """
+        @return: a SampleSubscription to poll or wait on for new samples
+        """
+        return SampleSubscription(self)
+
+    def add_sample_listener(self, listener):
+        """
+        @param listener: callable(sample) called from the source's thread for every new HRSample
+        """
+        self.sample_listeners.append(listener)
+
+    def remove_sample_listener(self, listener):
+        self.sample_listeners.remove(listener)
+
+    def add_notification_listener(self, listener):
+        """
+        @param listener: callable(timestamp, payload) called for every raw notification
+        """
+        self.notification_listeners.append(listener)
+
+    def remove_notification_listener(self, listener):
+        self.notification_listeners.remove(listener)
+
+    def handle_notification(self, payload, timestamp=None, received=None):
+        """
+        Decode a raw heart rate measurement and update the source with it
+        @param payload: raw 0x2A37 value
+        @param timestamp: wall clock time it was received, defaults to now
+        @param received: monotonic time it was received, defaults to now
+        @return: the decoded HRMeasurement
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        measurement = decode_hr_measurement(payload)
+        self.publish_measurement(measurement, received)
+        for listener in self.notification_listeners:
+            listener(timestamp, payload)
+        return measurement
+
+    def handle_notifications(self, payloads, timestamp=None, received=None):
+        """
+        Decode raw heart rate measurements that came in together, e.g. after
+        the reader was held up. Every one goes to the notification listeners,
+        the subscribers get a single sample: the newest heart rate with the
+        RR-intervals of all of them, so no beat is lost
+        @param payloads: raw 0x2A37 values, oldest first
+        @return: list of the decoded HRMeasurements
+        """
+        if len(payloads) == 1:
+            return [self.handle_notification(payloads[0], timestamp, received)]
+        if timestamp is None:
+            timestamp = time.time()
+        measurements = [decode_hr_measurement(payload) for payload in payloads]
+        rr_intervals = tuple(rr for measurement in measurements for rr in measurement.rr_intervals)
+        self.publish_measurement(measurements[-1]._replace(rr_intervals=rr_intervals), received)
+        for listener in self.notification_listeners:
+            for payload in payloads:
+                listener(timestamp, payload)
+        return measurements
+
+    def publish_measurement(self, measurement, received=None):
+        """
+        Update the source with a decoded measurement and hand it to the subscribers
+        @param received: monotonic time the measurement was received, defaults to now
+        @return: the published HRSample
+        """
+        self.measurement = measurement
+        self.rrIntervals = measurement.rr_intervals
+        self.heartRate = measurement.heart_rate
+        self._seq += 1
+        if received is None:
+            received = monotonic()
+        sample = HRSample(self._seq, received, measurement.heart_rate, measurement.rr_intervals, measurement)
+        self._latest = sample
+        with self.sample_condition:
+            self.sample_condition.notify_all()
+        for listener in self.sample_listeners:
+            listener(sample)
+        return sample
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class _ThreadedSource(HeartRateSource):
+    """
+    Source that produces its measurements from a daemon thread
+    """
+
+    def __init__(self):
+        super(_ThreadedSource, self).__init__()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def run(self):
+        """
+        Produce the measurements, in the source's own thread, until the stop event is set.
+        Every threaded source implements it
+        """
+        raise NotImplementedError("%s does not implement run()" % self.__class__.__name__)
+
+
+class NotificationRecorder(object):
+    """
+    Writes the raw notification stream of a source to a compact binary file
+    """
+
+    def __init__(self, source, path):
+        """
+        @param source: HeartRateSource to record
+        @param path: recording file to write
+        """
+        self.source = source
+        self.path = path
+        self.count = 0
+        self._file = open(path, "wb")
+        self._file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION))
+        source.add_notification_listener(self.record)
+
+    def record(self, timestamp, payload):
+        self._file.write(RECORDING_ENTRY.pack(timestamp, len(payload)))
+        self._file.write(bytes(payload))
+        self.count += 1
+
+    def close(self):
+        self.source.remove_notification_listener(self.record)
+        self._file.close()
+
+
+def read_recording(path):
+    """
+    @return: list of (timestamp, payload) from a NotificationRecorder file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version = RECORDING_HEADER.unpack_from(data, 0)
+    if magic != RECORDING_MAGIC:
+        raise ValueError("%s is not a heart rate recording" % path)
+    entries = []
+    offset = RECORDING_HEADER.size
+    while offset + RECORDING_ENTRY.size <= len(data):
+        timestamp, size = RECORDING_ENTRY.unpack_from(data, offset)
+        offset += RECORDING_ENTRY.size
+        entries.append((timestamp, bytearray(data[offset:offset + size])))
+        offset += size
+    return entries
+
+
+class ReplaySource(_ThreadedSource):
+    """
+    Plays back a NotificationRecorder file
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+        """
+        @param path: recording to play
+        @param speed: 1 for real time, N for N times faster, 0 for as fast as possible
+        @param loop: start again from the beginning when the recording ends
+        """
+        super(ReplaySource, self).__init__()
+        self.entries = read_recording(path)
+        self.speed = speed
+        self.loop = loop
+        self.finished = threading.Event()
+
+    def run(self):
+        while True:
+            if self.entries:
+                first = self.entries[0][0]
+                started = monotonic()
+                for timestamp, payload in self.entries:
+                    if self.speed > 0:
+                        delay = started + (timestamp - first) / self.speed - monotonic()
+                        if delay > 0 and self._stop_event.wait(delay):
+                            return
+                    elif self._stop_event.is_set():
+                        return
+                    self.handle_notification(payload)
+            if not self.loop or not self.entries:
+                break
+        self.finished.set()
+
+
+class SyntheticSource(_ThreadedSource):
+    """
+    Generates beats around a mean heart rate with respiratory sinus arrhythmia
+    and some noise, and sends them like the polarOH does, i.e. about once a
+    second with the RR-intervals of the beats since the last notification
+    """
+
+    def __init__(self, mean_hr=70.0, rsa_amplitude=4.0, breathing_rate=0.25, noise=15.0,
+                 interval=1.0, speed=1.0, seed=None):
+        """
+        @param mean_hr: average heart rate in bpm
+        @param rsa_amplitude: swing of the heart rate with breathing in bpm
+        @param breathing_rate: breaths per second
+        @param noise: standard deviation of the beat to beat noise in ms
+        @param interval: seconds between notifications
+        @param speed: 1 for real time, N for N times faster
+        @param seed: random seed for reproducible sessions
+        """
+        super(SyntheticSource, self).__init__()
+        self.mean_hr = mean_hr
+        self.rsa_amplitude = rsa_amplitude
+        self.breathing_rate = breathing_rate
+        self.noise = noise
+        self.interval = interval
+        self.speed = speed
+        self.random = random.Random(seed)
+        self.beat_time = 0.0
+
+    def next_rr(self):
+        """
+        @return: the next RR-interval in ms
+        """
+        hr = self.mean_hr + self.rsa_amplitude * math.sin(2 * math.pi * self.breathing_rate * self.beat_time)
+        rr = 60000.0 / hr + self.random.gauss(0.0, self.noise)
+        self.beat_time += rr / 1000.0
+        return rr
+
+    def run(self):
+        # The strap notifies on a clock of its own, not on the beats
+        next_notification = self.interval
+        pending = []
+        rr = self.next_rr()
+        started = monotonic()
+        hr = self.mean_hr
+        while True:
+            while self.beat_time <= next_notification:
+                pending.append(rr)
+                rr = self.next_rr()
+            delay = started + next_notification / self.speed - monotonic()
+            if delay > 0 and self._stop_event.wait(delay):
+                return
+            if self._stop_event.is_set():
+                return
+            if pending:
+                hr = 60000.0 * len(pending) / sum(pending)
+            self.handle_notification(encode_hr_measurement(hr, pending))
+            pending = []
+            next_notification += self.interval
+
+
+class FileHeartRateSource(HeartRateSource):
+    """
+    Heart rate written to a text file, first line being the bpm.
+    The file is only stat'ed every check_interval seconds and only read again
+    when its modification time changes
+    """
+
+    def __init__(self, path=HR_FILE, check_interval=0.5):
+        self.path = path
+        self.check_interval = check_interval
+        self._heart_rate = 60
+        self._mtime = None
+        self._next_check = 0.0
+        super(FileHeartRateSource, self).__init__()
+
+    def _check(self):
+        now = monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._reload()
+
+    @property
+    def heartRate(self):
+        self._check()
+        return self._heart_rate
+
+    @heartRate.setter
+    def heartRate(self, value):
+        self._heart_rate = value
+
+    @property
+    def latest(self):
+        self._check()
+        return self._latest
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        with open(self.path) as f:
+            try:
+                heart_rate = int(f.readline())
+            except ValueError:
+                # Half written file, try again next time it changes
+                self._mtime = None
+                return
+        self.publish_measurement(HRMeasurement(heart_rate, None, None, ()))
+
+
+class BusSource(_ThreadedSource):
+    """
+    Heart rate source reading the notifications another process writes to a bus
+    """
+
+    def __init__(self, path=BUS_PATH, poll_interval=0.01, check_interval=1.0):
+        """
+        @param path: bus file
+        @param poll_interval: seconds between looking for new notifications
+        @param check_interval: seconds between looking for a restarted writer
+        """
+        super(BusSource, self).__init__()
+        self.reader = BusReader(path)
+        self.poll_interval = poll_interval
+        self.check_interval = check_interval
+
+    def run(self):
+        next_check = 0.0
+        while not self._stop_event.wait(self.poll_interval):
+            now = monotonic()
+            if now >= next_check:
+                next_check = now + self.check_interval
+                self.reader.check()
+            for timestamp, received, payload in self.reader.read():
+                self.handle_notification(bytearray(payload), timestamp, received)
+        self.reader.close()
@@ -0,0 +1,219 @@
+# Streaming heart rate variability from the RR-intervals the polarOH sends.
+# Each window keeps running sums over the beats inside it, so adding a beat
+# and dropping the ones that fell out of the window is O(1) (amortised) and
+# memory only depends on the window length. The session wide figures keep
+# the sums without any buffer at all, so they cost constant memory however
+# long the session runs.
+#   RMSSD  root mean square of successive RR differences (ms)
+#   SDNN   standard deviation of the RR-intervals (ms)
+#   pNN50  percentage of successive differences larger than 50ms
+# RespirationRate estimates how fast the participant breathes from the same
+# RR-intervals (respiratory sinus arrhythmia).
+import math
+import threading
+from collections import deque
+
+MIN_RR = 300.0      # ms, anything shorter or longer than these is treated as an artefact
+MAX_RR = 2000.0
+NN50 = 50.0
+BREATH_WINDOW = 30.0        # seconds of beats the breathing rate is estimated over
+BREATH_SMOOTHING = 2        # beats averaged to take out the beat to beat noise
+BREATH_HYSTERESIS = 0.25    # of the standard deviation the RR-intervals must swing past their mean
+MIN_BREATHING = 4.0         # breaths per minute, slower or faster estimates are not trusted
+MAX_BREATHING = 40.0
+
+
+class RollingHRV(object):
+    """
+    HRV over the last window seconds of beats (or the whole session if window is None)
+    """
+
+    def __init__(self, window=None):
+        """
+        @param window: length of the window in seconds, None to never forget
+        """
+        self.window = window
+        self.beats = deque() if window else None     # (beat time, rr) in the window
+        self.diffs = deque() if window else None     # successive differences, diffs[i] ends at beats[i + 1]
+        self.beat_time = 0.0                          # seconds of RR-intervals seen so far
+        self.last_rr = None
+        self.count = 0
+        self.sum_rr = 0.0
+        self.sum_rr2 = 0.0
+        self.diff_count = 0
+        self.sum_diff2 = 0.0
+        self.nn50 = 0
+
+    def add(self, rr):
+        """
+        Add one RR-interval in ms
+        """
+        self.beat_time += rr / 1000.0
+        if self.last_rr is not None:
+            diff = rr - self.last_rr
+            self.diff_count += 1
+            self.sum_diff2 += diff * diff
+            if abs(diff) > NN50:
+                self.nn50 += 1
+            if self.diffs is not None:
+                self.diffs.append(diff)
+        self.last_rr = rr
+        self.count += 1
+        self.sum_rr += rr
+        self.sum_rr2 += rr * rr
+        if self.beats is not None:
+            self.beats.append((self.beat_time, rr))
+            self._expire()
+
+    def _expire(self):
+        oldest = self.beat_time - self.window
+        beats = self.beats
+        while beats and beats[0][0] <= oldest:
+            _, rr = beats.popleft()
+            self.count -= 1
+            self.sum_rr -= rr
+            self.sum_rr2 -= rr * rr
+            if self.diffs:
+                diff = self.diffs.popleft()
+                self.diff_count -= 1
+                self.sum_diff2 -= diff * diff
+                if abs(diff) > NN50:
+                    self.nn50 -= 1
+        if not beats:
+            # Start the sums again from exactly zero so rounding errors do not build up
+            self.count = 0
+            self.sum_rr = self.sum_rr2 = self.sum_diff2 = 0.0
+            self.diff_count = self.nn50 = 0
+
+    def metrics(self):
+        """
+        @return: dict with beats, mean_rr, mean_hr, sdnn, rmssd and pnn50 (None if not enough beats)
+        """
+        result = {"beats": self.count, "mean_rr": None, "mean_hr": None,
+                  "sdnn": None, "rmssd": None, "pnn50": None}
+        if self.count:
+            mean_rr = self.sum_rr / self.count
+            result["mean_rr"] = mean_rr
+            result["mean_hr"] = 60000.0 / mean_rr
+        if self.count > 1:
+            variance = (self.sum_rr2 - self.count * result["mean_rr"] ** 2) / (self.count - 1)
+            result["sdnn"] = math.sqrt(max(variance, 0.0))
+        if self.diff_count:
+            result["rmssd"] = math.sqrt(max(self.sum_diff2, 0.0) / self.diff_count)
+            result["pnn50"] = 100.0 * self.nn50 / self.diff_count
+        return result
+
+
+class HRVMonitor(object):
+    """
+    Live HRV of one participant, fed by the samples of a heart rate source
+    """
+
+    def __init__(self, source=None, windows=(30, 300), participant=None):
+        """
+        @param source: HeartRateSource to attach to, or None to feed add_rr yourself
+        @param windows: window lengths in seconds
+        @param participant: participant number, reported with the summary
+        """
+        self.participant = participant
+        self.windows = dict((window, RollingHRV(window)) for window in windows)
+        self.session = RollingHRV()
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self.source = source
+        if source is not None:
+            source.add_sample_listener(self.on_sample)
+
+    def on_sample(self, sample):
+        self.add_rr(sample.rr_intervals)
+
+    def add_rr(self, rr_intervals):
+        """
+        @param rr_intervals: RR-intervals in ms
+        """
+        with self._lock:
+            for rr in rr_intervals:
+                if rr < MIN_RR or rr > MAX_RR:
+                    self.rejected += 1
+                    continue
+                self.session.add(rr)
+                for window in self.windows.values():
+                    window.add(rr)
+
+    def metrics(self):
+        """
+        @return: dict of window length to the metrics over that window
+        """
+        with self._lock:
+            return dict((length, window.metrics()) for length, window in self.windows.items())
+
+    def summary(self):
+        """
+        @return: metrics over the whole session
+        """
+        with self._lock:
+            result = self.session.metrics()
+        result["participant"] = self.participant
+        result["duration"] = self.session.beat_time
+        result["rejected"] = self.rejected
+        return result
+
+    def detach(self):
+        if self.source is not None:
+            self.source.remove_sample_listener(self.on_sample)
+            self.source = None
+
+
+class RespirationRate(object):
+    """
+    Breathing rate from respiratory sinus arrhythmia: the heart speeds up
+    breathing in and slows down breathing out, so the RR-intervals, smoothed
+    over a few beats, rise through their mean once a breath
+    """
+
+    def __init__(self, window=BREATH_WINDOW):
+        """
+        @param window: seconds of beats to estimate over
+        """
+        self.window = window
+        self.beats = deque()        # (beat time, rr) in the window
+        self.beat_time = 0.0
+
+    def add_rr(self, rr_intervals):
+        """
+        @param rr_intervals: RR-intervals in ms
+        """
+        for rr in rr_intervals:
+            if MIN_RR <= rr <= MAX_RR:
+                self.beat_time += rr / 1000.0
+                self.beats.append((self.beat_time, rr))
+        oldest = self.beat_time - self.window
+        while self.beats and self.beats[0][0] <= oldest:
+            self.beats.popleft()
+
+    def breaths_per_minute(self):
+        """
+        @return: breathing rate, None until half the window is filled or if no breathing shows in the beats
+        """
+        beats = list(self.beats)
+        if len(beats) < 4 * BREATH_SMOOTHING or beats[-1][0] - beats[0][0] < self.window / 2.0:
+            return None
+        half = BREATH_SMOOTHING // 2
+        smoothed = [(beats[i + half][0], sum(rr for _, rr in beats[i:i + BREATH_SMOOTHING]) / BREATH_SMOOTHING)
+                    for i in range(len(beats) - BREATH_SMOOTHING + 1)]
+        mean = sum(rr for _, rr in smoothed) / len(smoothed)
+        band = BREATH_HYSTERESIS * math.sqrt(sum((rr - mean) ** 2 for _, rr in smoothed) / len(smoothed))
+        if band <= 0.0:
+            return None
+        rises = []
+        low = False
+        for beat_time, rr in smoothed:
+            if rr < mean - band:
+                low = True
+            elif low and rr > mean + band:
+                rises.append(beat_time)
+                low = False
+        if len(rises) < 3:
+            return None
+        rate = 60.0 * (len(rises) - 1) / (rises[-1] - rises[0])
+        return rate if MIN_BREATHING <= rate <= MAX_BREATHING else None
@@ -0,0 +1,256 @@
+# Where the time goes in a session.
+# The strap reader, the light loops and the robot handlers time their stages
+# (waiting for gatttool, parsing, updating the heart rate, the phase maths,
+# the ROS publish or naoqi call, how late the loop wakes up) into per stage
+# histograms. Instrumentation is off unless enabled before the session is set
+# up; then every stage is a shared no-op object and costs a method call.
+#
+# While a session runs the figures can be read from a Unix socket, one JSON
+# snapshot per connection:
+#
+#   python instrumentation.py [/tmp/heartbot_metrics.sock]
+#
+# and a summary is logged every so often, see MetricsReporter.
+import bisect
+import json
+import os
+import socket
+import sys
+import threading
+
+from tick_scheduler import monotonic as _now
+
+SOCKET_PATH = "/tmp/heartbot_metrics.sock"
+REPORT_INTERVAL = 60.0          # seconds between logged summaries
+# Histogram bucket upper bounds, doubling from 1us to about 17s
+BUCKETS = [1e-6 * 2 ** i for i in range(25)]
+
+
+class Stage(object):
+    """
+    Count and latency histogram of one stage. Only the thread running the stage adds to it
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def begin(self):
+        """
+        @return: start time to hand to end()
+        """
+        return _now()
+
+    def end(self, started):
+        """
+        Add the time since begin()
+        @return: the current time
+        """
+        now = _now()
+        self.add(now - started)
+        return now
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def percentile(self, q):
+        """
+        @param q: 0-100
+        @return: upper bound of the bucket the percentile falls in, in seconds
+        """
+        buckets = list(self.buckets)
+        count = sum(buckets)
+        if not count:
+            return 0.0
+        rank = q / 100.0 * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        count = self.count
+        return {
+            "count": count,
+            "mean_s": self.total / count if count else 0.0,
+            "p50_s": self.percentile(50),
+            "p95_s": self.percentile(95),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+            "buckets": list(self.buckets),
+        }
+
+    def __str__(self):
+        snapshot = self.snapshot()
+        return ("%s: %d mean: %.3fms p50: <%.3fms p95: <%.3fms p99: <%.3fms max: %.3fms"
+                % (self.name, snapshot["count"], snapshot["mean_s"] * 1000.0, snapshot["p50_s"] * 1000.0,
+                   snapshot["p95_s"] * 1000.0, snapshot["p99_s"] * 1000.0, snapshot["max_s"] * 1000.0))
+
+
+class _NullStage(object):
+    """
+    Stands in for every stage while instrumentation is off
+    """
+    name = None
+
+    def begin(self):
+        return 0.0
+
+    def end(self, started):
+        return 0.0
+
+    def add(self, seconds):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+class Metrics(object):
+    """
+    The stages of a session by name
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = _now()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """
+        Start timing the stages created from now on
+        """
+        self.enabled = True
+        self.started = _now()
+
+    def stage(self, name):
+        """
+        @return: the Stage of that name, or a no-op stand in if instrumentation is off
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            return stage
+
+    def snapshot(self):
+        """
+        @return: dict of the figures of every stage
+        """
+        with self._lock:
+            stages = list(self.stages.values())
+        return {"uptime_s": _now() - self.started,
+                "stages": dict((stage.name, stage.snapshot()) for stage in stages)}
+
+    def summary(self):
+        with self._lock:
+            stages = sorted(self.stages.values(), key=lambda stage: stage.name)
+        return "\n".join(str(stage) for stage in stages)
+
+
+# The stages of this process
+METRICS = Metrics()
+
+
+class MetricsServer(threading.Thread):
+    """
+    Hands a JSON snapshot of the metrics to whoever connects to the Unix socket, read only
+    """
+
+    def __init__(self, metrics=METRICS, path=SOCKET_PATH):
+        super(MetricsServer, self).__init__(name="metrics-server")
+        self.daemon = True
+        self.metrics = metrics
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(4)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error:
+                break
+            try:
+                connection.sendall(json.dumps(self.metrics.snapshot(), sort_keys=True).encode("ascii"))
+            except socket.error:
+                pass
+            finally:
+                connection.close()
+
+    def stop(self):
+        self._stop_event.set()
+        try:
+            # wake up accept()
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MetricsReporter(threading.Thread):
+    """
+    Logs the summary of the metrics every interval seconds
+    """
+
+    def __init__(self, logger, metrics=METRICS, interval=REPORT_INTERVAL):
+        super(MetricsReporter, self).__init__(name="metrics-reporter")
+        self.daemon = True
+        self.logger = logger
+        self.metrics = metrics
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        self.logger.info("Stage timing after %.0fs:\n%s" % (_now() - self.metrics.started, self.metrics.summary()))
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def read_metrics(path=SOCKET_PATH):
+    """
+    @return: the snapshot served by a running session
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    chunks = []
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    client.close()
+    return json.loads(b"".join(chunks).decode("ascii"))
+
+
+if __name__ == "__main__":
+    snapshot = read_metrics(sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH)
+    print("uptime: %.0fs" % snapshot["uptime_s"])
+    for name in sorted(snapshot["stages"]):
+        stage = snapshot["stages"][name]
+        print("%-32s %8d mean %8.3fms p50 <%8.3fms p95 <%8.3fms p99 <%8.3fms max %8.3fms"
+              % (name, stage["count"], stage["mean_s"] * 1000.0, stage["p50_s"] * 1000.0, stage["p95_s"] * 1000.0,
+                 stage["p99_s"] * 1000.0, stage["max_s"] * 1000.0))
@@ -0,0 +1,340 @@
+# Run the sessions of a whole room from one terminal.
+# Every session (a participant's strap and their robots) is a polarHeartBot
+# process of its own, pinned to a core (where Python has sched_setaffinity),
+# with its stdout in its log directory.
+# The supervisor keeps an eye on each of them:
+#   - the process is running, if it exits it is started again after a backoff
+#   - the strap: every session publishes its heart rate on a bus of its own
+#     (hr_bus.py), so the supervisor sees the heart rate and how long ago the
+#     last notification came. The reader reconnects by itself, the session is
+#     only restarted when the strap has been silent for RESTART_SILENCE
+#   - the light loop: the session serves its stage timing (instrumentation.py)
+#     and is restarted if the loop stops ticking
+# and shows the state of all of them in one table.
+#
+# The lab file (JSON) lists the sessions, anything but "participant" can be left out:
+# {
+#     "sessions": [
+#         {"participant": 12, "strap": "A0:9E:1A:25:71:5C", "robot": "pepper@192.168.1.193",
+#          "async": false, "beat": true, "core": 2},
+#         {"participant": 13, "strap": "A0:9E:1A:25:80:11", "session": "room2.json", "python": "python2"},
+#         {"participant": 14, "args": ["synthetic"], "robot": "none"}
+#     ]
+# }
+#
+#   python lab_supervisor.py lab.json
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from ble_connection import Backoff
+from hr_bus import BUS_PATH, BusReader
+from hr_measurement import decode_hr_measurement
+from instrumentation import read_metrics
+from tick_scheduler import monotonic
+
+SESSION_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "polarHeartBot.py")
+LOG_ROOT = os.path.join(".", "Logs")
+CHECK_INTERVAL = 1.0            # seconds between health checks
+STATUS_INTERVAL = 2.0           # seconds between status tables
+STARTUP_GRACE = 90.0            # seconds a session gets to connect before it is held to the checks
+STRAP_SILENCE = 10.0            # seconds without a notification before the strap counts as silent
+RESTART_SILENCE = 120.0         # seconds without a notification before the session is restarted
+LOOP_STALL = 10.0               # seconds the light loop may go without a tick
+STOP_TIMEOUT = 10.0             # seconds a session gets to shut down before it is killed
+
+STARTING = "starting"
+RUNNING = "running"
+SILENT = "strap silent"
+WAITING = "restarting"
+STOPPED = "stopped"
+
+
+def load_lab(path):
+    """
+    @return: the lab configuration in the file
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def _cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    import multiprocessing
+    return list(range(multiprocessing.cpu_count()))
+
+
+class SupervisedSession(object):
+    """
+    One participant's polarHeartBot process and its health
+    """
+
+    def __init__(self, config, core=None, log_root=LOG_ROOT, logger=None):
+        """
+        @param config: session entry of the lab file
+        @param core: cpu to pin the process to, None to leave it to the scheduler
+        """
+        self.config = config
+        self.participant = int(config["participant"])
+        self.core = config.get("core", core)
+        self.log_path = os.path.join(log_root, "P%d" % self.participant)
+        self.logger = logger
+        self.bus_path = os.path.join(os.path.dirname(BUS_PATH), "heartbot_hr_P%d" % self.participant)
+        self.metrics_path = os.path.join("/tmp", "heartbot_P%d.sock" % self.participant)
+        self.process = None
+        self.state = STOPPED
+        self.restarts = 0
+        self.reason = None          # why it was last restarted
+        self.backoff = Backoff(initial=1.0)
+        self.started = None
+        self.restart_at = None
+        self.bus = BusReader(self.bus_path)
+        self.heart_rate = None
+        self.last_notification = None
+        self.ticks = None
+        self.last_tick = None
+        self._output = None
+
+    def command(self):
+        """
+        @return: the polarHeartBot command line of the session
+        """
+        config = self.config
+        argv = [config.get("python", sys.executable), SESSION_SCRIPT, str(self.participant)]
+        if config.get("async"):
+            argv.append("async")
+        if config.get("beat"):
+            argv.append("beat")
+        if config.get("strap"):
+            argv.append("strap=%s" % config["strap"])
+        if config.get("robot"):
+            argv.append("robot=%s" % config["robot"])
+        if config.get("session"):
+            argv.append("session=%s" % config["session"])
+        argv.extend(config.get("args", []))
+        argv.append("publish=%s" % self.bus_path)
+        argv.append("metrics=%s" % self.metrics_path)
+        return argv
+
+    def _pin(self):
+        # runs in the child between fork and exec
+        if self.core is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, [self.core])
+
+    def start(self):
+        if not os.path.isdir(self.log_path):
+            os.makedirs(self.log_path)
+        self._output = open(os.path.join(self.log_path, "supervised_output.txt"), "a")
+        self._output.write("---- %s start %d\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), self.restarts))
+        self._output.flush()
+        self.process = subprocess.Popen(self.command(), stdout=self._output, stderr=subprocess.STDOUT,
+                                        preexec_fn=self._pin)
+        self.started = monotonic()
+        self.state = STARTING
+        self.restart_at = None
+        self.heart_rate = None
+        self.last_notification = None
+        self.ticks = None
+        self.last_tick = None
+        self._log("started, pid %d core %s" % (self.process.pid, self.core))
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.info("P%d %s" % (self.participant, msg))
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Let the session shut down like on Ctrl-C, kill it if it does not
+        """
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            deadline = monotonic() + timeout
+            while process.poll() is None and monotonic() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if self._output:
+            self._output.close()
+            self._output = None
+        self.process = None
+
+    def restart(self, reason):
+        """
+        Stop the session and start it again after the backoff
+        """
+        self.reason = reason
+        self._log("restarting: %s" % reason)
+        self.stop()
+        self.restarts += 1
+        self.state = WAITING
+        self.restart_at = monotonic() + self.backoff.next()
+
+    def _read_bus(self):
+        for _, received, payload in self.bus.read():
+            self.last_notification = received
+            self.heart_rate = decode_hr_measurement(bytearray(payload)).heart_rate
+            # notifications flow, so the next trouble starts from a short backoff again
+            self.backoff.reset()
+
+    def _read_loop(self, now):
+        try:
+            stage = read_metrics(self.metrics_path)["stages"].get("light loop tick")
+        except (IOError, OSError, ValueError):
+            return
+        if stage is None:
+            return
+        if stage["count"] != self.ticks:
+            self.ticks = stage["count"]
+            self.last_tick = now
+
+    def check(self, now=None):
+        """
+        Health check, restarts the session if need be
+        """
+        if now is None:
+            now = monotonic()
+        if self.state == WAITING:
+            if now >= self.restart_at:
+                self.start()
+            return
+        if self.process is None:
+            return
+        code = self.process.poll()
+        if code is not None:
+            self.restart("exited with %d" % code)
+            return
+        self.bus.check()
+        self._read_bus()
+        self._read_loop(now)
+        if now - self.started < STARTUP_GRACE and self.last_notification is None:
+            self.state = STARTING
+            return
+        silence = now - (self.last_notification or self.started)
+        if silence > RESTART_SILENCE:
+            self.restart("no heart rate for %.0fs" % silence)
+        elif self.last_tick is not None and now - self.last_tick > LOOP_STALL:
+            self.restart("light loop stalled for %.0fs" % (now - self.last_tick))
+        elif silence > STRAP_SILENCE:
+            self.state = SILENT
+        else:
+            self.state = RUNNING
+
+    def status(self, now=None):
+        """
+        @return: dict with the state of the session
+        """
+        if now is None:
+            now = monotonic()
+        return {
+            "participant": self.participant,
+            "pid": self.process.pid if self.process else None,
+            "core": self.core,
+            "state": self.state,
+            "uptime_s": now - self.started if self.process else None,
+            "heart_rate": self.heart_rate,
+            "notification_age_s": now - self.last_notification if self.last_notification is not None else None,
+            "ticks": self.ticks,
+            "restarts": self.restarts,
+            "reason": self.reason,
+        }
+
+
+class LabSupervisor(object):
+    """
+    Starts the sessions of a lab file, checks them and shows their state
+    """
+
+    def __init__(self, lab, log_root=LOG_ROOT, logger=None, status_path=None):
+        """
+        @param lab: lab configuration, see the top of this file
+        @param status_path: file to keep the status of all the sessions in as JSON
+        """
+        cores = _cores()
+        # leave the first core to the supervisor and the system when there are enough
+        usable = cores[1:] if len(cores) > len(lab["sessions"]) else cores
+        self.sessions = [SupervisedSession(config, usable[i % len(usable)], log_root, logger)
+                         for i, config in enumerate(lab["sessions"])]
+        self.logger = logger
+        self.status_path = status_path or os.path.join(log_root, "lab_status.json")
+        self.running = False
+
+    def status(self):
+        now = monotonic()
+        return [session.status(now) for session in self.sessions]
+
+    def status_table(self):
+        lines = ["%-6s %-7s %-4s %-13s %8s %4s %7s %8s %8s  %s"
+                 % ("P", "pid", "core", "state", "uptime", "HR", "HR age", "ticks", "restarts", "last restart")]
+        for status in self.status():
+            lines.append("%-6s %-7s %-4s %-13s %8s %4s %7s %8s %8d  %s" % (
+                "P%d" % status["participant"],
+                status["pid"] or "-",
+                "-" if status["core"] is None else status["core"],
+                status["state"],
+                "%.0fs" % status["uptime_s"] if status["uptime_s"] is not None else "-",
+                status["heart_rate"] if status["heart_rate"] is not None else "-",
+                "%.1fs" % status["notification_age_s"] if status["notification_age_s"] is not None else "-",
+                status["ticks"] if status["ticks"] is not None else "-",
+                status["restarts"],
+                status["reason"] or ""))
+        return "\n".join(lines)
+
+    def _write_status(self):
+        temp = self.status_path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.status(), f, indent=1, sort_keys=True)
+        os.rename(temp, self.status_path)
+
+    def run(self, duration=None, show=True):
+        """
+        Start all the sessions and supervise them until Ctrl-C (or duration seconds)
+        """
+        self.running = True
+        for session in self.sessions:
+            session.start()
+        started = monotonic()
+        next_status = started
+        try:
+            while self.running and (duration is None or monotonic() - started < duration):
+                for session in self.sessions:
+                    session.check()
+                now = monotonic()
+                if now >= next_status:
+                    next_status = now + STATUS_INTERVAL
+                    self._write_status()
+                    if show:
+                        if sys.stdout.isatty():
+                            sys.stdout.write("\033[2J\033[H")
+                        print(self.status_table())
+                        sys.stdout.flush()
+                time.sleep(CHECK_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        for session in self.sessions:
+            session.stop()
+            session.state = STOPPED
+        self._write_status()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python lab_supervisor.py lab.json")
+        sys.exit(1)
+    import logging
+    if not os.path.isdir(LOG_ROOT):
+        os.makedirs(LOG_ROOT)
+    logging.basicConfig(filename=os.path.join(LOG_ROOT, "lab_supervisor.log"), level=logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(message)s")
+    supervisor = LabSupervisor(load_lab(sys.argv[1]), logger=logging.getLogger("LabSupervisor"))
+    supervisor.run()
@@ -0,0 +1,197 @@
+# The pulse of the robot lights, for the live loops and offline alike.
+# The light loops advance the pulse one tick at a time with the functions
+# here, and render() works out the whole trajectory of a recorded heart rate
+# series (every tick's robot rate, phase and brightness) in one numpy pass
+# with the same arithmetic, so backends can be checked against golden
+# trajectories and hours of stimulus generated in milliseconds.
+#
+#   rate mode   the pulse runs at half the robot's heart rate, which follows
+#               the strap (x0.8 in the asynchronous condition)
+#   beat mode   the phase comes from a BeatPLL locked on the beats, see render_beats()
+#
+# The brightness at a phase comes from the robot's waveform (waveforms.py).
+# Miro gets it as a byte in the top of each LED's 0xLLRRGGBB word, Pepper the
+# brightness itself.
+#
+#   python light_trajectory.py recording.hrr [--rate 20] [--async] [--beat] [--waveform lubdub]
+#                                            [--output golden.npz]
+import argparse
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from beat_pll import BeatPLL
+from hr_measurement import decode_hr_measurement
+from hr_sources import HRSample, read_recording
+from waveforms import COSINE, WAVEFORMS, get_waveform
+
+ASYNC_FACTOR = 0.8              # robot rate relative to the heart rate in the asynchronous condition
+MIN_RATE = 0.01                 # beats per second, lower heart rates are ignored
+START_RATE = 1.0                # beats per second the robots start at
+
+# color for six LEDs: [front_left, middle_left, back_left, front_right, etc.]
+DEFAULT_RGB = [0x00FFFFFF, 0x00FFFFFF, 0x00FFFFFF, 0x00FFFFFF, 0x00FFFFFF, 0x00FFFFFF]
+
+
+class Trajectory(namedtuple('Trajectory', ['ticks', 'rate', 'phase', 'brightness'])):
+    """
+    The lights of a session tick by tick
+    @param ticks: tick times in seconds
+    @param rate: robot heart rate in beats per second at each tick
+    @param phase: pulse phase in radians as shown, i.e. including any lead
+    @param brightness: 0-1
+    """
+    __slots__ = ()
+
+
+def robot_rate(heart_rate, asynchMode=False):
+    """
+    @param heart_rate: bpm from the strap, number or array
+    @return: the rate in beats per second the robot pulses along to
+    """
+    return heart_rate * (ASYNC_FACTOR if asynchMode else 1.0) / 60.0
+
+
+def advance_phase(phase, phase_time, rate):
+    """
+    @param phase_time: seconds since the previous tick
+    @param rate: robot heart rate in beats per second, the light pulses at half of it
+    @return: the phase one tick on
+    """
+    return phase + phase_time * (rate / 2.0) * 2 * np.pi
+
+
+def miro_words(levels, rgb=DEFAULT_RGB):
+    """
+    @param levels: Waveform.level() of each tick, the brightness byte in place
+    @param rgb: 0x00RRGGBB color of each LED, LEDs that are 0 stay off
+    @return: ticks x LEDs array of the illum words Miro is sent
+    """
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    levels = np.atleast_1d(levels).astype(np.uint32)
+    return np.where(rgb != 0, rgb | levels[:, np.newaxis], np.uint32(0)).astype(np.uint32)
+
+
+def pepper_window(phase, rate, steps, waveform=COSINE):
+    """
+    Keyframes of a Pepper fade window
+    @param phase: phase the window starts from
+    @param rate: robot heart rate in beats per second
+    @param steps: times of the keyframes from now in seconds
+    @param waveform: Waveform of the pulse
+    @return: brightness of each keyframe
+    """
+    return waveform.brightness(advance_phase(phase, steps, rate))
+
+
+def tick_times(duration, update_rate=20.0, start=0.0):
+    """
+    @return: the ideal tick times of a light loop over duration seconds
+    """
+    return start + np.arange(int(round(duration * update_rate))) / float(update_rate)
+
+
+def held_rate(ticks, sample_times, heart_rates, asynchMode=False):
+    """
+    Robot heart rate at each tick: the rate of the last usable sample before
+    it, the start rate before the first
+    """
+    rates = robot_rate(np.asarray(heart_rates, dtype=np.float64), asynchMode)
+    usable = rates > MIN_RATE
+    sample_times = np.asarray(sample_times, dtype=np.float64)[usable]
+    rates = np.concatenate(([robot_rate(START_RATE * 60.0, asynchMode)], rates[usable]))
+    return rates[np.searchsorted(sample_times, ticks, side="right")]
+
+
+def render(sample_times, heart_rates, ticks=None, update_rate=20.0, asynchMode=False, lead=0.0, waveform=COSINE):
+    """
+    Rate mode trajectory of a heart rate series, as the live loops step it
+    @param sample_times: times of the heart rate samples in seconds
+    @param heart_rates: bpm of each sample
+    @param ticks: tick times, by default update_rate ticks a second over the series
+    @param lead: seconds the shown pulse runs ahead, i.e. the actuation latency
+    @param waveform: Waveform of the pulse
+    @return: Trajectory
+    """
+    if ticks is None:
+        duration = sample_times[-1] - sample_times[0] if len(sample_times) else 0.0
+        ticks = tick_times(duration, update_rate, sample_times[0] if len(sample_times) else 0.0)
+    ticks = np.asarray(ticks, dtype=np.float64)
+    rate = held_rate(ticks, sample_times, heart_rates, asynchMode)
+    # the first tick advances by one period like the live loop, the others by the time since the previous
+    phase_time = np.empty_like(ticks)
+    phase_time[:1] = 1.0 / update_rate
+    phase_time[1:] = np.diff(ticks)
+    # summed one tick after the other, as the loop does
+    phase = np.cumsum(advance_phase(0.0, phase_time, rate))
+    # the lead as ActuationLatency.phase_lead works it out
+    phase = phase + 2 * math.pi * (rate / 2.0) * lead
+    return Trajectory(ticks, rate, phase, waveform.brightness(phase))
+
+
+def render_beats(samples, ticks, pll=None, asynchMode=False, waveform=COSINE):
+    """
+    Beat mode trajectory. The loop is fed sample by sample, and in between
+    samples the phase of all the ticks follows from its state in one go
+    @param samples: HRSamples (timestamp, heart_rate, rr_intervals) in time order
+    @param ticks: tick times on the same clock as the samples
+    @param pll: BeatPLL to use, a new one by default
+    @param waveform: Waveform of the pulse
+    @return: Trajectory
+    """
+    if pll is None:
+        pll = BeatPLL(rate_factor=ASYNC_FACTOR if asynchMode else 1.0)
+    ticks = np.asarray(ticks, dtype=np.float64)
+    phase = np.zeros(len(ticks))
+    rate = np.zeros(len(ticks))
+    # each sample is taken in by the first tick at or after it
+    boundaries = np.searchsorted(ticks, [sample.timestamp for sample in samples], side="left")
+    start = 0
+    for sample, end in zip(list(samples) + [None], list(boundaries) + [len(ticks)]):
+        if end > start:
+            # the loop's state only changes with a sample, so the ticks up to the next one go in one array
+            phase[start:end] = pll.light_phase(ticks[start:end])
+            rate[start:end] = 2.0 * pll.pulse_frequency()
+            start = end
+        if sample is not None:
+            pll.add_sample(sample)
+    return Trajectory(ticks, rate, phase, waveform.brightness(phase))
+
+
+def samples_from_recording(path):
+    """
+    @return: HRSamples of a NotificationRecorder file, timed from its first notification
+    """
+    entries = read_recording(path)
+    first = entries[0][0] if entries else 0.0
+    samples = []
+    for seq, (timestamp, payload) in enumerate(entries):
+        measurement = decode_hr_measurement(payload)
+        samples.append(HRSample(seq + 1, timestamp - first, measurement.heart_rate, measurement.rr_intervals,
+                                measurement))
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the light trajectory of a heart rate recording")
+    parser.add_argument("recording", help="HeartBot_*.hrr notification recording")
+    parser.add_argument("--rate", type=float, default=20.0, help="light updates per second")
+    parser.add_argument("--async", dest="asynch", action="store_true", help="asynchronous condition")
+    parser.add_argument("--beat", action="store_true", help="beat locked instead of rate mode")
+    parser.add_argument("--waveform", default="cosine", choices=sorted(WAVEFORMS), help="shape of the pulse")
+    parser.add_argument("--output", help="write ticks, rate, phase, brightness and miro words to this .npz")
+    args = parser.parse_args()
+
+    samples = samples_from_recording(args.recording)
+    waveform = get_waveform(args.waveform)
+    ticks = tick_times(samples[-1].timestamp if samples else 0.0, args.rate)
+    if args.beat:
+        trajectory = render_beats(samples, ticks, asynchMode=args.asynch, waveform=waveform)
+    else:
+        trajectory = render([sample.timestamp for sample in samples], [sample.heart_rate for sample in samples],
+                            ticks, args.rate, args.asynch, waveform=waveform)
+    print("%d ticks over %.0fs, mean rate %.1fbpm"
+          % (len(ticks), ticks[-1] if len(ticks) else 0.0, trajectory.rate.mean() * 60.0 if len(ticks) else 0.0))
+    if args.output:
+        np.savez(args.output, miro=miro_words(waveform.level(trajectory.phase)), **trajectory._asdict())
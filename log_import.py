@@ -0,0 +1,384 @@
+# Import the text logs of past sessions into the session archive.
+# Before the telemetry file and the archive existed every tick of the light
+# loops went into the log, e.g.
+#
+#   2019-05-03 14:12:01,234 HeartBot     INFO     Heart rate change: 72 to 75
+#   2019-05-03 14:12:01,251 HeartBot     INFO     Pepper current heart_rate: 1.250000 beats per seond
+#   2019-05-03 14:12:01,252 HeartBot     INFO     Phase: 8123.400000 	 Brightness: 0.412000
+#
+# Miro logged its brightness as the raw LED word (the level byte shifted to the
+# top, int(mag * 0xFF) << 24), which is taken back to 0-1 like Pepper's.
+# Each log (one per run of polarHeartBot) is streamed line by line into an
+# archived session: the heart rates of the strap as samples, the phase and
+# brightness lines as telemetry of the robot that logged the current heart
+# rate just before them. Logs written since have a telemetry file next to them
+# (same time stamp, .tlm) which is imported instead of the phase lines.
+# Rows are written out in blocks so memory stays bounded however long the
+# log, and every participant directory is imported by its own process.
+#
+#   python log_import.py [./Logs] [--archive ./Logs/archive] [--processes 8] [--force] [--summary sync.csv]
+#
+# Sessions already imported from a log, or archived live while the log was
+# written, are skipped unless --force is given.
+# Once a session is imported the error between the rate of its lights and the
+# participant's heart rate is worked out from the archived columns, see sync_error().
+import argparse
+import csv
+import io
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from session_archive import ARCHIVE_ROOT, TABLES, TELEMETRY_RECORD, SessionArchive
+from telemetry import HEADER, MAGIC, RECORD, SOURCE_MIRO, SOURCE_NAMES, SOURCE_PEPPER, source_name, source_type
+
+LOG_ROOT = os.path.join(".", "Logs")
+BLOCK_ROWS = 8192               # rows held per table before they are written out
+ASYNC_FACTOR = 0.8              # light rate relative to the heart rate in the asynchronous condition
+SYNC_WINDOW = 1.0               # seconds the light rate is measured over
+SYNC_TOLERANCE = 2.0            # bpm, light rate errors within this count as in sync
+
+ROBOT_SOURCES = {"Pepper": SOURCE_PEPPER, "Miro": SOURCE_MIRO}
+MIRO_LEVEL_MAX = 0xFF           # brightness byte at the top of Miro's logged LED word
+
+# asctime, name and level of the add_logger format, then the message
+_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) \S+\s+\S+\s+(.*)$")
+_PARTICIPANT = re.compile(r"Participant Number (\d+)")
+_HR_CHANGE = re.compile(r"Heart rate change: -?\d+ to (\d+)")
+_HR_READ = re.compile(r"Heart rate read: (\d+)")
+_ROBOT_UPDATE = re.compile(r"(Pepper|Miro) (asynchronous )?heart_rate updated to : ([-\d.]+)")
+_ROBOT_CURRENT = re.compile(r"(Pepper|Miro) current heart_rate: ([-\d.]+)")
+_PHASE = re.compile(r"Phase: ([-\d.e+]+)\s+Brightness: ([-\d.e+]+)")
+_LOG_NAME = re.compile(r"HeartBot_(\d{6}_\d{8})\.log$")
+
+
+class _Clock(object):
+    """
+    Turns log time stamps into time.time() seconds, parsing each second only once
+    """
+
+    def __init__(self):
+        self._second = None
+        self._seconds = 0.0
+
+    def __call__(self, second, millis):
+        if second != self._second:
+            self._seconds = time.mktime(time.strptime(second, "%Y-%m-%d %H:%M:%S"))
+            self._second = second
+        return self._seconds + int(millis) / 1000.0
+
+
+class _Blocks(object):
+    """
+    Rows of the tables of a session, written out in blocks
+    """
+
+    def __init__(self):
+        self.writer = None
+        self.rows = dict((table, dict((column, []) for column, _ in columns)) for table, columns in TABLES.items())
+
+    def add(self, table, **values):
+        columns = self.rows[table]
+        for column, value in values.items():
+            columns[column].append(value)
+        if len(columns["timestamp"]) >= BLOCK_ROWS:
+            self.write(table)
+
+    def write(self, table):
+        columns = self.rows[table]
+        if columns["timestamp"]:
+            self.writer.append(table, columns)
+            self.rows[table] = dict((column, []) for column in columns)
+
+
+def _telemetry_path(log_path):
+    match = _LOG_NAME.search(log_path)
+    if not match:
+        return None
+    path = os.path.join(os.path.dirname(log_path), "HeartBot_%s.tlm" % match.group(1))
+    return path if os.path.isfile(path) else None
+
+
+def _import_telemetry(path, writer):
+    """
+    Copy a telemetry file into the telemetry table block by block
+    @return: names of the robot types that recorded to it
+    """
+    robots = set()
+    sources = set()
+    with open(path, "rb") as f:
+        magic, _, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != RECORD.size:
+            return robots
+        while True:
+            records = np.fromfile(f, dtype=TELEMETRY_RECORD, count=BLOCK_ROWS)
+            if not len(records):
+                break
+            writer.append("telemetry", dict((column, records[column]) for column, _ in TABLES["telemetry"]))
+            sources.update(int(source) for source in np.unique(records["source"]))
+    # the file does not know the robots' names, the sources are named after their type and place
+    writer.set_sources(dict((source, source_name(source)) for source in sources))
+    for source in sources:
+        if source_type(source) in (SOURCE_PEPPER, SOURCE_MIRO):
+            robots.add(SOURCE_NAMES[source_type(source)].capitalize())
+    return robots
+
+
+def import_log(archive, log_path, participant=None, source=None):
+    """
+    Stream one log into a new archived session
+    @param archive: SessionArchive to add the session to
+    @param log_path: the log file
+    @param participant: participant number if the log does not say
+    @param source: name the session records it was imported from, the log path if not given
+    @return: meta data of the session, None if the log had no time stamped lines
+    """
+    clock = _Clock()
+    blocks = _Blocks()
+    robots = set()
+    mode = "sync"
+    seq = 0
+    robot = None                # robot that logged the current heart rate last
+    robot_rate = 0.0            # its heart rate in beats per second
+    started = None              # time of the first line
+    last = None
+    with io.open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = _LINE.match(line)
+            if match is None:
+                # e.g. the lines of a traceback
+                continue
+            timestamp = clock(match.group(1), match.group(2))
+            message = match.group(3)
+            last = timestamp
+            if started is None:
+                # The participant number is logged first thing
+                started = timestamp
+                number = _PARTICIPANT.search(message)
+                if number:
+                    participant = int(number.group(1))
+                blocks.writer = archive.create(participant if participant is not None else 0, mode,
+                                               started=started, source=source or log_path)
+
+            # roughly most to least frequent
+            if message.startswith("Phase"):
+                phase = _PHASE.match(message)
+                if phase and robot is not None:
+                    brightness = float(phase.group(2))
+                    if robot == "Miro":
+                        brightness = (int(brightness) >> 24) / float(MIRO_LEVEL_MAX)
+                    blocks.add("telemetry", timestamp=timestamp, source=ROBOT_SOURCES[robot],
+                               heart_rate=robot_rate * 60.0, phase=math.radians(float(phase.group(1))),
+                               brightness=brightness)
+                continue
+            current = _ROBOT_CURRENT.match(message)
+            if current:
+                robot = current.group(1)
+                robot_rate = float(current.group(2))
+                robots.add(robot)
+                continue
+            hr = _HR_CHANGE.search(message) or _HR_READ.search(message)
+            if hr:
+                blocks.add("samples", timestamp=timestamp, seq=seq, heart_rate=int(hr.group(1)))
+                seq += 1
+                continue
+            update = _ROBOT_UPDATE.match(message)
+            if update:
+                robots.add(update.group(1))
+                if update.group(2):
+                    mode = "async"
+
+    writer = blocks.writer
+    if writer is None:
+        return None
+    for table in TABLES:
+        blocks.write(table)
+    telemetry_path = _telemetry_path(log_path)
+    if telemetry_path:
+        robots.update(_import_telemetry(telemetry_path, writer))
+    writer.meta["mode"] = mode
+    writer.set_robots(sorted(robots))
+    writer.close(end=last, index=False)
+    return writer.meta
+
+
+def sync_error(session, source, window=SYNC_WINDOW):
+    """
+    Error between the rate the lights of a robot pulsed at and the rate they
+    should have pulsed at, the participant's heart rate (times ASYNC_FACTOR in
+    the asynchronous condition). The light rate is measured from the phase
+    over window seconds and counts two beats per pulse
+    @param session: ArchivedSession
+    @param source: telemetry source of the robot
+    @return: dict of statistics in bpm, None if there is nothing to compare
+    """
+    telemetry = session.telemetry(source)
+    times = np.asarray(telemetry["timestamp"])
+    samples = session.table("samples")
+    sample_times = np.asarray(samples["timestamp"])
+    if len(times) < 2 or not len(sample_times):
+        return None
+    phase = np.unwrap(np.asarray(telemetry["phase"], dtype=np.float64))
+
+    # light rate over the window ending at each tick
+    start = np.searchsorted(times, times - window)
+    valid = (times - times[start]) >= window / 2.0
+    elapsed = times - times[start]
+    elapsed[~valid] = 1.0
+    light_rate = (phase - phase[start]) / elapsed / math.pi * 60.0
+
+    # heart rate in force at each tick
+    held = np.searchsorted(sample_times, times, side="right") - 1
+    valid &= held >= 0
+    heart_rate = np.asarray(samples["heart_rate"], dtype=np.float64)[np.maximum(held, 0)]
+    valid &= heart_rate > 0
+    if not valid.any():
+        return None
+    factor = ASYNC_FACTOR if session.meta["mode"] == "async" else 1.0
+    error = light_rate[valid] - factor * heart_rate[valid]
+    absolute = np.abs(error)
+    return {
+        "ticks": int(valid.sum()),
+        "mean": float(error.mean()),
+        "mean_abs": float(absolute.mean()),
+        "rms": float(np.sqrt((error * error).mean())),
+        "p95_abs": float(np.percentile(absolute, 95)),
+        "in_sync": float((absolute <= SYNC_TOLERANCE).mean()),
+    }
+
+
+def session_summary(session):
+    """
+    @return: one dict per robot of the session with its sync error statistics
+    """
+    rows = []
+    names = session.sources()
+    sources = np.unique(session.column("telemetry", "source")).tolist()
+    for source in sources:
+        if source_type(source) not in (SOURCE_PEPPER, SOURCE_MIRO):
+            continue
+        stats = sync_error(session, source)
+        if stats is None:
+            continue
+        meta = session.meta
+        row = {"participant": meta["participant"], "session": meta["id"], "mode": meta["mode"],
+               "robot": names.get(source, source_name(source)),
+               "duration_s": (meta["end"] or meta["start"]) - meta["start"]}
+        row.update(stats)
+        rows.append(row)
+    return rows
+
+
+def import_participant(task):
+    """
+    Import the logs of one participant directory, run in a worker process
+    @param task: (archive root, directory, participant number or None, dict of log to session path already
+                  imported, force)
+    @return: (list of session meta data, list of summary rows, list of (log, error) that failed)
+    """
+    root, directory, participant, imported, force = task
+    archive = SessionArchive(root)
+    metas = []
+    rows = []
+    failed = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".log"):
+            continue
+        log_path = os.path.join(directory, name)
+        if os.path.abspath(log_path) in imported:
+            if not force:
+                continue
+            shutil.rmtree(os.path.join(root, imported[os.path.abspath(log_path)]), ignore_errors=True)
+        try:
+            meta = import_log(archive, log_path, participant)
+        except Exception as e:
+            failed.append((log_path, str(e)))
+            continue
+        if meta is None:
+            continue
+        metas.append(meta)
+        rows.extend(session_summary(archive.open(meta["path"])))
+    return metas, rows, failed
+
+
+def _participant_directories(log_root, archive_root):
+    for name in sorted(os.listdir(log_root)):
+        directory = os.path.join(log_root, name)
+        if not os.path.isdir(directory) or os.path.abspath(directory) == os.path.abspath(archive_root):
+            continue
+        match = re.match(r"P(\d+)$", name)
+        yield directory, int(match.group(1)) if match else None
+
+
+def import_logs(log_root=LOG_ROOT, archive_root=ARCHIVE_ROOT, processes=None, force=False, logger=None):
+    """
+    Import every participant directory under log_root, one worker process per directory
+    @return: (number of sessions imported, list of summary rows, list of (log, error) that failed)
+    """
+    archive = SessionArchive(archive_root)
+    # sessions archived live by polarHeartBot have their log as source too
+    imported = dict((os.path.abspath(entry["source"]), entry["path"]) for entry in archive.index()
+                    if entry.get("source"))
+    tasks = [(archive_root, directory, participant, imported, force)
+             for directory, participant in _participant_directories(log_root, archive_root)]
+    if not tasks:
+        return 0, [], []
+    sessions = 0
+    rows = []
+    failed = []
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(tasks)))
+    try:
+        for metas, summary, errors in pool.imap_unordered(import_participant, tasks):
+            # The workers leave the index to this process
+            for meta in metas:
+                archive.add_to_index(meta)
+                if logger:
+                    logger.info("Imported %s" % meta["source"])
+            sessions += len(metas)
+            rows.extend(summary)
+            failed.extend(errors)
+    finally:
+        pool.close()
+        pool.join()
+    rows.sort(key=lambda row: (row["participant"], row["session"], row["robot"]))
+    return sessions, rows, failed
+
+
+SUMMARY_COLUMNS = ["participant", "session", "mode", "robot", "duration_s", "ticks", "mean", "mean_abs", "rms",
+                   "p95_abs", "in_sync"]
+
+
+def write_summary(path, rows):
+    with open(path, "w") as f:
+        writer = csv.DictWriter(f, SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import HeartBot text logs into the session archive")
+    parser.add_argument("logs", nargs="?", default=LOG_ROOT, help="directory with the P<participant> directories")
+    parser.add_argument("--archive", default=ARCHIVE_ROOT, help="session archive to import into")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, one per core by default")
+    parser.add_argument("--force", action="store_true", help="import logs again that were imported before")
+    parser.add_argument("--summary", default=None, help="write the sync error of every session to this csv file")
+    args = parser.parse_args()
+
+    started = time.time()
+    sessions, rows, failed = import_logs(args.logs, args.archive, args.processes, args.force)
+    print("Imported %d sessions in %.1fs" % (sessions, time.time() - started))
+    for row in rows:
+        print("P%-4d %-18s %-5s %-6s mean %+6.2f mean abs %5.2f rms %5.2f p95 %5.2f bpm in sync %3.0f%%"
+              % (row["participant"], row["session"], row["mode"], row["robot"], row["mean"], row["mean_abs"],
+                 row["rms"], row["p95_abs"], row["in_sync"] * 100.0))
+    for log_path, error in failed:
+        print("Could not import %s: %s" % (log_path, error))
+    if args.summary:
+        write_summary(args.summary, rows)
+    sys.exit(1 if failed else 0)
@@ -10,18 +10,20 @@
 ################################################################
 
 import rospy
-from std_msgs.msg import String#,Float32MultiArray,UInt16MultiArray
-from std_msgs.msg import Float32MultiArray, UInt32MultiArray
-from sensor_msgs.msg import JointState
-from geometry_msgs.msg import Twist
+from std_msgs.msg import UInt32MultiArray
 
-import math
-import numpy as np
+import threading
 import time
 import sys
-import os
-import miro2 as miro
-from datetime import datetime
+from tick_scheduler import TickScheduler, monotonic
+from miro_light_frame import MiroLightFrame
+from telemetry import SOURCE_MIRO, SOURCE_PLL
+from beat_pll import BeatPLL
+from actuation_latency import ActuationLatency
+from hr_sources import FileHeartRateSource
+from instrumentation import METRICS
+from light_trajectory import ASYNC_FACTOR, advance_phase, robot_rate
+from waveforms import get_waveform
 
 ################################################################
 
@@ -30,7 +32,7 @@ def error(msg):
 	sys.exit(0)
 
 def usage():
-	print """
+	print("""
 Usage:
 	miro_ros_client_lights.py robot=<robot_name>
 
@@ -42,14 +44,14 @@ Options:
 		specify the name of the miro robot to connect to,
 		which forms the ros base topic "/miro/<robot_name>".
 		there is no default, this argument must be specified.
-	"""
+	""")
 	sys.exit(0)
 
 ################################################################
 
 class miro_ros_client_std:
 	
-	def __init__(self, robot_name, hr_reader=None, asynchMode=False, logger=None):
+	def __init__(self, robot_name, hr_reader=None, asynchMode=False, logger=None, update_rate=20.0, telemetry=None, sync_mode="rate", connect=True, waveform="cosine", actuation_offset=0.0):
 		
 		# report
 		print("initialising robot...")
@@ -57,21 +59,47 @@ class miro_ros_client_std:
 		
 		self.heart_rate = 60.0/60.0    # 60 beats per second
 		self.robot_name = robot_name
-		self.hr_reader = hr_reader	
+		self.name = "Miro %s" % robot_name
+		# Without a reader fall back to the heart rate written in ./heartRate.txt
+		self.hr_reader = hr_reader if hr_reader else FileHeartRateSource()
+		# New heart rate samples of the reader, only polled once a tick
+		self.hr_samples = self.hr_reader.subscribe()
 		
 		self.asynchMode = asynchMode
 		
-        if self.asynchMode:
-            self.heart_rate = self.heart_rate * 0.8 
-        self.logger = logger
+		if self.asynchMode:
+			self.heart_rate = self.heart_rate * ASYNC_FACTOR
+		self.logger = logger
+		self.update_rate = update_rate	# light updates per second
+		# per tick heart rate, phase and brightness go to telemetry rather than the log
+		self.telemetry = telemetry.channel(SOURCE_MIRO, self.name) if telemetry else None
+		# "rate" integrates the heart rate, "beat" locks the light phase on the beats themselves
+		self.sync_mode = sync_mode
+		self.pll = BeatPLL(rate_factor=ASYNC_FACTOR if asynchMode else 1.0) if sync_mode == "beat" else None
+		self.pll_telemetry = telemetry.channel(SOURCE_PLL, "%s pll" % self.name) if telemetry and self.pll else None
+		# shape of the pulse, looked up by phase every tick
+		self.waveform = get_waveform(waveform)
+		# only the time from step() to the publish to ROS can be measured here, how long the Miro then
+		# takes to light its LEDs is measured once per robot and given as its offset
+		self.actuation = ActuationLatency(offset=actuation_offset)
+		# stage timing, no-ops unless instrumentation is on
+		self.update_stage = METRICS.stage("%s update_heart_rate" % self.name)
+		self.phase_stage = METRICS.stage("%s phase" % self.name)
+		self.send_stage = METRICS.stage("%s publish" % self.name)
 		
 		# check we got at least one
 		if len(self.robot_name) == 0:
 			error("argument \"robot\" must be specified")
 			
 		self.set_active = False
-			
+		if connect:
+			self.connect()
 		
+	def connect(self):
+		"""
+		Start the ROS node, if this process has none yet, and advertise the illum topic
+		"""
+		init_node()
 		# topic root
 		topic_root = "/" + self.robot_name + "/"
 		#print "topic_root", topic_root
@@ -81,50 +109,107 @@ class miro_ros_client_std:
 		if self.logger:
 			self.logger.info("Publishing on: %s" % topic_name)
 		self.pub_lights = rospy.Publisher(topic_name, UInt32MultiArray, queue_size=0)
+		# preallocated frame that we keep republishing
+		self.light_frame = MiroLightFrame(self.pub_lights, msg_type=UInt32MultiArray)
 		
 		
 		if self.logger:
 			self.logger.info("Miro Initialised")
 		
 	def update_heart_rate(self):
-		updated_rate = 1.0
-		if self.hr_reader and not self.asynchMode:
-			rate = self.hr_reader.heartRate
-			updated_rate = float(rate)/60.0
+		# Nothing to do until the reader publishes a new sample
+		sample = self.hr_samples.poll()
+		if sample is None:
+			return
+		if self.pll:
+			for error in self.pll.add_sample(sample):
+				if self.pll_telemetry:
+					self.pll_telemetry.record(60.0 / self.pll.period, error)
+		rate = sample.heart_rate
+		if not self.asynchMode:
+			updated_rate = robot_rate(float(rate))
 			#
 			if updated_rate > 0.01 and self.heart_rate != updated_rate:
 				print("Updating robot rate to  %f bps" % updated_rate)
 				self.heart_rate = updated_rate
 				if self.logger:
 					self.logger.info("Miro heart_rate updated to : %f beats per seond" % self.heart_rate)
-		elif self.hr_reader and self.asynchMode:
-            # a quarter rate for asynch
-            rate = self.hr_reader.heartRate
-            updated_rate = (float(rate) * 0.8)/60.0
-            
-            if updated_rate > 0.01 and self.heart_rate != updated_rate:
-                print("Updating robot asynchronous rate to  %f bps" % updated_rate)
-                self.heart_rate = updated_rate	
-	            if self.logger:
-					self.logger.info("Miro asynchronous heart_rate updated to : %f beats per seond" % self.heart_rate)
-		 		
 		else:
-			# Read from file
-			hr_file = "./heartRate.txt"
-			if os.path.isfile(hr_file):
+			# a quarter rate for asynch
+			updated_rate = robot_rate(float(rate), asynchMode=True)
+			
+			if updated_rate > 0.01 and self.heart_rate != updated_rate:
+				print("Updating robot asynchronous rate to  %f bps" % updated_rate)
+				self.heart_rate = updated_rate	
 				if self.logger:
-					self.logger.info("Updating heart_rate from file")
-				f = hr_file.open()
-				rate = int(f.readline())
-				updated_rate = float(rate)/60.0
-				if updated_rate > 0.01 and self.heart_rate != updated_rate:
-					print("Updating robot rate to  %f bps" % updated_rate)
-					self.heart_rate = updated_rate
-					if self.logger:
-					   self.logger.info("Miro heart_rate updated to : %f beats per seond" % self.heart_rate)
+					self.logger.info("Miro asynchronous heart_rate updated to : %f beats per seond" % self.heart_rate)
 	
 	
 
+	def start_lights(self):
+		"""
+		Start the pulse from the beginning
+		"""
+		self.phase = 0.0
+
+	def step(self, now, phase_time):
+		"""
+		Advance the pulse by one tick without publishing anything
+		@param now: monotonic time of the tick
+		@param phase_time: seconds since the previous tick
+		@return: brightness word for send() and the time it was worked out
+		"""
+		# Get an update of heart rate from the reader
+		started = self.update_stage.begin()
+		self.update_heart_rate()
+		self.update_stage.end(started)
+		
+		started = self.phase_stage.begin()
+		if self.pll:
+			# phase straight from the predicted beats
+			f_pulse = self.pll.pulse_frequency()
+			self.phase = self.pll.light_phase(now)
+		else:
+			# update pulse rate for the robot
+			f_pulse = self.heart_rate/2.0
+			
+			# increment pulse phase by current rate
+			self.phase = advance_phase(self.phase, phase_time, self.heart_rate)
+
+		# run ahead by the time the frame takes to show on the robot
+		shown_phase = self.phase + self.actuation.phase_lead(f_pulse)
+
+		# brightness byte, already in place in the LED word
+		level = self.waveform.level(shown_phase)
+
+		if self.telemetry:
+			self.telemetry.record(self.heart_rate * 60.0, shown_phase, self.waveform.brightness(shown_phase))
+		self.phase_stage.end(started)
+		return level, monotonic()
+
+	def send(self, command):
+		"""
+		Fix up the brightness of all LEDs and publish if it changed
+		"""
+		started = monotonic()
+		level, stamped = command
+		if self.light_frame.show(level):
+			# including the wait in the mailbox while the last frame was going out
+			self.actuation.add(monotonic() - stamped)
+		self.send_stage.end(started)
+
+	def stop_lights(self):
+		# Switch off the lights
+		self.light_frame.off()
+
+	def log_summary(self):
+		if self.logger:
+			frame = self.light_frame
+			self.logger.info("%s publish time: %s" % (self.name, self.actuation))
+			self.logger.info("%s light frames published: %d unchanged: %d" % (self.name, frame.published, frame.skipped))
+			if self.pll:
+				self.logger.info("%s beat lock: %s" % (self.name, self.pll))
+
 	def synch_hr(self):
 		
 		# wait for connection
@@ -133,70 +218,56 @@ class miro_ros_client_std:
 		self.set_active = True
 
 		# params
-		T = .05 # update time
-		phase = 0.0 
-		phase_time = T
-		last_time = None
-		# color for six LEDs: [front_left, middle_left, back_left, front_right, etc.]
-		rgb = [0x00FFFFFF, 0x00FFFFFF,  0x00FFFFFF, 0x00FFFFFF, 0x00FFFFFF,  0x00FFFFFF]
+		scheduler = self.scheduler = TickScheduler(self.update_rate)
+		lateness_stage = METRICS.stage("%s loop lateness" % self.name)
+		phase_time = scheduler.period
+		self.start_lights()
+		scheduler.start()
 		try:
 			# loop
 			while self.set_active and not rospy.core.is_shutdown():
-				
-				# Get an update of heart rate from the reader
-				self.update_heart_rate()
-				
-				# update pulse rate for the robot
-				if self.logger:
-					self.logger.info("Miro current heart_rate: %f beats per seond" % self.heart_rate)
-				f_pulse = self.heart_rate/2.0
-				
-				# create message
-				l = UInt32MultiArray()
-				l.data = np.zeros([6], 'uint32')
-				this_time = datetime.now()
-				if last_time:
-					phase_time = (this_time - last_time).total_seconds()
-				# increment pulse phase by current rate
-				phase += phase_time * f_pulse * 2 * np.pi
-				last_time = this_time
-	
-				# magnitude
-				mag = np.cos(phase) * 0.5 + 0.5
-				bright = int(mag * 0xFF) << 24
-	
-				if self.logger:
-					self.logger.info("Phase: %f \t Brightness: %f" %(np.degrees(phase), bright))
-	
-				
-				# fix up the brightness
-				for j in range(0, 6):
-				     if rgb[j]:
-				     	l.data[j] = rgb[j] | bright
-	
-				#print l
+				self.send(self.step(scheduler.last_tick, phase_time))
 	
-				# publish
-				self.pub_lights.publish(l)
-	
-				# sleep
-				time.sleep(T)
+				# sleep until the next tick is due
+				phase_time = scheduler.wait()
+				lateness_stage.add(scheduler.last_lateness)
 				
 		finally:
-			# Switch off the lights
-			l = UInt32MultiArray()
-			l.data = np.zeros([6], 'uint32')
-			# publish
-			self.pub_lights.publish(l)
-
-def setup_heartbot(robot_name, hr_reader=None, logger=None):
-	main_robot = miro_ros_client_std(robot_name, hr_reader, logger)
-	rospy.init_node("miro_ros_client_std", anonymous=True)
-	return main_robot
+			self.stop_lights()
+			if self.logger:
+				self.logger.info("%s light loop timing: %s" % (self.name, scheduler.stats))
+			self.log_summary()
+
+_node_started = [False]
+_node_lock = threading.Lock()
+
+def init_node():
+	# rospy only allows one node per process, however many Miros it talks to
+	# and whichever of their connect threads gets here first
+	with _node_lock:
+		if not _node_started[0]:
+			# it waits for the ROS master, so it runs in the robots' connect threads, and rospy can only
+			# install its signal handlers from the main thread
+			main_thread = threading.current_thread().name == "MainThread"
+			rospy.init_node("miro_ros_client_std", anonymous=True, disable_signals=not main_thread)
+			_node_started[0] = True
+
+def create_robot(config, hr_source, logger=None, telemetry=None, asynchMode=False, sync_mode="rate"):
+	"""
+	Backend entry point for robot_backends, connecting (starting the node and advertising the topic) is
+	left to the caller
+	@param config: session entry of the robot, "name" (or "address") of the Miro, "waveform" and
+	               "actuation_offset", the seconds from publish to light of this Miro
+	"""
+	robot_name = config.get("name", config.get("address", "miro"))
+	return miro_ros_client_std(robot_name, hr_source, asynchMode, logger, telemetry=telemetry, sync_mode=sync_mode,
+				connect=False, waveform=config.get("waveform", "cosine"),
+				actuation_offset=config.get("actuation_offset", 0.0))
+
+def setup_heartbot(robot_name, hr_reader=None, asynchMode=False, logger=None, update_rate=20.0, telemetry=None, sync_mode="rate"):
+	return miro_ros_client_std(robot_name, hr_reader, asynchMode, logger, update_rate, telemetry, sync_mode)
 									
 if __name__ == "__main__":
 	main = setup_heartbot("miro")
 	main.synch_hr()
 	
-
-
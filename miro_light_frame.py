@@ -0,0 +1,55 @@
+# Reusable light frame for Miro's "control/illum" topic.
+# The message and its backing array are allocated once. Every tick only the
+# brightness byte changes, which comes ready shifted into place from the
+# waveform's level table and is applied to all the LEDs in one numpy
+# operation, and nothing is published if it is the same as what Miro is
+# already showing.
+# rospy serializes the message inside publish(), so it is safe to keep
+# modifying the same message object afterwards.
+import numpy as np
+
+from light_trajectory import DEFAULT_RGB
+
+
+class MiroLightFrame(object):
+
+    def __init__(self, publisher, rgb=DEFAULT_RGB, msg_type=None):
+        """
+        @param publisher: rospy publisher of the illum topic
+        @param rgb: 0x00RRGGBB color of each LED, LEDs that are 0 are left off
+        @param msg_type: message class, defaults to std_msgs UInt32MultiArray
+        """
+        if msg_type is None:
+            from std_msgs.msg import UInt32MultiArray as msg_type
+        self.publisher = publisher
+        self.rgb = np.array(rgb, 'uint32')
+        self.lit = self.rgb != 0
+        self.data = np.zeros(len(self.rgb), 'uint32')
+        self.msg = msg_type()
+        self.msg.data = self.data
+        self.level = None        # brightness word currently on the robot
+        self.published = 0
+        self.skipped = 0
+
+    def show(self, level):
+        """
+        Set all the LEDs to a brightness and publish if it changed
+        @param level: uint32 with the brightness byte in the top 8 bits, see Waveform.level()
+        @return: True if a frame was published
+        """
+        if level == self.level:
+            self.skipped += 1
+            return False
+        np.bitwise_or(self.rgb, level, out=self.data, where=self.lit)
+        self.publisher.publish(self.msg)
+        self.level = level
+        self.published += 1
+        return True
+
+    def off(self):
+        """
+        Switch all the LEDs off
+        """
+        self.data.fill(0)
+        self.publisher.publish(self.msg)
+        self.level = None
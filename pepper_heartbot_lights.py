@@ -1,134 +1,292 @@
-import math
 import numpy as np
-import os
 import time
-import sys
-from datetime import datetime
 
 from naoqi import ALProxy
+from tick_scheduler import TickScheduler, monotonic
+from telemetry import SOURCE_PEPPER, SOURCE_PLL
+from beat_pll import BeatPLL
+from breathing import AMPLITUDE, FIXED_BPM, MIN_INTERVAL, THRESHOLD, BreathTempo, breathing_worker
+from actuation_latency import ActuationLatency
+from hr_sources import FileHeartRateSource
+from instrumentation import METRICS
+from light_trajectory import ASYNC_FACTOR, advance_phase, pepper_window, robot_rate
+from waveforms import get_waveform
 
 
 ROBOT_IP = '192.168.1.193'
 #ROBOT_IP = '192.168.1.163'
 #ROBOT_IP = '192.168.1.162'
 
+# "window" led mode: instead of an intensity RPC every tick send the robot a
+# timed fade of the next WINDOW_LENGTH seconds and only refresh it when the
+# heart rate changes or the fade is about to run out
+WINDOW_LENGTH = 2.0     # seconds of light queued on the robot
+WINDOW_STEP = 0.1       # seconds between fade keyframes, the robot interpolates in between
+WINDOW_REFRESH = 0.5    # send a new window when less than this is left
+# the fades are posted without waiting for the robot, so in window mode the
+# latency is measured with a blocking call every PROBE_INTERVAL seconds instead
+PROBE_INTERVAL = 2.0
+
 
 class PepperHandler(object):
-    __instance = None
-    
-    @staticmethod 
-    def getInstance(hr_reader=None, asynchMode=False, logger=None):
-       """ Static access method. To create singleton handler """
-       if PepperHandler.__instance == None:
-          # Create new
-          PepperHandler(hr_reader, asynchMode, logger)
-          
-       return PepperHandler.__instance
-          
     
-    def __init__(self, hr_reader, asynchMode, logger):
+    def __init__(self, hr_reader=None, asynchMode=False, logger=None, update_rate=20.0, led_mode="tick", telemetry=None,
+                 sync_mode="rate", robot_ip=ROBOT_IP, connect=True, waveform="cosine", breathing="fixed",
+                 breath_threshold=THRESHOLD, breath_interval=MIN_INTERVAL, actuation_offset=0.0):
+        
+        super(PepperHandler, self).__init__()
+        self.robot_ip = robot_ip
+        self.name = "Pepper %s" % robot_ip
+        self.headLockPitch = None
+        self.headLockYaw = None
+        
+        self.heart_rate = 60.0/60.0    # 60 beats per second
+        # Without a reader fall back to the heart rate written in ./heartRate.txt
+        self.hr_reader = hr_reader if hr_reader else FileHeartRateSource()
+        # New heart rate samples of the reader, only polled once a tick
+        self.hr_samples = self.hr_reader.subscribe()
+        self.asynchMode = asynchMode
+        if self.asynchMode:
+            self.heart_rate = self.heart_rate * ASYNC_FACTOR
+        
+        self.logger = logger
+        self.update_rate = update_rate    # light updates per second
+        self.led_mode = led_mode          # "tick" or "window"
+        self.fade_task = None             # naoqi task id of the queued fade window
+        # per tick heart rate, phase and brightness go to telemetry rather than the log
+        self.telemetry = telemetry.channel(SOURCE_PEPPER, self.name) if telemetry else None
+        # "rate" integrates the heart rate, "beat" locks the light phase on the beats themselves
+        self.sync_mode = sync_mode
+        self.pll = BeatPLL(rate_factor=ASYNC_FACTOR if asynchMode else 1.0) if sync_mode == "beat" else None
+        self.pll_telemetry = telemetry.channel(SOURCE_PLL, "%s pll" % self.name) if telemetry and self.pll else None
+        # shape of the pulse, looked up by phase every tick
+        self.waveform = get_waveform(waveform)
+        # "fixed" breathing tempo, or following the heart rate ("hr") or the breathing ("resp")
+        self.breath = None
+        if breathing != "fixed":
+            self.breath = BreathTempo(breathing, ASYNC_FACTOR if asynchMode else 1.0, breath_threshold,
+                                      breath_interval)
+        self.breath_worker = None
+        # ALLeds calls block for the round trip to the robot, the offset is whatever the leds add to it
+        self.actuation = ActuationLatency(round_trip=True, offset=actuation_offset)
+        # stage timing, no-ops unless instrumentation is on
+        self.update_stage = METRICS.stage("%s update_heart_rate" % self.name)
+        self.phase_stage = METRICS.stage("%s phase" % self.name)
+        self.send_stage = METRICS.stage("%s ALLeds" % self.name)
+        if connect:
+            self.connect()
+        
+    def connect(self):
+        """
+        Connect to the robot, wake it up and set up the heart leds. Takes a few
+        seconds, so the session does it while the strap is connecting
+        """
+        self.motion_handler = ALProxy("ALMotion", self.robot_ip, 9559)
+        self.motion_handler.wakeUp()
+        self.basic_awareness = ALProxy("ALBasicAwareness", self.robot_ip, 9559)
+        self.basic_awareness.stopAwareness()
+        self.motion_handler.setBreathConfig([['Bpm', FIXED_BPM], ['Amplitude', AMPLITUDE]])
+        self.motion_handler.setBreathEnabled ('Body', False)
+        self.motion_handler.setBreathEnabled ('Arms', True)
+        # The Leds we want to use for heart beat display            
+        # Create a new group
+        heart_led_group = [# Ear Led
+                            "Ears/Led/Right/0Deg/Actuator/Value",
+                            "Ears/Led/Left/0Deg/Actuator/Value",
+                            "Ears/Led/Right/36Deg/Actuator/Value",
+                            "Ears/Led/Left/36Deg/Actuator/Value",
+                            "Ears/Led/Right/72Deg/Actuator/Value",
+                            "Ears/Led/Left/72Deg/Actuator/Value",
+                            "Ears/Led/Right/108Deg/Actuator/Value",
+                            "Ears/Led/Left/108Deg/Actuator/Value",
+                            "Ears/Led/Right/144Deg/Actuator/Value",
+                            "Ears/Led/Left/144Deg/Actuator/Value",
+                            "Ears/Led/Right/180Deg/Actuator/Value",
+                            "Ears/Led/Left/180Deg/Actuator/Value",
+                            "Ears/Led/Right/216Deg/Actuator/Value",
+                            "Ears/Led/Left/216Deg/Actuator/Value",
+                            "Ears/Led/Right/252Deg/Actuator/Value",
+                            "Ears/Led/Left/252Deg/Actuator/Value",
+                            "Ears/Led/Right/288Deg/Actuator/Value",
+                            "Ears/Led/Left/288Deg/Actuator/Value",
+                            "Ears/Led/Right/324Deg/Actuator/Value",
+                            "Ears/Led/Left/324Deg/Actuator/Value",
+                            #Shoulder Leds
+                            "ChestBoard/Led/Blue/Actuator/Value",
+                            #"ChestBoard/Led/Green/Actuator/Value",
+                            #"ChestBoard/Led/Red/Actuator/Value"
+                            ]
+        shoulder_led_group = [#Shoulder Leds
+                              "ChestBoard/Led/Blue/Actuator/Value",
+                              "ChestBoard/Led/Green/Actuator/Value",
+                              "ChestBoard/Led/Red/Actuator/Value"
+                            ]
+        
+        self.leds = ALProxy("ALLeds", self.robot_ip, 9559)
+        self.leds.createGroup("HeartLeds",heart_led_group)
+        self.leds.createGroup("ShoulderLeds",shoulder_led_group)
+        # Switch the new group on
+        self.leds.off("ShoulderLeds")
+        self.leds.on("HeartLeds")
         
-        if PepperHandler.__instance != None:
-            raise Exception("This class is a singleton!")
-        else:
-            PepperHandler.__instance = self
-            super(PepperHandler, self).__init__()
-            self.motion_handler = ALProxy("ALMotion", ROBOT_IP, 9559)
-            self.motion_handler.wakeUp()
-            self.basic_awareness = ALProxy("ALBasicAwareness", ROBOT_IP, 9559)
-            self.basic_awareness.stopAwareness()
-            self.motion_handler.setBreathConfig([['Bpm', 2.0], ['Amplitude', 1.0]])
-            self.motion_handler.setBreathEnabled ('Body', False)
-            self.motion_handler.setBreathEnabled ('Arms', True)
-            self.headLockPitch = None
-            self.headLockYaw = None
-            
-            self.heart_rate = 60.0/60.0    # 60 beats per second
-            self.hr_reader = hr_reader 
-            self.asynchMode = asynchMode
-            if self.asynchMode:
-                self.heart_rate = self.heart_rate * 0.8 
-            
-            self.logger = logger
-            # The Leds we want to use for heart beat display            
-            # Create a new group
-            heart_led_group = [# Ear Led
-                                "Ears/Led/Right/0Deg/Actuator/Value",
-                                "Ears/Led/Left/0Deg/Actuator/Value",
-                                "Ears/Led/Right/36Deg/Actuator/Value",
-                                "Ears/Led/Left/36Deg/Actuator/Value",
-                                "Ears/Led/Right/72Deg/Actuator/Value",
-                                "Ears/Led/Left/72Deg/Actuator/Value",
-                                "Ears/Led/Right/108Deg/Actuator/Value",
-                                "Ears/Led/Left/108Deg/Actuator/Value",
-                                "Ears/Led/Right/144Deg/Actuator/Value",
-                                "Ears/Led/Left/144Deg/Actuator/Value",
-                                "Ears/Led/Right/180Deg/Actuator/Value",
-                                "Ears/Led/Left/180Deg/Actuator/Value",
-                                "Ears/Led/Right/216Deg/Actuator/Value",
-                                "Ears/Led/Left/216Deg/Actuator/Value",
-                                "Ears/Led/Right/252Deg/Actuator/Value",
-                                "Ears/Led/Left/252Deg/Actuator/Value",
-                                "Ears/Led/Right/288Deg/Actuator/Value",
-                                "Ears/Led/Left/288Deg/Actuator/Value",
-                                "Ears/Led/Right/324Deg/Actuator/Value",
-                                "Ears/Led/Left/324Deg/Actuator/Value",
-                                #Shoulder Leds
-                                "ChestBoard/Led/Blue/Actuator/Value",
-                                #"ChestBoard/Led/Green/Actuator/Value",
-                                #"ChestBoard/Led/Red/Actuator/Value"
-                                ]
-            shoulder_led_group = [#Shoulder Leds
-                                  "ChestBoard/Led/Blue/Actuator/Value",
-                                  "ChestBoard/Led/Green/Actuator/Value",
-                                  "ChestBoard/Led/Red/Actuator/Value"
-                                ]
-            
-            self.leds = ALProxy("ALLeds",ROBOT_IP, 9559)
-            self.leds.createGroup("HeartLeds",heart_led_group)
-            self.leds.createGroup("ShoulderLeds",shoulder_led_group)
-            # Switch the new group on
-            self.leds.off("ShoulderLeds")
-            self.leds.on("HeartLeds")
-            
     def update_heart_rate(self):
-        if self.hr_reader and not self.asynchMode:
-            rate = self.hr_reader.heartRate
-            updated_rate = float(rate)/60.0
+        # Nothing to do until the reader publishes a new sample
+        sample = self.hr_samples.poll()
+        if sample is None:
+            return
+        if self.breath:
+            self.breath.add_sample(sample)
+        if self.pll:
+            for error in self.pll.add_sample(sample):
+                if self.pll_telemetry:
+                    self.pll_telemetry.record(60.0 / self.pll.period, error)
+        rate = sample.heart_rate
+        if not self.asynchMode:
+            updated_rate = robot_rate(float(rate))
             #
             if updated_rate > 0.01 and self.heart_rate != updated_rate:
                 print("Updating robot rate to  %f bps" % updated_rate)
                 self.heart_rate = updated_rate
                 if self.logger:
                     self.logger.info("Pepper heart_rate updated to : %f beats per second" % self.heart_rate)
-        elif self.hr_reader and self.asynchMode:
+        else:
             # a quarter rate for asynch
-            rate = self.hr_reader.heartRate
-            updated_rate = (float(rate) * 0.8)/60.0
+            updated_rate = robot_rate(float(rate), asynchMode=True)
             
             if updated_rate > 0.01 and self.heart_rate != updated_rate:
                 print("Updating robot asynchronous rate to  %f bps" % updated_rate)
                 self.heart_rate = updated_rate
                 if self.logger:
                     self.logger.info("Pepper asynchronous heart_rate updated to : %f beats per second" % self.heart_rate)
-        else:
-            # Read from file
-            hr_file = "./heartRate.txt"
-            if os.path.isfile(hr_file):
-                if self.logger:
-                    self.logger.info("Updating heart_rate from file")
-                f = hr_file.open()
-                rate = int(f.readline())
-                updated_rate = float(rate)/60.0
-                if updated_rate > 0.01 and self.heart_rate != updated_rate:
-                    print("Updating robot rate to  %f bps" % updated_rate)
-                    self.heart_rate = updated_rate
-                    if self.logger:
-                       self.logger.info("Pepper heart_rate updated to : %f beats per second" % self.heart_rate)
     
     
         
 
+    def send_fade_window(self, phase, f_pulse):
+        """
+        Queue the next WINDOW_LENGTH seconds of pulsing on the robot as one fade
+        @param phase: current pulse phase
+        @param f_pulse: pulse frequency to extrapolate with
+        @return: monotonic time at which the queued fade runs out
+        """
+        steps = np.arange(1, int(round(WINDOW_LENGTH / WINDOW_STEP)) + 1) * WINDOW_STEP
+        mags = pepper_window(phase, 2.0 * f_pulse, steps, self.waveform)
+        # same level on red, green and blue, single colour leds pick theirs out
+        rgb = (mags * 0xFF).astype(int) * 0x010101
+        if self.fade_task:
+            self.leds.stop(self.fade_task)
+        self.fade_task = self.leds.post.fadeListRGB("HeartLeds", rgb.tolist(), steps.tolist())
+        return monotonic() + WINDOW_LENGTH
+
+    def probe_actuation(self, queued=0.0):
+        """
+        Time a blocking call to ALLeds for the actuation latency estimate
+        @param queued: seconds the command sent with it waited after step()
+        """
+        started = monotonic()
+        self.leds.getIntensity("HeartLeds")
+        self.actuation.add(monotonic() - started, queued)
+        self.next_probe = monotonic() + PROBE_INTERVAL
+
+    def start_lights(self):
+        """
+        Start the pulse from the beginning
+        """
+        self.phase = 0.0
+        self.window_rate = None
+        self.window_end = 0.0
+        self.next_probe = 0.0
+        if self.breath and self.breath_worker is None:
+            # tempo changes go out from a thread of their own
+            self.breath_worker = breathing_worker(self.motion_handler, self.name, self.logger)
+
+    def step(self, now, phase_time):
+        """
+        Advance the pulse by one tick. Only works out what to send, the robot
+        is not called so this never blocks
+        @param now: monotonic time of the tick
+        @param phase_time: seconds since the previous tick
+        @return: command for send(), stamped with the time it was worked out, or None if the robot is
+                 already showing the right thing
+        """
+        # Get an update of heart rate from the reader
+        started = self.update_stage.begin()
+        self.update_heart_rate()
+        self.update_stage.end(started)
+        
+        started = self.phase_stage.begin()
+        if self.pll:
+            # phase straight from the predicted beats
+            f_pulse = self.pll.pulse_frequency()
+            self.phase = self.pll.light_phase(now)
+        else:
+            # update pulse rate for the robot
+            f_pulse = self.heart_rate/2.0
+            
+            # calculate intesity phase
+            # increment pulse phase by current rate
+            self.phase = advance_phase(self.phase, phase_time, self.heart_rate)
+
+        # run ahead by the time the command takes to show on the robot
+        shown_phase = self.phase + self.actuation.phase_lead(f_pulse)
+
+        # magnitude
+        mag = self.waveform.brightness(shown_phase)
+        
+        if self.telemetry:
+            self.telemetry.record(self.heart_rate * 60.0, shown_phase, mag)
+        self.phase_stage.end(started)
+
+        if self.breath:
+            bpm = self.breath.due(now)
+            if bpm is not None:
+                self.breath_worker.post(bpm)
+
+        if self.led_mode == "window":
+            # only talk to the robot when the queued fade no longer fits
+            if f_pulse != self.window_rate or now >= self.window_end - WINDOW_REFRESH:
+                self.window_rate = f_pulse
+                self.window_end = now + WINDOW_LENGTH
+                return ("window", shown_phase, f_pulse, monotonic())
+            return None
+        return ("intensity", mag, monotonic())
+
+    def send(self, command):
+        """
+        Send a command from step() to the robot, blocks for the round trip
+        """
+        sent = self.send_stage.begin()
+        # how long it sat in the mailbox while the robot was busy
+        queued = monotonic() - command[-1]
+        if command[0] == "window":
+            self.send_fade_window(command[1], command[2])
+            if monotonic() >= self.next_probe:
+                self.probe_actuation(queued)
+        else:
+            started = monotonic()
+            self.leds.setIntensity("HeartLeds", command[1])
+            self.actuation.add(monotonic() - started, queued)
+        self.send_stage.end(sent)
+
+    def stop_lights(self):
+        # Switch off the lights
+        if self.fade_task:
+            self.leds.stop(self.fade_task)
+            self.fade_task = None
+        self.leds.off("HeartLeds")
+        if self.breath_worker:
+            self.breath_worker.stop(5.0)
+            self.breath_worker = None
+
+    def log_summary(self):
+        if self.logger:
+            self.logger.info("%s actuation latency: %s" % (self.name, self.actuation))
+            if self.breath:
+                self.logger.info("%s breathing (%s) tempo changes: %d, last %s bpm"
+                                 % (self.name, self.breath.mode, self.breath.updates, self.breath.sent))
+            if self.pll:
+                self.logger.info("%s beat lock: %s" % (self.name, self.pll))
+
     def synch_hr(self):
         
         # wait for connection
@@ -137,50 +295,46 @@ class PepperHandler(object):
         self.set_active = True
 
         # params
-        T = .05 # update time
-        phase = 0.0 
-        phase_time = T
-        last_time = None
+        scheduler = self.scheduler = TickScheduler(self.update_rate)
+        lateness_stage = METRICS.stage("%s loop lateness" % self.name)
+        phase_time = scheduler.period
+        self.start_lights()
+        scheduler.start()
         
         try:
             # loop
             while self.set_active:
-                
-                # Get an update of heart rate from the reader
-                self.update_heart_rate()
-                
-                # update pulse rate for the robot
-                if self.logger:
-                    self.logger.info("Pepper current heart_rate: %f beats per seond" % self.heart_rate)
-                f_pulse = self.heart_rate/2.0
-                
-                # calculate intesity phase
-                this_time = datetime.now()
-                if last_time:
-                    phase_time = (this_time - last_time).total_seconds()
-                # increment pulse phase by current rate
-                phase += phase_time * f_pulse * 2 * np.pi
-                last_time = this_time
-    
-                # magnitude
-                mag = np.cos(phase) * 0.5 + 0.5
-                
-                if self.logger:
-                    self.logger.info("Phase: %f \t Brightness: %f" %(np.degrees(phase), mag))
-    
-                
-                # fix up the brightness
-                self.leds.setIntensity("HeartLeds", mag)
+                command = self.step(scheduler.last_tick, phase_time)
+                if command is not None:
+                    self.send(command)
     
-                # sleep
-                time.sleep(T)
+                # sleep until the next tick is due
+                phase_time = scheduler.wait()
+                lateness_stage.add(scheduler.last_lateness)
                 
         finally:
-            # Switch off the lights
-            self.leds.off("HeartLeds")
+            self.stop_lights()
+            if self.logger:
+                self.logger.info("%s light loop timing: %s" % (self.name, scheduler.stats))
+            self.log_summary()
+
+
+def create_robot(config, hr_source, logger=None, telemetry=None, asynchMode=False, sync_mode="rate"):
+    """
+    Backend entry point for robot_backends, the connection is left to the caller
+    @param config: session entry of the robot, "ip" (or "address"), "led_mode", "waveform" and
+                   "breathing" with "breath_threshold" and "breath_interval" and "actuation_offset",
+                   seconds this Pepper's leds add to the measured delay
+    """
+    robot_ip = config.get("ip", config.get("address", ROBOT_IP))
+    return PepperHandler(hr_source, asynchMode, logger, led_mode=config.get("led_mode", "tick"), telemetry=telemetry,
+                         sync_mode=sync_mode, robot_ip=robot_ip, connect=False, waveform=config.get("waveform", "cosine"),
+                         breathing=config.get("breathing", "fixed"),
+                         breath_threshold=config.get("breath_threshold", THRESHOLD),
+                         breath_interval=config.get("breath_interval", MIN_INTERVAL),
+                         actuation_offset=config.get("actuation_offset", 0.0))
 
 
 if __name__ =='__main__':
-    main_robot = PepperHandler.getInstance(hr_reader=None, logger=None)
+    main_robot = PepperHandler()
     main_robot.synch_hr()
-                        
\ No newline at end of file
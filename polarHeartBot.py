@@ -1,27 +1,28 @@
 # Using Hexiwear with Python
-import pexpect
 import time
 import logging
 import sys
 import os
-import string
-from exceptions import Exception
 
 from datetime import datetime
 from HR_reader import HeartBeat_BLE
+from hr_bus import BUS_PATH, BusWriter
+from hr_sources import BusSource, NotificationRecorder, ReplaySource, SyntheticSource
+from hrv import HRVMonitor
+from instrumentation import METRICS, SOCKET_PATH, MetricsReporter, MetricsServer
+from telemetry import Telemetry
+from robot_backends import parse_robots
+from robot_fanout import RobotFanout, load_session
+from session_archive import SessionArchive
+from startup_timer import StartupTimer
 
 
 
-MAX_CONN_RETRY = 5
-MAX_NULL_HR = 10
+STARTUP_TIMEOUT = 60.0    # seconds to wait for the first heart rate notification
+# Used when no robots are given on the command line or in a session file
 WITH_ROBOT=True       # without robot to test the polar OH only
 ROBOT_TYPE = "Miro"   # Set this to Pepper or Miro
 
-if WITH_ROBOT and ROBOT_TYPE=="Miro":
-    from miro_heartbot_lights import setup_heartbot
-elif WITH_ROBOT and ROBOT_TYPE=="Pepper":
-    from pepper_heartbot_lights import PepperHandler
-
 def add_logger(log_path, participantNumber):
     
     logger = logging.getLogger("HeartBot")
@@ -30,7 +31,7 @@ def add_logger(log_path, participantNumber):
     filePath = os.path.join(log_path, filename)
     
     # create error file handler and set level to info
-    handler = logging.FileHandler(os.path.join(log_path, filename),"w", encoding=None, delay="true")
+    handler = logging.FileHandler(filePath,"w", encoding=None, delay="true")
     handler.setLevel(logging.INFO)
     formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
     handler.setFormatter(formatter)
@@ -39,72 +40,121 @@ def add_logger(log_path, participantNumber):
     return logger
 
 
+def add_telemetry(log_path):
+    """
+    Start the binary telemetry writer for the per tick heart rate/phase/brightness
+    records. The file sits next to the log with the same time stamp
+    """
+    filename = "HeartBot_%s.tlm" % (datetime.now().strftime("%H%M%S_%d%m%Y"))
+    telemetry = Telemetry(os.path.join(log_path, filename))
+    telemetry.start()
+    return telemetry
+
 
-def main(doAsynch, logger):
-    max_retry = MAX_CONN_RETRY
+
+def main(doAsynch, logger, telemetry=None, hr_source=None, record_path=None, participant=None, sync_mode="rate",
+         session=None, startup=None, archive=None, bus=None, strap=None):
+    """
+    Relay the heart rate to the robot
+    @param hr_source: heart rate source to use instead of the polarOH e.g. a ReplaySource
+    @param record_path: if given the raw heart rate notifications are recorded to this file
+    @param participant: participant number for the HRV summary
+    @param sync_mode: "rate" to pulse at the heart rate, "beat" to also lock the pulses onto the beats
+    @param session: session configuration with the robots to drive (see robot_fanout.py),
+                    by default the single robot of ROBOT_TYPE
+    @param startup: StartupTimer started at launch, the startup steps are marked in it
+    @param archive: SessionWriter to archive the heart rate samples in
+    @param bus: BusWriter to publish the heart rate notifications on for other processes
+    @param strap: mac address or name of the strap to read, by default the one used last (see strap_cache.py)
+    """
+    if startup is None:
+        startup = StartupTimer(logger)
     do_relay = False
     hr_polarOH = None
     heart_robot = None
+    recorder = None
+    hrv_monitor = None
     try: 
-        # Run gatttool interactively.
-        hr_polarOH = HeartBeat_BLE(logger)
-        if WITH_ROBOT:
-            if ROBOT_TYPE == "Pepper":
-                heart_robot = PepperHandler.getInstance(hr_polarOH, doAsynch, logger)
-            elif ROBOT_TYPE == "Miro":
-                heart_robot = setup_heartbot("miro", hr_polarOH, doAsynch, logger)
-            else: 
-                raise Exception("Do not recognize robot: %s" % ROBOT_TYPE)
+        if hr_source is None:
+            # Run gatttool interactively.
+            hr_polarOH = HeartBeat_BLE(logger, device=strap, telemetry=telemetry)
+            hr_source = hr_polarOH
+        if record_path:
+            recorder = NotificationRecorder(hr_source, record_path)
+        # live HRV from the RR-intervals, summarised at the end of the session
+        hrv_monitor = HRVMonitor(hr_source, participant=participant)
+        if archive:
+            archive.attach(hr_source)
+        if bus:
+            bus.attach(hr_source)
+        if session is None:
+            session = {"robots": [{"type": ROBOT_TYPE}] if WITH_ROBOT else []}
+        if session.get("robots"):
+            # one light loop for all the robots
+            heart_robot = RobotFanout.from_session(session, hr_source, logger, telemetry, doAsynch, sync_mode,
+                                                   startup)
+            startup.mark("robot backends loaded")
+            if archive:
+                archive.set_robots([robot.name for robot in heart_robot.robots], sync_mode)
+        
+        if hr_polarOH is None:
+            # Recorded or generated heart rate, nothing to connect to
+            logger.info("Using heart rate source %s" % hr_source.__class__.__name__)
+            hr_source.start()
+            do_relay = True
         
         #-------------------------------------------------------
         # Setting up connection
-        while max_retry >= 0:
-            try:
-                # try connecting to the heart-rate tool
-                index = hr_polarOH.connect()
-                if index > 0:
-                    #connection was successful 
-                    hr_polarOH.switch_HR_notifications(True)
-                    hr_polarOH.start()
-                    do_relay = True
-                    break
-            except pexpect.TIMEOUT:
-                pass
-            
-            logger.info("Startup connection failure")
-            # some issue let's retry
-            if max_retry > 0:
-                print("Connection failed. Will retry %d more times" % max_retry)
-                max_retry -= 1
-                
-                # send peripheral a disconnect signal and sleep and retry
-                hr_polarOH.disconnect()
-                time.sleep(0.5)
-               
+        if hr_polarOH:
+            # The reader connects, and reconnects after any dropout, with backoff
+            # between the attempts, all in its own thread
+            hr_polarOH.start()
+        if heart_robot:
+            # Connect to and wake up the robots while the strap is connecting
+            heart_robot.connect()
+        if hr_polarOH:
+            if hr_polarOH.wait_streaming(STARTUP_TIMEOUT):
+                startup.mark("heart rate notifications streaming")
+                do_relay = True
             else:
-                # No more tryies left 
-                max_retry -= 1
+                logger.info("Startup connection failure")
                 print("Connection failed. Please restart bluetooth on measurement tool")
         #------------------------------------------------------
         # Now for robot to read the heart_rate
-        max_retry = MAX_NULL_HR
         if do_relay:
             print("Starting heart-beat relay")
             logger.info("Starting heart-beat relay")
             if heart_robot:
                 print("Starting heart-beat relay with robot")
                 heart_robot.synch_hr()
+            elif bus:
+                # Only publishing for the robot processes, keep going until stopped
+                try:
+                    while True:
+                        print(hr_source.heartRate)
+                        time.sleep(2)
+                except KeyboardInterrupt:
+                    pass
             else:
                 for i in range(10):
-                    print hr_polarOH.heartRate
+                    print(hr_source.heartRate)
                     time.sleep(2)
             
     
     finally:   
-    	print("Closing connection to heart-rate tool")
-    	logger.info("Closing connection to heart-rate tool")
-    	if hr_polarOH:
-    	    hr_polarOH.stop() 
+        print("Closing connection to heart-rate tool")
+        logger.info("Closing connection to heart-rate tool")
+        if hr_polarOH:
+            hr_polarOH.stop() 
+            logger.info("Strap connection: %s" % hr_polarOH.connection.metrics)
+        elif hr_source:
+            hr_source.stop()
+        if recorder:
+            recorder.close()
+        if bus:
+            bus.close()
+        if hrv_monitor:
+            logger.info("HRV summary: %s" % hrv_monitor.summary())
             
         if heart_robot:
             heart_robot.set_active=False
@@ -114,18 +164,91 @@ if __name__ =='__main__':
     if len(sys.argv) < 2:
         print("Please make sure you have provided the participant number")
     else:
+        startup = StartupTimer()
         asynchMode = False
+        sync_mode = "rate"
+        session = None
+        robots = None
+        hr_source = None
+        bus = None
+        metrics_path = None
+        strap = None
+        speed = None
         participantNumber = int(sys.argv[1])
-        if len(sys.argv) == 3:
-            if string.lower(sys.argv[2]) == "async":
+        for arg in sys.argv[2:]:
+            if arg.lower() == "async":
                 asynchMode = True
+            elif arg.lower().startswith("replay="):
+                # Play back a recorded session instead of reading the strap
+                hr_source = ReplaySource(arg.split("=", 1)[1])
+            elif arg.lower().startswith("speed="):
+                # Play the recording N times faster, 0 for as fast as it goes
+                speed = float(arg.split("=", 1)[1])
+            elif arg.lower() == "synthetic":
+                hr_source = SyntheticSource()
+            elif arg.lower() == "bus" or arg.lower().startswith("bus="):
+                # Heart rate published by another process, see hr_bus.py
+                hr_source = BusSource(arg.split("=", 1)[1] if "=" in arg else BUS_PATH)
+            elif arg.lower() == "publish" or arg.lower().startswith("publish="):
+                # Publish the heart rate for robot processes, see hr_bus.py
+                bus = BusWriter(arg.split("=", 1)[1] if "=" in arg else BUS_PATH)
+            elif arg.lower().startswith("session="):
+                # Robots to drive, see robot_fanout.py
+                session = load_session(arg.split("=", 1)[1])
+            elif arg.lower().startswith("robot="):
+                # Robots to drive, type[@address],... or none
+                robots = parse_robots(arg.split("=", 1)[1])
+            elif arg.lower() == "metrics" or arg.lower().startswith("metrics="):
+                # Time the stages of the reader and the light loops, see instrumentation.py
+                metrics_path = arg.split("=", 1)[1] if "=" in arg else SOCKET_PATH
+            elif arg.lower().startswith("strap="):
+                # Mac address or name of the strap, e.g. one per participant when several sessions run at once
+                strap = arg.split("=", 1)[1]
+            elif arg.lower() == "beat":
+                # Lock the light pulses onto the participant's beats
+                sync_mode = "beat"
+        if speed is not None:
+            if not isinstance(hr_source, ReplaySource):
+                print("speed= only applies to replay=")
+                sys.exit(1)
+            hr_source.speed = speed
+        if robots is not None:
+            session = dict(session or {}, robots=robots)
         log_path = './Logs'
         log_path = os.path.join(log_path, 'P%d' % participantNumber)
         if not os.path.isdir(log_path):
-            os.mkdir(log_path)
+            os.makedirs(log_path)
         logger = add_logger(log_path, None)
+        startup.logger = logger
         logger.info("Participant Number %d" % participantNumber)
-        main(asynchMode, logger)
+        telemetry = add_telemetry(log_path)
+        # typed columns of the session for analysis, next to the log. The log is its source, so
+        # log_import.py knows the session is archived already
+        archive = SessionArchive().create(participantNumber, "async" if asynchMode else "sync", sync_mode=sync_mode,
+                                          source=logger.handlers[-1].baseFilename)
+        telemetry.add_sink(archive.add_telemetry)
+        metrics_server = None
+        metrics_reporter = None
+        if metrics_path:
+            # before main so the reader and the robots pick up real stages
+            METRICS.enable()
+            metrics_server = MetricsServer(path=metrics_path)
+            metrics_server.start()
+            metrics_reporter = MetricsReporter(logger)
+            metrics_reporter.start()
+        record_path = os.path.join(log_path, "HeartBot_%s.hrr" % (datetime.now().strftime("%H%M%S_%d%m%Y")))
+        try:
+            main(asynchMode, logger, telemetry, hr_source, record_path, participantNumber, sync_mode, session, startup,
+                 archive, bus, strap)
+        finally:
+            if metrics_server:
+                metrics_server.stop()
+                metrics_reporter.stop()
+                metrics_reporter.report()
+            telemetry.stop()
+            # which telemetry source is which robot
+            archive.set_sources(telemetry.sources)
+            archive.close()
     
 
     
@@ -0,0 +1,71 @@
+# Robot backends by name. The module of a backend is only imported when a
+# robot of that type is asked for, so a Miro session never loads naoqi and a
+# Pepper session never loads rospy. A backend module provides
+#     create_robot(config, hr_source, logger, telemetry, asynchMode, sync_mode)
+# returning a robot handler that is not connected yet: its connect() is called
+# separately so the robots can connect while the strap does.
+#
+# On the command line robots are given as type[@address],... where the
+# address is the IP of a Pepper or the name of a Miro, e.g.
+#     robot=pepper@192.168.1.163,miro
+import importlib
+
+BACKENDS = {
+    "pepper": "pepper_heartbot_lights",
+    "miro": "miro_heartbot_lights",
+}
+
+
+def register_backend(name, module_name):
+    """
+    Make a robot type available
+    @param module_name: module with the create_robot entry point, imported when first used
+    """
+    BACKENDS[name.lower()] = module_name
+
+
+def backend_names():
+    return sorted(BACKENDS)
+
+
+def load_backend(name):
+    """
+    @return: the module of the robot type, imported now if it was not yet
+    """
+    try:
+        module_name = BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError("Do not recognize robot: %s (known: %s)" % (name, ", ".join(backend_names())))
+    return importlib.import_module(module_name)
+
+
+def create_robot(config, hr_source, logger=None, telemetry=None, asynchMode=False, sync_mode="rate"):
+    """
+    Create one robot handler from its session entry, without connecting to it
+    @param config: dict with "type" and the options of the robot
+    @param asynchMode, sync_mode: used when the entry does not set "async"/"sync_mode"
+    """
+    backend = load_backend(config["type"])
+    return backend.create_robot(config, hr_source, logger, telemetry, config.get("async", asynchMode),
+                                config.get("sync_mode", sync_mode))
+
+
+def parse_robots(text):
+    """
+    "pepper@192.168.1.163,miro" -> [{"type": "pepper", "address": "192.168.1.163"}, {"type": "miro"}]
+    "none" -> []
+    """
+    robots = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item or item.lower() == "none":
+            continue
+        robot_type, _, address = item.partition("@")
+        config = {"type": robot_type.lower()}
+        if address:
+            config["address"] = address
+        if config["type"] not in BACKENDS:
+            # fail on a typo before anything is started
+            raise ValueError("Do not recognize robot: %s (known: %s)" % (robot_type, ", ".join(backend_names())))
+        robots.append(config)
+    return robots
@@ -0,0 +1,242 @@
+# Drive any number of robots from one heart rate source.
+# One scheduler thread steps every robot's pulse each tick, which only works
+# out the light command and never talks to the robot. The commands are handed
+# to a worker thread per robot through a single slot mailbox: if the robot is
+# still busy with the previous command the pending one is replaced by the
+# newer, so a slow robot falls behind on its own and the others (and the tick
+# rate) are not held up.
+#
+# The robots come from a session file (JSON), e.g.
+# {
+#     "update_rate": 20,
+#     "async": false,
+#     "sync_mode": "rate",
+#     "robots": [
+#         {"type": "pepper", "ip": "192.168.1.193", "led_mode": "window"},
+#         {"type": "miro", "name": "miro", "async": true, "waveform": "lubdub"}
+#     ]
+# }
+# "async" and "sync_mode" can be given for the whole session and overridden per robot.
+# The robot types are looked up in robot_backends.
+import json
+import threading
+
+from instrumentation import METRICS
+from robot_backends import create_robot
+from tick_scheduler import TickScheduler
+
+_CLOSED = object()
+
+
+def load_session(path):
+    """
+    @return: the session configuration in the file
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+class CommandMailbox(object):
+    """
+    Holds the latest command for a robot, a new command replaces one that was not taken yet
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._command = None
+        self._pending = False
+        self._closed = False
+        self.posted = 0
+        self.replaced = 0
+
+    def put(self, command):
+        with self._condition:
+            if self._pending:
+                self.replaced += 1
+            self._command = command
+            self._pending = True
+            self.posted += 1
+            self._condition.notify()
+
+    def take(self):
+        """
+        Block until there is a command
+        @return: the command, or _CLOSED once the mailbox is closed and empty
+        """
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return _CLOSED
+            command = self._command
+            self._command = None
+            self._pending = False
+            return command
+
+    def close(self):
+        """
+        Let the worker finish, after the command it has not taken yet
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+
+class RobotWorker(threading.Thread):
+    """
+    Sends the commands from a robot's mailbox to the robot
+    """
+
+    def __init__(self, robot, logger=None, startup=None):
+        """
+        @param startup: optional StartupTimer, marked when the first command went out
+        """
+        super(RobotWorker, self).__init__(name="robot-%s" % getattr(robot, "name", "robot"))
+        self.daemon = True
+        self.robot = robot
+        self.logger = logger
+        self.startup = startup
+        self.mailbox = CommandMailbox()
+        self.sent = 0
+        self.errors = 0
+
+    def post(self, command):
+        self.mailbox.put(command)
+
+    def run(self):
+        while True:
+            command = self.mailbox.take()
+            if command is _CLOSED:
+                break
+            try:
+                self.robot.send(command)
+                self.sent += 1
+                if self.sent == 1 and self.startup:
+                    self.startup.mark("first pulse on %s" % self.robot.name)
+            except Exception as e:
+                # One failing call should not take the robot out for the rest of the session
+                self.errors += 1
+                if self.logger:
+                    self.logger.error("%s command failed: %s" % (self.robot.name, e))
+
+    def stop(self, timeout=None):
+        self.mailbox.close()
+        self.join(timeout)
+
+
+class RobotFanout(object):
+    """
+    Pulses the lights of several robots from one scheduler thread
+    """
+
+    def __init__(self, robots, update_rate=20.0, logger=None, startup=None):
+        """
+        @param robots: robot handlers, each with connect, start_lights, step, send, stop_lights and log_summary
+        @param update_rate: light updates per second, the same for all the robots
+        @param startup: optional StartupTimer to mark the connections and first pulses in
+        """
+        self.robots = list(robots)
+        self.update_rate = update_rate
+        self.logger = logger
+        self.startup = startup
+        self.set_active = False
+        self.scheduler = None
+        self.workers = []
+        self._thread = None
+
+    @classmethod
+    def from_session(cls, session, hr_source, logger=None, telemetry=None, asynchMode=False, sync_mode="rate",
+                     startup=None):
+        """
+        Create the robots of a session. They are not connected to yet, see connect()
+        @param session: session configuration, see the top of this file
+        @param asynchMode, sync_mode: defaults for the robots that do not set them
+        """
+        asynchMode = session.get("async", asynchMode)
+        sync_mode = session.get("sync_mode", sync_mode)
+        # each robot records its telemetry under sources of its own
+        robots = [create_robot(config, hr_source, logger, telemetry.robot(index) if telemetry else None, asynchMode,
+                               sync_mode)
+                  for index, config in enumerate(session.get("robots", []))]
+        return cls(robots, session.get("update_rate", 20.0), logger, startup)
+
+    def connect(self, timeout=None):
+        """
+        Connect to all the robots at the same time
+        @raise: the error of the first robot that failed to connect
+        """
+        errors = []
+
+        def connect_robot(robot):
+            try:
+                robot.connect()
+                if self.startup:
+                    self.startup.mark("%s connected" % robot.name)
+            except Exception as e:
+                errors.append((robot, e))
+        threads = [threading.Thread(target=connect_robot, args=(robot,), name="connect-%s" % robot.name)
+                   for robot in self.robots]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(timeout)
+        if errors:
+            robot, error = errors[0]
+            if self.logger:
+                self.logger.error("Could not connect to %s: %s" % (robot.name, error))
+            raise error
+
+    def synch_hr(self):
+        """
+        Run the light loop in the calling thread until set_active is cleared.
+        The robots have to be connected first
+        """
+        self.set_active = True
+
+        scheduler = self.scheduler = TickScheduler(self.update_rate)
+        tick_stage = METRICS.stage("light loop tick")
+        lateness_stage = METRICS.stage("light loop lateness")
+        self.workers = [RobotWorker(robot, self.logger, self.startup) for robot in self.robots]
+        for robot, worker in zip(self.robots, self.workers):
+            robot.start_lights()
+            worker.start()
+        phase_time = scheduler.period
+        scheduler.start()
+        try:
+            while self.set_active:
+                now = scheduler.last_tick
+                started = tick_stage.begin()
+                for worker in self.workers:
+                    command = worker.robot.step(now, phase_time)
+                    if command is not None:
+                        worker.post(command)
+                tick_stage.end(started)
+                phase_time = scheduler.wait()
+                lateness_stage.add(scheduler.last_lateness)
+        finally:
+            for worker in self.workers:
+                worker.stop(timeout=2.0)
+            for robot in self.robots:
+                robot.stop_lights()
+            if self.logger:
+                self.logger.info("Light loop timing: %s" % scheduler.stats)
+                for worker in self.workers:
+                    mailbox = worker.mailbox
+                    self.logger.info("%s commands sent: %d replaced while busy: %d failed: %d"
+                                     % (worker.robot.name, worker.sent, mailbox.replaced, worker.errors))
+            for robot in self.robots:
+                robot.log_summary()
+
+    def start(self):
+        """
+        Run the light loop in its own thread
+        """
+        self._thread = threading.Thread(target=self.synch_hr, name="robot-fanout")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self.set_active = False
+        if self._thread:
+            self._thread.join(timeout)
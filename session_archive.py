@@ -0,0 +1,344 @@
+# Columnar session archive.
+# Every session gets a directory with one raw little endian file per column
+# and a meta.json describing the columns and the session (participant, mode,
+# robots, time range). A small index.json at the top lists all the sessions so
+# analysis scripts can pick sessions without opening them, and any column can
+# be memory mapped straight from its file without parsing or copying.
+# Several processes can archive into the same root (see lab_supervisor.py):
+# the index is only changed holding a lock on index.json.lock.
+#
+#   <root>/index.json
+#   <root>/P<participant>/<session id>/meta.json
+#   <root>/P<participant>/<session id>/<table>.<column>.col
+#
+# Tables:
+#   samples    timestamp, seq, heart_rate              one row per heart rate notification, also
+#                                                      when the reader hands them on in batches
+#   rr         timestamp, interval                     one row per RR-interval (ms)
+#   telemetry  timestamp, source, heart_rate, phase, brightness
+#                                                      the telemetry records (see telemetry.py)
+# meta.json "sources" names the telemetry source of every robot, e.g.
+# {"3": "Pepper 192.168.1.193", "19": "Pepper 192.168.1.194"}.
+# Timestamps are time.time() seconds.
+#
+#   archive = SessionArchive()
+#   for entry in archive.sessions(participant=12, mode="async"):
+#       session = archive.open(entry)
+#       phase = session.column("telemetry", "phase")
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+import time
+
+import numpy as np
+
+from hr_measurement import decode_hr_measurement
+from telemetry import RECORD
+
+ARCHIVE_ROOT = os.path.join(".", "Logs", "archive")
+INDEX_FILE = "index.json"
+INDEX_LOCK_FILE = "index.json.lock"
+META_FILE = "meta.json"
+
+TABLES = {
+    "samples": [("timestamp", "<f8"), ("seq", "<u4"), ("heart_rate", "<u2")],
+    "rr": [("timestamp", "<f8"), ("interval", "<f4")],
+    "telemetry": [("timestamp", "<f8"), ("source", "u1"), ("heart_rate", "<f4"), ("phase", "<f8"),
+                  ("brightness", "<f4")],
+}
+# Layout of a telemetry.RECORD so a flushed block can be split into columns without unpacking
+TELEMETRY_RECORD = np.dtype([("timestamp", "<f8"), ("phase", "<f8"), ("heart_rate", "<f4"), ("brightness", "<f4"),
+                             ("source", "u1"), ("pad", "V7")])
+assert TELEMETRY_RECORD.itemsize == RECORD.size
+
+
+def _column_file(table, column):
+    return "%s.%s.col" % (table, column)
+
+
+def _write_json(path, data):
+    # write next to the file and rename so a reader never sees half a file,
+    # under a name of this process and thread so no other writer touches it
+    temp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+    with open(temp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(temp, path)
+
+
+class SessionWriter(object):
+    """
+    Appends the columns of one live session. Samples are buffered by whichever
+    thread produces them and written out by flush(), which the telemetry thread
+    calls through add_telemetry
+    """
+
+    def __init__(self, archive, participant, mode, robots=(), sync_mode="rate", started=None, source=None):
+        """
+        @param archive: SessionArchive the session belongs to
+        @param participant: participant number
+        @param mode: "sync" or "async"
+        @param robots: names of the robots driven in the session
+        @param started: start of the session (time.time() seconds), now if not given
+        @param source: log file of the session, recorded live or imported from it
+        """
+        self.archive = archive
+        started = time.time() if started is None else started
+        self.session_id = time.strftime("%Y%m%d_%H%M%S", time.localtime(started))
+        self.path = os.path.join(archive.root, "P%d" % participant, self.session_id)
+        count = 1
+        while os.path.exists(self.path):
+            # a second session started within the same second
+            count += 1
+            self.path = os.path.join(archive.root, "P%d" % participant, "%s_%d" % (self.session_id, count))
+        self.session_id = os.path.basename(self.path)
+        os.makedirs(self.path)
+        self.meta = {"id": self.session_id, "participant": participant, "mode": mode, "robots": list(robots),
+                     "sync_mode": sync_mode, "start": started, "end": None, "source": source,
+                     "path": os.path.relpath(self.path, archive.root), "tables": {}}
+        self._files = {}
+        for table, columns in TABLES.items():
+            self.meta["tables"][table] = {"rows": 0, "columns": dict(columns)}
+            for column, _ in columns:
+                self._files[table, column] = open(os.path.join(self.path, _column_file(table, column)), "wb")
+        self._pending = []
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.source = None
+        _write_json(os.path.join(self.path, META_FILE), self.meta)
+
+    def set_robots(self, robots, sync_mode=None):
+        self.meta["robots"] = list(robots)
+        if sync_mode is not None:
+            self.meta["sync_mode"] = sync_mode
+
+    def set_sources(self, sources):
+        """
+        @param sources: dict of telemetry source to the name of the robot (or reader) recording under it
+        """
+        self.meta["sources"] = dict((str(source), name) for source, name in sources.items())
+
+    def attach(self, source):
+        """
+        Archive every notification of a heart rate source. Its subscribers only get one sample for
+        the notifications that came in together, the archive keeps each of them
+        """
+        self.source = source
+        source.add_notification_listener(self.on_notification)
+
+    def on_notification(self, timestamp, payload):
+        measurement = decode_hr_measurement(payload)
+        with self._lock:
+            self._seq += 1
+            self._pending.append((timestamp, self._seq, measurement.heart_rate, measurement.rr_intervals))
+
+    def add_telemetry(self, data):
+        """
+        Telemetry sink, gets each block of records the telemetry thread flushes
+        """
+        records = np.frombuffer(data, dtype=TELEMETRY_RECORD)
+        self.append("telemetry", dict((column, records[column]) for column, _ in TABLES["telemetry"]))
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        self.append("samples", {
+            "timestamp": [p[0] for p in pending],
+            "seq": [p[1] for p in pending],
+            "heart_rate": [p[2] for p in pending],
+        })
+        rr_time = []
+        rr = []
+        for timestamp, _, _, intervals in pending:
+            rr_time.extend([timestamp] * len(intervals))
+            rr.extend(intervals)
+        if rr:
+            self.append("rr", {"timestamp": rr_time, "interval": rr})
+
+    def append(self, table, columns):
+        """
+        Append a block of rows
+        @param columns: dict of column name to the values of every column of the table
+        """
+        rows = 0
+        for column, dtype in TABLES[table]:
+            values = np.asarray(columns[column], dtype=dtype)
+            values.tofile(self._files[table, column])
+            rows = len(values)
+        self.meta["tables"][table]["rows"] += rows
+
+    def close(self, end=None, index=True):
+        """
+        Write out what is left, finish the meta data and add the session to the index
+        @param end: end of the session, now if not given
+        @param index: add the session to the index, leave it out when another process owns the index
+        """
+        if self.source is not None:
+            self.source.remove_notification_listener(self.on_notification)
+            self.source = None
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self.meta["end"] = time.time() if end is None else end
+        _write_json(os.path.join(self.path, META_FILE), self.meta)
+        if index:
+            self.archive.add_to_index(self.meta)
+
+
+class ArchivedSession(object):
+    """
+    Read access to one archived session
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+    def column(self, table, column):
+        """
+        @return: read only numpy array of the column, memory mapped from its file
+        """
+        dtype = np.dtype(self.meta["tables"][table]["columns"][column])
+        path = os.path.join(self.path, _column_file(table, column))
+        rows = os.path.getsize(path) // dtype.itemsize
+        if not rows:
+            # numpy can not map an empty file
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(rows,))
+
+    def table(self, table):
+        """
+        @return: dict of column name to memory mapped column
+        """
+        return dict((column, self.column(table, column)) for column in self.meta["tables"][table]["columns"])
+
+    def sources(self):
+        """
+        @return: dict of telemetry source to the name of the robot recording under it, empty for older sessions
+        """
+        return dict((int(source), name) for source, name in self.meta.get("sources", {}).items())
+
+    def telemetry(self, source):
+        """
+        @param source: telemetry source (see telemetry.robot_source), or the name of the robot
+        @return: dict of the telemetry columns of that source only (copies, selected by a mask)
+        """
+        try:
+            source = int(source)
+        except ValueError:
+            named = [number for number, name in self.sources().items() if name == source]
+            if not named:
+                raise KeyError("No telemetry source named %r" % source)
+            source = named[0]
+        columns = self.table("telemetry")
+        mask = columns["source"] == source
+        return dict((name, values[mask]) for name, values in columns.items())
+
+
+class SessionArchive(object):
+
+    def __init__(self, root=ARCHIVE_ROOT):
+        self.root = root
+        self._lock = threading.Lock()
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def create(self, participant, mode, robots=(), sync_mode="rate", started=None, source=None):
+        """
+        Start archiving a new session
+        @return: SessionWriter
+        """
+        return SessionWriter(self, participant, mode, robots, sync_mode, started, source)
+
+    def _index_path(self):
+        return os.path.join(self.root, INDEX_FILE)
+
+    def index(self):
+        """
+        @return: list of the session summaries
+        """
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return []
+
+    @contextmanager
+    def _index_locked(self):
+        """
+        Hold the index against the other threads of this process and the other processes
+        """
+        with self._lock:
+            with open(os.path.join(self.root, INDEX_LOCK_FILE), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _index_entry(meta):
+        entry = dict((key, meta[key]) for key in ("id", "participant", "mode", "robots", "sync_mode", "start",
+                                                  "end", "path"))
+        entry["source"] = meta.get("source")
+        entry["rows"] = dict((table, info["rows"]) for table, info in meta["tables"].items())
+        return entry
+
+    def add_to_index(self, meta):
+        entry = self._index_entry(meta)
+        with self._index_locked():
+            index = [e for e in self.index() if e["path"] != entry["path"]]
+            index.append(entry)
+            index.sort(key=lambda e: (e["participant"], e["start"]))
+            _write_json(self._index_path(), index)
+
+    def rebuild_index(self):
+        """
+        Rebuild the index from the meta data of every session, e.g. after copying sessions in
+        @return: number of sessions found
+        """
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            if META_FILE in files:
+                with open(os.path.join(directory, META_FILE)) as f:
+                    meta = json.load(f)
+                meta["path"] = os.path.relpath(directory, self.root)
+                entries.append(self._index_entry(meta))
+        entries.sort(key=lambda e: (e["participant"], e["start"]))
+        with self._index_locked():
+            _write_json(self._index_path(), entries)
+        return len(entries)
+
+    def sessions(self, participant=None, mode=None, robot=None, start=None, end=None):
+        """
+        Sessions matching all the given criteria
+        @param robot: robot name, matches sessions where that robot was one of the robots
+        @param start, end: time range (time.time() seconds) the session has to overlap
+        """
+        found = []
+        for entry in self.index():
+            if participant is not None and entry["participant"] != participant:
+                continue
+            if mode is not None and entry["mode"] != mode:
+                continue
+            if robot is not None and robot not in entry["robots"]:
+                continue
+            if start is not None and (entry["end"] or entry["start"]) < start:
+                continue
+            if end is not None and entry["start"] > end:
+                continue
+            found.append(entry)
+        return found
+
+    def open(self, entry):
+        """
+        @param entry: index entry or session path relative to the archive
+        @return: ArchivedSession
+        """
+        path = entry["path"] if isinstance(entry, dict) else entry
+        return ArchivedSession(os.path.join(self.root, path))
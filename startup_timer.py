@@ -0,0 +1,41 @@
+# Time line of a session's startup, from launch to the first light pulse.
+# Each step marks the time since launch when it is done and it is logged
+# straight away, so a slow startup shows which step held it up.
+import threading
+
+from tick_scheduler import monotonic
+
+
+class StartupTimer(object):
+
+    def __init__(self, logger=None, started=None):
+        """
+        @param logger: optional python logger, can be set later once it exists
+        @param started: monotonic launch time, now if not given
+        """
+        self.logger = logger
+        self.started = monotonic() if started is None else started
+        self.marks = []         # (step, seconds since launch)
+        self._lock = threading.Lock()
+
+    def mark(self, step):
+        """
+        Record that a step is done
+        @return: seconds since launch
+        """
+        elapsed = monotonic() - self.started
+        with self._lock:
+            self.marks.append((step, elapsed))
+        if self.logger:
+            self.logger.info("Startup %.2fs: %s" % (elapsed, step))
+        return elapsed
+
+    def summary(self):
+        """
+        @return: list of (step, seconds since launch) in the order they were done
+        """
+        with self._lock:
+            return list(self.marks)
+
+    def __str__(self):
+        return ", ".join("%s %.2fs" % mark for mark in self.summary())
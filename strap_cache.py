@@ -0,0 +1,163 @@
+# The straps this machine knows.
+# ble_discovery.py scans for heart rate straps and finds the handles of their
+# heart rate measurement characteristic and its notification switch. They
+# are kept in a JSON file by mac address together with the strap's name, so
+# a strap can be given by its name (or the id at the end of it, as printed on
+# a Polar) and reconnecting to a known strap goes straight to switching the
+# notifications on. How long connecting took is kept too, which gives known
+# straps a connect timeout of a few times their usual connect time rather
+# than the full CONNECT_TIMEOUT. Sessions running side by side (see
+# lab_supervisor.py) share the file, changes are made holding a lock on it.
+#
+# {
+#     "straps": {
+#         "A0:9E:1A:25:71:5C": {"name": "Polar OH1 2571C5", "value_handle": 37, "cccd_handle": 38,
+#                               "connects": 12, "connect_mean_s": 1.8, "connect_s": 1.6,
+#                               "last_connected": 1700000000.0}
+#     }
+# }
+import fcntl
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from ble_connection import CONNECT_TIMEOUT
+
+STRAP_CACHE = os.path.join(os.path.expanduser("~"), ".heartbot_straps.json")
+MIN_CONNECT_TIMEOUT = 3.0       # seconds, shortest connect timeout of a known strap
+CONNECT_TIMEOUT_FACTOR = 3.0    # a known strap gets this many times its usual connect time
+MAC = re.compile(r"^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2}){5}$")
+
+
+def is_mac(strap):
+    return bool(MAC.match(strap))
+
+
+class StrapCache(object):
+    """
+    The known straps, kept in a JSON file
+    """
+
+    def __init__(self, path=None):
+        """
+        @param path: cache file, STRAP_CACHE by default
+        """
+        self.path = path or STRAP_CACHE
+        self.straps = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f).get("straps", {})
+        except (IOError, OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the file against the other sessions sharing it
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _update(self, mac, changes):
+        """
+        Change one strap and write the file. The other straps are read again
+        first, so sessions sharing the file do not undo each other's changes
+        @param changes: dict of the changes, or a function of the strap's entry returning them
+        """
+        with self._locked():
+            self.straps = self._load()
+            entry = self.straps.setdefault(mac.upper(), {})
+            entry.update(changes(entry) if callable(changes) else changes)
+            self._write()
+        return entry
+
+    def _write(self):
+        temp = "%s.%d" % (self.path, os.getpid())
+        with open(temp, "w") as f:
+            json.dump({"straps": self.straps}, f, indent=1, sort_keys=True)
+        os.rename(temp, self.path)
+
+    def lookup(self, strap):
+        """
+        @param strap: mac address, name or the end of the name of a strap
+        @return: the mac address of the strap, None if it is not known
+        """
+        if is_mac(strap):
+            return strap.upper()
+        strap = strap.lower()
+        for mac, entry in sorted(self.straps.items()):
+            name = (entry.get("name") or "").lower()
+            if name and (name == strap or name.endswith(" " + strap)):
+                return mac
+        return None
+
+    def last_used(self):
+        """
+        @return: mac address of the strap connected to last, None if there is none
+        """
+        used = [(entry["last_connected"], mac) for mac, entry in self.straps.items() if "last_connected" in entry]
+        return max(used)[1] if used else None
+
+    def handles(self, mac):
+        """
+        @return: (heart rate measurement value handle, its notification switch handle), None if not discovered yet
+        """
+        entry = self.straps.get(mac.upper(), {})
+        if "value_handle" not in entry or "cccd_handle" not in entry:
+            return None
+        return entry["value_handle"], entry["cccd_handle"]
+
+    def connect_timeout(self, mac):
+        """
+        @return: seconds to wait for a connection to the strap
+        """
+        mean = self.straps.get(mac.upper(), {}).get("connect_mean_s")
+        if mean is None:
+            return CONNECT_TIMEOUT
+        return min(max(CONNECT_TIMEOUT_FACTOR * mean, MIN_CONNECT_TIMEOUT), CONNECT_TIMEOUT)
+
+    def add(self, mac, name=None, handles=None):
+        """
+        Remember a strap, and its handles once they are known
+        """
+        changes = {}
+        if name:
+            changes["name"] = name
+        if handles:
+            changes["value_handle"], changes["cccd_handle"] = handles
+        return self._update(mac, changes)
+
+    def record_connect(self, mac, seconds):
+        """
+        Keep how long connecting to the strap took
+        """
+        def changes(entry):
+            connects = entry.get("connects", 0) + 1
+            mean = entry.get("connect_mean_s", seconds)
+            return {
+                "connects": connects,
+                "connect_s": seconds,
+                "connect_mean_s": mean + (seconds - mean) / connects,
+                "last_connected": time.time(),
+            }
+        return self._update(mac, changes)
+
+    def forget(self, mac):
+        """
+        Drop a strap, e.g. after a firmware update moved its handles
+        """
+        with self._locked():
+            self.straps = self._load()
+            if self.straps.pop(mac.upper(), None) is not None:
+                self._write()
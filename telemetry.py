@@ -0,0 +1,208 @@
+# Binary telemetry for the hot loops.
+# The light loops and the heart rate reader used to write two formatted log
+# lines per tick through the logging FileHandler on their own thread. Instead
+# each of them gets a TelemetryChannel: a fixed size ring buffer of fixed size
+# binary records that only it writes to. A single background thread drains all
+# the channels and appends them to the telemetry file in bulk.
+# Each channel has exactly one producer and one consumer, and each side only
+# ever moves its own counter, so no locks are needed.
+# Human readable events (connections, rate changes, ...) stay in the log.
+# Every robot of a session records under a source of its own: the source of
+# its type plus SOURCE_STRIDE times its place in the session, so the first
+# robot keeps the plain SOURCE_PEPPER/SOURCE_MIRO. The telemetry keeps which
+# source is which robot (sources) for the session archive.
+import struct
+import threading
+import time
+
+MAGIC = b"HBTL"
+VERSION = 1
+HEADER = struct.Struct('<4sHH')              # magic, version, record size
+# timestamp, phase (radians), heart rate (bpm), brightness (0-1), source
+RECORD = struct.Struct('<ddffB7x')
+
+SOURCE_READER = 1
+SOURCE_MIRO = 2
+SOURCE_PEPPER = 3
+SOURCE_PLL = 4       # one record per beat: predicted heart rate and beat phase error
+SOURCE_NAMES = {SOURCE_READER: "reader", SOURCE_MIRO: "miro", SOURCE_PEPPER: "pepper", SOURCE_PLL: "pll"}
+SOURCE_STRIDE = 16   # sources of the same type apart, the source byte holds 16 robots of each
+
+
+def robot_source(source, index):
+    """
+    @param source: SOURCE_ constant of the robot type (or its PLL)
+    @param index: place of the robot in the session
+    @return: the source the robot records under
+    """
+    if not 0 <= index < 0x100 // SOURCE_STRIDE:
+        raise ValueError("No telemetry source for robot %d, at most %d robots" % (index, 0x100 // SOURCE_STRIDE))
+    return source + SOURCE_STRIDE * index
+
+
+def source_type(source):
+    """
+    @return: the SOURCE_ constant of the type of a robot's source
+    """
+    return source % SOURCE_STRIDE
+
+
+def source_name(source):
+    """
+    @return: e.g. "pepper" for the first Pepper of a session, "pepper 2" for the third
+    """
+    name = SOURCE_NAMES.get(source_type(source), "source")
+    index = source // SOURCE_STRIDE
+    return "%s %d" % (name, index) if index else name
+
+
+class TelemetryChannel(object):
+    """
+    Single producer ring buffer of telemetry records
+    """
+
+    def __init__(self, source, capacity=4096):
+        """
+        @param source: one of the SOURCE_ constants
+        @param capacity: number of records the buffer holds before dropping
+        """
+        self.source = source
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.head = 0            # records written, only moved by the producer
+        self.tail = 0            # records drained, only moved by the writer thread
+        self.dropped = 0
+
+    def record(self, heart_rate, phase=0.0, brightness=0.0):
+        """
+        Add a record. Never blocks, drops the record if the writer has fallen behind
+        """
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        RECORD.pack_into(self.buffer, (head % self.capacity) * RECORD.size,
+                         time.time(), phase, heart_rate, brightness, self.source)
+        # only make the record visible once it is fully written
+        self.head = head + 1
+
+    def drain(self):
+        """
+        Take all the records written so far
+        @return: bytes of the records
+        """
+        head = self.head
+        tail = self.tail
+        if head == tail:
+            return b""
+        start = (tail % self.capacity) * RECORD.size
+        end = (head % self.capacity) * RECORD.size
+        if start < end:
+            data = bytes(self.buffer[start:end])
+        else:
+            data = bytes(self.buffer[start:]) + bytes(self.buffer[:end])
+        self.tail = head
+        return data
+
+
+class Telemetry(threading.Thread):
+    """
+    Background writer that flushes all the channels to one file
+    """
+
+    def __init__(self, path, flush_interval=0.5, capacity=4096):
+        """
+        @param path: telemetry file to write
+        @param flush_interval: seconds between bulk writes
+        @param capacity: records per channel
+        """
+        super(Telemetry, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.channels = []
+        self.sinks = []
+        self.sources = {}        # source to the name of what records under it
+        self._stop_event = threading.Event()
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    def channel(self, source, name=None):
+        """
+        Create the channel for one producer
+        @param name: name of the producer, e.g. the robot's, kept in sources
+        """
+        channel = TelemetryChannel(source, self.capacity)
+        self.channels.append(channel)
+        self.sources[source] = name or source_name(source)
+        return channel
+
+    def robot(self, index):
+        """
+        @return: the telemetry as the robot at index in the session sees it
+        """
+        return RobotTelemetry(self, index)
+
+    def add_sink(self, sink):
+        """
+        @param sink: callable that also gets every block of records written, on the writer thread
+        """
+        self.sinks.append(sink)
+
+    def flush(self):
+        data = b"".join([channel.drain() for channel in list(self.channels)])
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            for sink in self.sinks:
+                sink(data)
+        return data
+
+    def run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    @property
+    def dropped(self):
+        return sum(channel.dropped for channel in self.channels)
+
+    def stop(self):
+        """
+        Stop the writer and flush whatever is left
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        self._file.close()
+
+
+class RobotTelemetry(object):
+    """
+    Hands out the channels of one robot of the session under its own sources
+    """
+
+    def __init__(self, telemetry, index):
+        self.telemetry = telemetry
+        self.index = index
+
+    def channel(self, source, name=None):
+        return self.telemetry.channel(robot_source(source, self.index), name)
+
+
+def read_telemetry(path):
+    """
+    Read back a telemetry file
+    @return: list of (timestamp, source, heart_rate, phase, brightness)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, size = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or size != RECORD.size:
+        raise ValueError("%s is not a version %d telemetry file" % (path, VERSION))
+    records = []
+    for offset in range(HEADER.size, len(data) - size + 1, size):
+        timestamp, phase, heart_rate, brightness, source = RECORD.unpack_from(data, offset)
+        records.append((timestamp, source, heart_rate, phase, brightness))
+    return records
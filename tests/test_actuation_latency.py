@@ -0,0 +1,47 @@
+# The actuation latency counts from when step() worked a command out.
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import fake_naoqi
+import fake_ros
+from actuation_latency import ActuationLatency
+from hr_sources import HeartRateSource
+
+RPC_LATENCY = 0.01
+QUEUED = 0.05
+
+
+class QueuedCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        fake_naoqi.install(RPC_LATENCY)
+        fake_ros.install()
+
+    def test_queued_time_counts_in_full(self):
+        latency = ActuationLatency(round_trip=True)
+        self.assertAlmostEqual(latency.add(0.02, queued=0.05), 0.06)
+
+    def send_late(self, robot):
+        robot.start_lights()
+        command = robot.step(0.0, 0.05)
+        # as if it waited in the fanout mailbox behind a busy robot
+        time.sleep(QUEUED)
+        robot.send(command)
+        return robot.actuation.estimate
+
+    def test_pepper(self):
+        from pepper_heartbot_lights import PepperHandler
+        robot = PepperHandler(HeartRateSource())
+        self.assertGreaterEqual(self.send_late(robot), QUEUED + RPC_LATENCY / 2.0)
+
+    def test_miro(self):
+        from miro_heartbot_lights import miro_ros_client_std
+        robot = miro_ros_client_std("miro", HeartRateSource())
+        self.assertGreaterEqual(self.send_late(robot), QUEUED)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# The beat locked loop against a strap that notifies on its own clock, about
+# once a second whatever the heart rate, as a polarOH does.
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy as np
+
+from beat_pll import BeatPLL
+from hr_sources import HRSample
+from light_trajectory import render_beats
+
+LATENCY = 0.03                  # seconds from a notification being due to it arriving
+
+
+def beat_times(bpm, seconds, noise=0.02, seed=1):
+    """
+    @return: beat times with some beat to beat variation, the first not on a notification
+    """
+    rng = random.Random(seed)
+    beats = [0.37]
+    while beats[-1] < seconds + 5.0:
+        beats.append(beats[-1] + 60.0 / bpm + rng.gauss(0.0, noise))
+    return beats
+
+
+def notifications(beats, seconds, interval=1.0, seed=2):
+    """
+    @return: HRSamples every interval seconds with the RR-intervals of the beats since the last one
+    """
+    rng = random.Random(seed)
+    samples = []
+    sent = 0
+    due = interval
+    while due < seconds:
+        last = sent
+        while beats[last] <= due:
+            last += 1
+        rr = [1000.0 * (beats[i] - beats[i - 1]) for i in range(max(sent, 1), last)]
+        hr = 60000.0 * len(rr) / sum(rr) if rr else 0
+        samples.append(HRSample(len(samples) + 1, due + LATENCY + rng.uniform(0.0, 0.02), hr, rr, None))
+        sent = last
+        due += interval
+    return samples
+
+
+def phase_error_rms(errors):
+    return math.degrees(math.sqrt(sum(error * error for error in errors) / len(errors)))
+
+
+class BeatPLLTest(unittest.TestCase):
+
+    def run_live(self, bpm, interval=1.0, seconds=180.0):
+        """
+        @return: the loop, and the phase errors of the beats of the second half,
+                 each against the prediction of the loop at the time
+        """
+        beats = beat_times(bpm, seconds)
+        pll = BeatPLL(beat_delay=LATENCY)
+        errors = []
+        upcoming = 0
+        for sample in notifications(beats, seconds, interval):
+            pll.add_sample(sample)
+            while beats[upcoming] <= sample.timestamp:
+                upcoming += 1
+            end = upcoming
+            while beats[end] <= sample.timestamp + interval:
+                if sample.timestamp > seconds / 2.0:
+                    position = pll.beat_phase(beats[end])
+                    errors.append(2 * math.pi * (position - round(position)))
+                end += 1
+        return pll, errors
+
+    def test_locks_on_the_beats_not_the_notifications(self):
+        for bpm in (55.0, 72.0, 110.0):
+            pll, errors = self.run_live(bpm)
+            self.assertAlmostEqual(pll.period, 60.0 / bpm, delta=0.02 * 60.0 / bpm)
+            self.assertLess(phase_error_rms(errors), 45.0)
+
+    def test_notification_interval_off_a_second(self):
+        pll, errors = self.run_live(72.0, interval=0.93)
+        self.assertAlmostEqual(pll.period, 60.0 / 72.0, delta=0.02)
+        self.assertLess(phase_error_rms(errors), 45.0)
+
+    def test_anchored_again_after_a_gap(self):
+        beats = beat_times(72.0, 60.0)
+        samples = [sample for sample in notifications(beats, 60.0) if not 20.0 < sample.timestamp < 30.0]
+        pll = BeatPLL(beat_delay=LATENCY)
+        for sample in samples:
+            pll.add_sample(sample)
+        self.assertEqual(pll.anchors, 2)
+        self.assertAlmostEqual(pll.period, 60.0 / 72.0, delta=0.02)
+
+    def test_render_beats_peaks_on_every_second_beat(self):
+        seconds = 120.0
+        beats = beat_times(72.0, seconds)
+        samples = notifications(beats, seconds)
+        ticks = np.arange(0.0, seconds, 0.05)
+        trajectory = render_beats(samples, ticks, BeatPLL(beat_delay=LATENCY))
+        late = ticks > seconds / 2.0
+        self.assertAlmostEqual(np.mean(np.diff(trajectory.phase[late])) / 0.05, math.pi * 72.0 / 60.0,
+                               delta=0.05 * math.pi * 72.0 / 60.0)
+        # every beat is half a light cycle, the light peaks (phase a multiple of 2pi) fall on every second one
+        beats = np.array([beat for beat in beats if seconds / 2.0 < beat < seconds - 1.0])
+        phase = np.interp(beats, ticks, trajectory.phase) / math.pi
+        errors = math.pi * (phase - np.round(phase))
+        self.assertLess(phase_error_rms(errors.tolist()), 45.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+# The connection state machine against a scripted transport.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ble_connection import CONNECTED, STREAMING, WRITTEN, ConnectionStateMachine
+from hr_measurement import gatt_value_to_bytes
+from hr_sources import HeartRateSource
+
+PREFIX = b"Notification handle = 0x0025 value: "
+
+
+class ScriptedBackend(object):
+    """
+    Transport that does what it is told and keeps no strap of its own
+    """
+
+    def __init__(self):
+        self.device = "A0:9E:1A:25:71:5C"
+        self.handles = (0x0025, 0x0026)
+        self.connect_timeout = 10.0
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def switch_notifications(self, switchOn):
+        pass
+
+    def notification_value(self, line):
+        if not line.startswith(PREFIX):
+            return None
+        return gatt_value_to_bytes(line[len(PREFIX):])
+
+
+class MalformedNotificationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = HeartRateSource()
+        self.samples = []
+        self.source.add_sample_listener(self.samples.append)
+        self.machine = ConnectionStateMachine(self.source, ScriptedBackend())
+        self.lifecycle = self.machine.lifecycle()
+        next(self.lifecycle)
+        self.lifecycle.send([CONNECTED])
+        self.lifecycle.send([WRITTEN])
+        self.assertEqual(self.machine.state, STREAMING)
+
+    def test_truncated_notification_is_skipped(self):
+        self.lifecycle.send([PREFIX + b"01 4b"])
+        self.lifecycle.send([PREFIX + b"00 48"])
+        self.assertEqual(self.machine.state, STREAMING)
+        self.assertEqual(self.machine.metrics.malformed, 1)
+        self.assertEqual([sample.heart_rate for sample in self.samples], [72])
+
+    def test_good_notifications_of_a_batch_are_kept(self):
+        self.lifecycle.send([PREFIX + b"00 46", PREFIX + b"zz 4b", PREFIX + b"08 4b 01", PREFIX + b"00 48"])
+        self.assertEqual(self.machine.state, STREAMING)
+        self.assertEqual(self.machine.metrics.malformed, 2)
+        self.assertEqual(self.source.heartRate, 72)
+        self.assertEqual(len(self.samples), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
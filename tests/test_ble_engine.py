@@ -0,0 +1,70 @@
+# One strap going wrong must not take the others down with it.
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir))
+from ble_connection import STREAMING
+from ble_engine import BLEReaderEngine, GatttoolBackend
+from strap_cache import StrapCache
+
+FAKE_GATTTOOL = "%s %s --rate 5" % (sys.executable,
+                                    os.path.join(TESTS_DIR, os.pardir, "benchmarks", "fake_gatttool.py"))
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+class EngineRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mktemp(suffix=".json", prefix="heartbot_straps_")
+        self.engine = BLEReaderEngine(lambda mac: GatttoolBackend(mac, FAKE_GATTTOOL),
+                                      cache=StrapCache(self.cache_path))
+        self.first = self.engine.add_sensor("AA:BB:CC:DD:EE:01")
+        self.second = self.engine.add_sensor("AA:BB:CC:DD:EE:02")
+        self.engine.start()
+        self.assertTrue(wait_for(lambda: self.first.state == STREAMING and self.second.state == STREAMING))
+
+    def tearDown(self):
+        self.engine.stop()
+        for path in (self.cache_path, self.cache_path + ".lock"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def streams(self, session):
+        count = session.samples.qsize()
+        return wait_for(lambda: session.samples.qsize() > count)
+
+    def test_gatttool_exiting_reconnects_that_strap(self):
+        os.kill(self.first.backend.child.pid, signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: self.first.connection.metrics.attempts == 2))
+        self.assertTrue(self.streams(self.first))
+        self.assertTrue(self.streams(self.second))
+        self.assertEqual(self.first.connection.metrics.summary()["dropouts"], 1)
+
+    def test_error_in_one_lifecycle_restarts_only_it(self):
+        failed = []
+
+        def subscriber(sample):
+            if not failed:
+                failed.append(sample)
+                raise RuntimeError("subscriber failed")
+        self.second.add_sample_listener(subscriber)
+        self.assertTrue(wait_for(lambda: self.second.connection.metrics.attempts == 2))
+        self.assertTrue(self.streams(self.second))
+        self.assertTrue(self.streams(self.first))
+        self.assertEqual(self.first.connection.metrics.attempts, 1)
+        self.assertTrue(self.engine._thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# The reader thread carries on whatever happens to gatttool or the subscribers.
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir))
+import HR_reader
+from ble_connection import STREAMING
+from strap_cache import StrapCache
+
+FAKE_GATTTOOL = "%s %s --rate 5" % (sys.executable,
+                                    os.path.join(TESTS_DIR, os.pardir, "benchmarks", "fake_gatttool.py"))
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+class ReaderRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mktemp(suffix=".json", prefix="heartbot_straps_")
+        self.command = HR_reader.GATTTOOL_CMD
+        HR_reader.GATTTOOL_CMD = FAKE_GATTTOOL
+        self.reader = HR_reader.HeartBeat_BLE(device="AA:BB:CC:DD:EE:01", cache=StrapCache(self.cache_path))
+        self.samples = []
+        self.reader.add_sample_listener(self.samples.append)
+        self.reader.start()
+        self.assertTrue(self.reader.wait_streaming(10.0))
+
+    def tearDown(self):
+        self.reader.stop()
+        HR_reader.GATTTOOL_CMD = self.command
+        for path in (self.cache_path, self.cache_path + ".lock"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def streams(self):
+        count = len(self.samples)
+        return wait_for(lambda: self.reader.connection.state == STREAMING and len(self.samples) > count)
+
+    def test_gatttool_exiting_respawns_it(self):
+        os.kill(self.reader.backend.child.pid, signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: self.reader.connection.metrics.attempts == 2))
+        self.assertTrue(self.streams())
+        self.assertTrue(self.reader.is_alive())
+
+    def test_listener_error_restarts_the_lifecycle(self):
+        failed = []
+
+        def listener(sample):
+            if not failed:
+                failed.append(sample)
+                raise IOError("recorder failed")
+        self.reader.add_sample_listener(listener)
+        self.assertTrue(wait_for(lambda: self.reader.connection.metrics.attempts == 2))
+        self.assertTrue(self.streams())
+        self.assertTrue(self.reader.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
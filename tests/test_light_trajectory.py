@@ -0,0 +1,92 @@
+# The robot handlers have to pulse exactly as light_trajectory renders it.
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy as np
+
+import fake_naoqi
+import fake_ros
+from hr_measurement import HRMeasurement
+from hr_sources import HeartRateSource, HRSample
+from light_trajectory import render, render_beats, tick_times
+
+UPDATE_RATE = 20.0
+TICKS = 400
+
+
+def heart_rate_samples(duration, rng):
+    """
+    @return: HRSamples about once a second, with the RR-intervals of the beats since the last one
+    """
+    samples = []
+    t = 0.3
+    beat = 0.0
+    while t < duration:
+        heart_rate = 65.0 + 10.0 * np.sin(t / 3.0) + rng.uniform(-2.0, 2.0)
+        rr = []
+        while beat + 60.0 / heart_rate <= t:
+            beat += 60.0 / heart_rate
+            rr.append(60000.0 / heart_rate)
+        measurement = HRMeasurement(int(heart_rate), None, None, tuple(rr))
+        samples.append(HRSample(len(samples) + 1, t, measurement.heart_rate, measurement.rr_intervals, measurement))
+        t += rng.uniform(0.9, 1.1)
+    return samples
+
+
+class GoldenTrajectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        fake_naoqi.install()
+        fake_ros.install()
+        rng = random.Random(20)
+        # late and early ticks, as the scheduler really has them
+        self.ticks = tick_times(TICKS / UPDATE_RATE, UPDATE_RATE) + np.array(
+            [rng.uniform(0.0, 0.02) for _ in range(TICKS)])
+        self.samples = heart_rate_samples(self.ticks[-1], rng)
+
+    def step(self, make_robot):
+        """
+        Run a robot's step() over the ticks, the samples coming in as they would live
+        @return: its phase at every tick
+        """
+        source = HeartRateSource()
+        robot = make_robot(source)
+        robot.start_lights()
+        phases = []
+        pending = list(self.samples)
+        for index, now in enumerate(self.ticks):
+            while pending and pending[0].timestamp <= now:
+                sample = pending.pop(0)
+                source.publish_measurement(sample.measurement, sample.timestamp)
+            robot.step(now, self.ticks[index] - self.ticks[index - 1] if index else 1.0 / UPDATE_RATE)
+            phases.append(robot.phase)
+        return np.array(phases)
+
+    def rendered(self, asynchMode, sync_mode):
+        if sync_mode == "beat":
+            return render_beats(self.samples, self.ticks, asynchMode=asynchMode).phase
+        return render([s.timestamp for s in self.samples], [s.heart_rate for s in self.samples], self.ticks,
+                      UPDATE_RATE, asynchMode).phase
+
+    def check(self, make_robot):
+        for asynchMode in (False, True):
+            for sync_mode in ("rate", "beat"):
+                phases = self.step(lambda source: make_robot(source, asynchMode, sync_mode))
+                error = np.max(np.abs(phases - self.rendered(asynchMode, sync_mode)))
+                self.assertEqual(error, 0.0, "%s %s: %r" % ("async" if asynchMode else "sync", sync_mode, error))
+
+    def test_pepper(self):
+        from pepper_heartbot_lights import PepperHandler
+        self.check(lambda source, asynchMode, sync_mode: PepperHandler(source, asynchMode, sync_mode=sync_mode))
+
+    def test_miro(self):
+        from miro_heartbot_lights import miro_ros_client_std
+        self.check(lambda source, asynchMode, sync_mode: miro_ros_client_std("miro", source, asynchMode,
+                                                                             sync_mode=sync_mode))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+# Importing the text logs of sessions from before the archive.
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy as np
+
+from log_import import import_log, import_logs
+from session_archive import SessionArchive
+from telemetry import SOURCE_MIRO, SOURCE_PEPPER
+
+# as the lights loops wrote them, Miro's brightness being its LED word int(mag * 0xFF) << 24
+LOG = """\
+2019-05-03 14:12:00,101 HeartBot     INFO     Participant Number 7
+2019-05-03 14:12:01,234 HeartBot     INFO     Heart rate change: 60 to 72
+2019-05-03 14:12:01,251 HeartBot     INFO     Miro current heart_rate: 1.200000 beats per seond
+2019-05-03 14:12:01,252 HeartBot     INFO     Phase: 60.000000 \t Brightness: 3204448256.000000
+2019-05-03 14:12:01,302 HeartBot     INFO     Phase: 180.000000 \t Brightness: 0.000000
+2019-05-03 14:12:01,351 HeartBot     INFO     Pepper current heart_rate: 1.200000 beats per seond
+2019-05-03 14:12:01,352 HeartBot     INFO     Phase: 60.000000 \t Brightness: 0.750000
+"""
+
+
+class MiroBrightnessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="heartbot_import_")
+        self.log_path = os.path.join(self.directory, "HeartBot_190503_14120010.log")
+        with open(self.log_path, "w") as f:
+            f.write(LOG)
+        self.archive = SessionArchive(os.path.join(self.directory, "archive"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miro_led_word_is_brightness(self):
+        meta = import_log(self.archive, self.log_path)
+        session = self.archive.open(meta["path"])
+        self.assertEqual(meta["participant"], 7)
+        self.assertEqual(sorted(meta["robots"]), ["Miro", "Pepper"])
+        miro = session.telemetry(SOURCE_MIRO)
+        self.assertTrue(np.allclose(miro["brightness"], [int(0.75 * 0xFF) / 255.0, 0.0]))
+        self.assertAlmostEqual(miro["phase"][0], math.radians(60.0))
+        pepper = session.telemetry(SOURCE_PEPPER)
+        self.assertTrue(np.allclose(pepper["brightness"], [0.75]))
+        self.assertTrue(np.all(session.column("telemetry", "brightness") <= 1.0))
+
+
+class LiveSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="heartbot_import_")
+        os.mkdir(os.path.join(self.directory, "P7"))
+        self.log_path = os.path.join(self.directory, "P7", "HeartBot_141200_03052019.log")
+        with open(self.log_path, "w") as f:
+            f.write(LOG)
+        self.archive_root = os.path.join(self.directory, "archive")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_log_of_a_live_session_is_not_imported_again(self):
+        # as polarHeartBot archives it, with the absolute path of its log
+        SessionArchive(self.archive_root).create(7, "sync", source=os.path.abspath(self.log_path)).close()
+        sessions, rows, failed = import_logs(self.directory, self.archive_root, processes=1)
+        self.assertEqual((sessions, failed), (0, []))
+        self.assertEqual(len(SessionArchive(self.archive_root).index()), 1)
+
+    def test_log_without_session_is_imported(self):
+        sessions, rows, failed = import_logs(self.directory, self.archive_root, processes=1)
+        self.assertEqual((sessions, failed), (1, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+# What the live session archive keeps of a heart rate source.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy as np
+
+from hr_measurement import encode_hr_measurement
+from hr_sources import HeartRateSource
+from session_archive import SessionArchive
+
+
+class NotificationRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="heartbot_archive_")
+        self.archive = SessionArchive(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_batch_is_a_row_per_notification(self):
+        source = HeartRateSource()
+        writer = self.archive.create(7, "sync")
+        writer.attach(source)
+        source.handle_notification(encode_hr_measurement(70, (857,)))
+        # a backlog handed on together is one sample for the subscribers
+        source.handle_notifications([encode_hr_measurement(71, (845,)), encode_hr_measurement(72, (833, 834)),
+                                     encode_hr_measurement(73, ())])
+        writer.close()
+        session = self.archive.open(writer.meta["path"])
+        self.assertEqual(list(session.column("samples", "heart_rate")), [70, 71, 72, 73])
+        self.assertEqual(list(session.column("samples", "seq")), [1, 2, 3, 4])
+        # the strap sends 1/1024 s
+        self.assertTrue(np.allclose(session.column("rr", "interval"), [857, 845, 833, 834], atol=1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+# Fixed rate scheduler for the robot light loops.
+# Sleeping for the update period after doing the work makes the real period
+# the update time plus however long the work took, and datetime.now() jumps
+# about with the wall clock. Instead every tick has an absolute deadline on the
+# monotonic clock and we sleep only for what is left until it.
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2 has no time.monotonic, so ask the kernel directly
+    import ctypes
+    import ctypes.util
+    import os
+
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        """
+        Seconds on the system monotonic clock
+        """
+        ts = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+CATCH_UP = "catchup"     # run late ticks back to back until we are on schedule again
+SKIP = "skip"            # drop the ticks we missed and carry on from the next deadline
+
+
+class TickStats(object):
+    """
+    Running timing statistics of a TickScheduler. Jitter is how late a tick
+    woke up relative to its deadline
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.overruns = 0        # ticks that started more than a period late
+        self.skipped = 0         # deadlines dropped under the SKIP policy
+        self.jitter_max = 0.0
+        self._jitter_sum = 0.0
+        self._jitter_sq_sum = 0.0
+
+    def record(self, lateness):
+        self.ticks += 1
+        self._jitter_sum += lateness
+        self._jitter_sq_sum += lateness * lateness
+        if lateness > self.jitter_max:
+            self.jitter_max = lateness
+
+    @property
+    def jitter_mean(self):
+        return self._jitter_sum / self.ticks if self.ticks else 0.0
+
+    @property
+    def jitter_rms(self):
+        return (self._jitter_sq_sum / self.ticks) ** 0.5 if self.ticks else 0.0
+
+    def __str__(self):
+        return ("ticks: %d overruns: %d skipped: %d jitter mean: %.2fms rms: %.2fms max: %.2fms"
+                % (self.ticks, self.overruns, self.skipped, self.jitter_mean * 1000.0,
+                   self.jitter_rms * 1000.0, self.jitter_max * 1000.0))
+
+
+class TickScheduler(object):
+    """
+    Ticks at a fixed rate using absolute deadlines on the monotonic clock
+    """
+
+    def __init__(self, rate=20.0, policy=SKIP, max_catch_up=5):
+        """
+        @param rate: ticks per second
+        @param policy: CATCH_UP or SKIP, what to do with deadlines we have already missed
+        @param max_catch_up: with CATCH_UP, the most ticks we will run back to back before skipping anyway
+        """
+        if rate <= 0:
+            raise ValueError("Tick rate must be positive: %r" % rate)
+        self.rate = float(rate)
+        self.period = 1.0 / self.rate
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.stats = TickStats()
+        self.next_deadline = None
+        self.last_tick = None
+        self.last_lateness = 0.0     # seconds the last tick woke up after its deadline
+
+    def start(self):
+        """
+        (Re)start the schedule from now. Called by the first wait() if needed
+        @return: the current monotonic time
+        """
+        now = monotonic()
+        self.next_deadline = now + self.period
+        self.last_tick = now
+        return now
+
+    def wait(self):
+        """
+        Sleep until the next tick is due
+        @return: seconds since the previous tick (what to advance phases by)
+        """
+        if self.next_deadline is None:
+            self.start()
+        now = monotonic()
+        delay = self.next_deadline - now
+        if delay > 0:
+            time.sleep(delay)
+            now = monotonic()
+
+        lateness = now - self.next_deadline
+        self.last_lateness = lateness
+        self.stats.record(lateness)
+        if lateness >= self.period:
+            self.stats.overruns += 1
+            missed = int(lateness / self.period)
+            if self.policy == CATCH_UP and missed <= self.max_catch_up:
+                # next deadlines are already in the past so they fire straight away
+                self.next_deadline += self.period
+            else:
+                self.stats.skipped += missed
+                self.next_deadline += (missed + 1) * self.period
+        else:
+            self.next_deadline += self.period
+
+        elapsed = now - self.last_tick
+        self.last_tick = now
+        return elapsed
+
+    def __iter__(self):
+        """
+        Iterate over ticks, yielding seconds since the previous tick
+        """
+        self.start()
+        while True:
+            yield self.wait()
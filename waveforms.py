@@ -0,0 +1,128 @@
+# Shapes of the light pulse.
+# A waveform is the brightness over one cycle of the pulse phase (0 to 2pi,
+# brightest at 0), precomputed into a table of TABLE_SIZE points when the
+# module is loaded. Every tick the light loops only look up the phase in the
+# table, interpolating between neighbouring points, and Miro gets its
+# brightness byte already shifted into place from a uint32 table, so there is
+# no maths left per tick whatever the shape.
+#
+#   cosine        the raised cosine the robots have always pulsed with
+#   lubdub        a heart sound like double thump, a strong beat and a weaker one right behind it
+#   attack_decay  a sharp rise and a long exponential fade
+#
+# Robots pick theirs with "waveform" in the session file, e.g.
+#   {"type": "miro", "name": "miro01", "waveform": "lubdub"}
+import math
+
+import numpy as np
+
+TABLE_SIZE = 4096               # points per cycle
+LEVEL_MAX = 0xFF                # Miro brightness byte
+TWO_PI = 2 * math.pi
+
+# lubdub: bumps exp(k (cos(x - centre) - 1)), width from k
+LUB_SHARPNESS = 6.0
+DUB_DELAY = 0.2                 # of a cycle between the two thumps
+DUB_AMPLITUDE = 0.6
+# attack_decay
+ATTACK = 0.08                   # of a cycle to rise
+DECAY = 0.2                     # of a cycle for the fade to drop to 1/e
+
+
+def cosine(x):
+    """
+    @param x: phase in radians, array
+    @return: brightness 0-1
+    """
+    return np.cos(x) * 0.5 + 0.5
+
+
+def lubdub(x):
+    lub = np.exp(LUB_SHARPNESS * (np.cos(x) - 1.0))
+    dub = DUB_AMPLITUDE * np.exp(LUB_SHARPNESS * (np.cos(x - TWO_PI * DUB_DELAY) - 1.0))
+    mag = lub + dub
+    return (mag - mag.min()) / (mag.max() - mag.min())
+
+
+def attack_decay(x):
+    cycle = np.mod(x, TWO_PI) / TWO_PI
+    # the fade runs from the peak at 0, the rise takes the end of the cycle up to the next peak
+    fade = np.exp(-cycle / DECAY)
+    floor = math.exp(-(1.0 - ATTACK) / DECAY)
+    rise = np.clip((cycle - (1.0 - ATTACK)) / ATTACK, 0.0, 1.0)
+    mag = np.where(cycle < 1.0 - ATTACK, fade, floor + (1.0 - floor) * rise * rise * (3.0 - 2.0 * rise))
+    return (mag - floor) / (1.0 - floor)
+
+
+SHAPES = {
+    "cosine": cosine,
+    "lubdub": lubdub,
+    "attack_decay": attack_decay,
+}
+
+
+class Waveform(object):
+    """
+    Lookup table of one pulse shape
+    """
+
+    def __init__(self, name, shape, size=TABLE_SIZE):
+        """
+        @param shape: brightness 0-1 as a function of an array of phases
+        @param size: points per cycle
+        """
+        self.name = name
+        self.size = size
+        self.scale = size / TWO_PI
+        # the table runs a point into the next cycle so interpolating never has to wrap around,
+        # and one more for phases that only round up to a whole cycle
+        self.table = np.asarray(shape(np.arange(size + 2) * (TWO_PI / size)), dtype=np.float64)
+        self.table[size:] = self.table[:2]
+        self.points = self.table.tolist()
+        # Miro's brightness byte of every point, in place in the 0xLLRRGGBB word
+        self.levels = (self.table[:size] * LEVEL_MAX).astype(np.uint32) << np.uint32(24)
+
+    def brightness(self, phase):
+        """
+        @param phase: radians, number or array
+        @return: brightness 0-1, interpolated between the points of the table
+        """
+        if isinstance(phase, np.ndarray):
+            position = np.mod(phase, TWO_PI) * self.scale
+            index = position.astype(np.intp)
+            fraction = position - index
+            low = self.table[index]
+            return low + fraction * (self.table[index + 1] - low)
+        position = phase % TWO_PI * self.scale
+        index = int(position)
+        low = self.points[index]
+        return low + (position - index) * (self.points[index + 1] - low)
+
+    def level(self, phase):
+        """
+        @param phase: radians, number or array
+        @return: Miro brightness byte(s) shifted into the top of the LED word, from the nearest point
+        """
+        if isinstance(phase, np.ndarray):
+            return self.levels[(np.mod(phase, TWO_PI) * self.scale + 0.5).astype(np.intp) % self.size]
+        return self.levels[int(phase % TWO_PI * self.scale + 0.5) % self.size]
+
+    def __repr__(self):
+        return "Waveform(%r)" % self.name
+
+
+WAVEFORMS = dict((name, Waveform(name, shape)) for name, shape in SHAPES.items())
+COSINE = WAVEFORMS["cosine"]
+
+
+def get_waveform(name):
+    """
+    @param name: one of WAVEFORMS, or a Waveform which is returned as it is
+    @return: the Waveform
+    """
+    if isinstance(name, Waveform):
+        return name
+    try:
+        return WAVEFORMS[name]
+    except KeyError:
+        raise ValueError("Unknown waveform %r, one of %s" % (name, ", ".join(sorted(WAVEFORMS))))